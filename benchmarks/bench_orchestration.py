@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Benchmark of chorut's own overhead in setup() and teardown(), without root.
+
+Runs root mode setups and teardowns against a RecordingMountManager, whose
+mounts only change an in-memory table, so the time measured is the Python
+orchestration around the mounts. Then sets up and tears down a fleet of
+roots whose mounts take a fixed injected latency, to show how scheduling
+and concurrency limits shape the total time.
+
+Usage: python benchmarks/bench_orchestration.py [iterations] [latency_ms]
+"""
+
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chorut import SETUP_PROFILES, ChrootManager
+from chorut.fleet import ChrootFleet
+from chorut.recording import RecordingMountManager
+
+
+def overhead(chroot_dir: str, iterations: int, **kwargs) -> tuple[float, float, int]:
+    """Return the median setup and teardown time in µs, and the operations per cycle."""
+    recorder = RecordingMountManager()
+    setups, teardowns = [], []
+    for _ in range(iterations):
+        recorder.clear()
+        chroot = ChrootManager(chroot_dir, mount_manager=recorder, **kwargs)
+        start = time.perf_counter()
+        chroot.setup()
+        setups.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        chroot.teardown()
+        teardowns.append(time.perf_counter() - start)
+    return statistics.median(setups) * 1e6, statistics.median(teardowns) * 1e6, len(recorder.operations)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 2.0) / 1000
+    # Silence the "not a mountpoint" warning of every setup
+    logging.disable(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as chroot_dir:
+        print(f"{'':28} {'setup':>9} {'teardown':>9} {'ops':>4} {'per op':>8}")
+        binds = [{"source": "/srv", "target": f"/mnt/bench{i}", "bind": True} for i in range(8)]
+        cases = [(f"profile {profile}", {"setup_profile": profile}) for profile in SETUP_PROFILES]
+        cases.append(("minimal + 8 binds", {"setup_profile": "minimal", "custom_mounts": binds}))
+        for label, kwargs in cases:
+            setup, teardown, operations = overhead(chroot_dir, iterations, **kwargs)
+            per_operation = (setup + teardown) / operations
+            print(f"{label:28} {setup:6.0f} µs {teardown:6.0f} µs {operations:4} {per_operation:5.1f} µs")
+
+        roots = 32
+        print(f"\nfleet of {roots} roots, profile full, {latency * 1000:g} ms per operation")
+        for max_concurrent in (1, 4, 16):
+            with ChrootFleet(max_concurrent=max_concurrent) as fleet:
+                for i in range(roots):
+                    root = os.path.join(chroot_dir, f"root{i}")
+                    os.makedirs(root, exist_ok=True)
+                    fleet.add(root, mount_manager=RecordingMountManager(latency=latency))
+                start = time.perf_counter()
+                fleet.setup()
+                fleet.teardown()
+                elapsed = time.perf_counter() - start
+                stats = fleet.stats()
+            print(
+                f"max_concurrent {max_concurrent:2}: {elapsed:6.2f} s total, "
+                f"setup p50 {stats.setup_p50 * 1000:5.1f} ms, queued {stats.queue_mean * 1000:6.1f} ms on average"
+            )
+
+
+if __name__ == "__main__":
+    main()
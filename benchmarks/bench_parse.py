@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the command string parse path of ChrootManager.execute().
+
+Compares the previous approach (twelve uncompiled regex searches followed by
+shlex.split) against the single-pass scanner, with and without the LRU cache.
+
+Usage: python benchmarks/bench_parse.py [iterations]
+"""
+
+import os
+import re
+import shlex
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chorut import _parse_command, _scan_command
+
+COMMANDS = [
+    "echo hello",
+    "ls -la /etc",
+    "echo 'hello world'",
+    "make -j8 CFLAGS=-O2 all",
+    "ls | wc -l",
+    "echo hello && echo world",
+    "cat /etc/os-release | grep -i 'pretty_name'",
+    r"find /usr -name '*.so' -exec ls -l {} \;",
+]
+
+LEGACY_PATTERNS = [
+    r"\|",
+    r"&&",
+    r"\|\|",
+    r"[;&]",
+    r"[<>]",
+    r"`[^`]*`",
+    r"\$\([^)]*\)",
+    r"\*",
+    r"\?",
+    r"~",
+    r"\$\w+",
+    r"\{[^}]*\}",
+]
+
+
+def legacy_parse(command: str) -> list[str]:
+    if not command.strip().startswith(("bash -c", "sh -c")) and any(
+        re.search(pattern, command) for pattern in LEGACY_PATTERNS
+    ):
+        return ["bash", "-c", command]
+    return shlex.split(command)
+
+
+def uncached_parse(command: str) -> tuple[str, ...]:
+    words, needs_shell = _scan_command(command)
+    return ("bash", "-c", command) if needs_shell else words
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    for name, parse in [
+        ("regex + shlex.split (previous)", legacy_parse),
+        ("single-pass scanner", uncached_parse),
+        ("single-pass scanner + LRU cache", _parse_command),
+    ]:
+        elapsed = timeit.timeit(lambda parse=parse: [parse(command) for command in COMMANDS], number=iterations)
+        per_call = elapsed / (iterations * len(COMMANDS)) * 1e6
+        print(f"{name:34} {per_call:8.3f} us/command")
+
+
+if __name__ == "__main__":
+    main()
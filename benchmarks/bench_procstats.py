@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the process sampler behind ChrootManager(process_sampling=...).
+
+Measures the cost of one sample of process trees of growing size, with and
+without the /proc scan that root mode adds, and the slowdown of a CPU-bound
+command sampled at the default interval. Runs on host processes, without root.
+
+Usage: python benchmarks/bench_procstats.py [samples]
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chorut.procstats import _MAX_LOAD, INTERVAL, Sampler
+
+BUSY = "end = __import__('time').process_time() + 1.0\nwhile __import__('time').process_time() < end: pass"
+
+
+def sample_cost(processes: int, samples: int, root: str | None) -> float:
+    """Return the mean time of one sample of a tree of processes, in ms."""
+    command = f"for i in $(seq {processes - 1}); do sleep 60 & done; wait"
+    with subprocess.Popen(["/bin/sh", "-c", command], start_new_session=True) as process:
+        sampler = Sampler(process.pid, root=root)
+        while len(sampler.report.processes) < processes:
+            sampler.sample()
+        times = []
+        for _ in range(samples):
+            start = time.perf_counter()
+            sampler.sample()
+            times.append(time.perf_counter() - start)
+        os.killpg(process.pid, 9)
+    return statistics.mean(times) * 1000
+
+
+def busy_time(interval: float | None) -> float:
+    start = time.perf_counter()
+    with subprocess.Popen([sys.executable, "-c", BUSY]) as process:
+        if interval is None:
+            process.wait()
+        else:
+            with Sampler(process.pid, interval):
+                process.wait()
+    return time.perf_counter() - start
+
+
+def main():
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    print(f"{'processes':>9} {'per sample':>11} {'+ /proc scan':>13} {'CPU at ' + str(INTERVAL) + ' s':>13}")
+    with tempfile.TemporaryDirectory() as root:
+        for processes in (1, 10, 100, 500):
+            cost = sample_cost(processes, samples, None)
+            # Root mode also scans /proc for processes that left the tree, every tenth sample
+            scanned = sample_cost(processes, samples, root)
+            # Trees that take longer than _MAX_LOAD of the interval are sampled less often
+            load = min(cost / (INTERVAL * 1000), _MAX_LOAD)
+            print(f"{processes:9} {cost:8.3f} ms {scanned:10.3f} ms {load * 100:11.2f} %")
+
+    plain = statistics.median(busy_time(None) for _ in range(5))
+    sampled = statistics.median(busy_time(INTERVAL) for _ in range(5))
+    print(f"\n1 s CPU-bound command: {plain:.3f} s, sampled {sampled:.3f} s ({(sampled / plain - 1) * 100:+.1f} %)")
+
+
+if __name__ == "__main__":
+    main()
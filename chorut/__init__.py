@@ -6,19 +6,45 @@ using only Python standard library modules.
 """
 
 import contextlib
+import functools
+import io
 import logging
 import os
-import subprocess
+import posixpath
+import re
+import stat
 import sys
+import threading
+from collections.abc import Callable, Iterable, Iterator
 from pathlib import Path
-from typing import Any
+from typing import IO, TYPE_CHECKING, Any, NoReturn
+
+if TYPE_CHECKING:
+    import subprocess
+
+    from .cache import ActionCache
+    from .cachemounts import CacheMount
+    from .clone import CloneResult
+    from .graph import GraphReport, Step
+    from .manifest import Manifest, ManifestDiff
+    from .prefetch import PrefetchResult, Profile
 
 __version__ = "0.1.0"
 
 logger = logging.getLogger(__name__)
 
-# Type alias for mount specifications
-MountSpec = dict[str, Any]
+# Size of the reads from in-memory files passed as stdin
+_STDIN_CHUNK = 1 << 16
+
+# Standard mounts that setup() can make, in mount order
+STANDARD_MOUNTS = ("proc", "sys", "efivarfs", "dev", "devpts", "shm", "run", "tmp", "resolv.conf")
+
+# Named sets of standard mounts, for ChrootManager(setup_profile=...)
+SETUP_PROFILES = {
+    "minimal": ("proc", "dev"),
+    "build": ("proc", "dev", "devpts", "shm", "tmp", "resolv.conf"),
+    "full": STANDARD_MOUNTS,
+}
 
 
 class ChrootError(Exception):
@@ -33,14 +59,428 @@ class MountError(Exception):
     pass
 
 
+class MountSpec:
+    """
+    A validated custom mount.
+
+    The target is normalised to a path relative to the chroot root, so
+    '/home', 'home/' and 'home' are the same mount. Mount specs are
+    immutable and compare equal when all of their fields are.
+    """
+
+    # A plain class rather than a dataclass, which would import inspect on every 'import chorut'
+    __slots__ = ("bind", "defer", "fstype", "idmap", "mkdir", "options", "source", "target")
+    _FIELDS = ("source", "target", "fstype", "options", "bind", "mkdir", "idmap", "defer")
+
+    def __init__(
+        self,
+        source: str,
+        target: str,
+        fstype: str | None = None,
+        options: str | None = None,
+        bind: bool = False,
+        mkdir: bool = True,
+        idmap: str | None = None,
+        defer: bool = False,
+    ):
+        if not source:
+            raise MountError("Mount specification missing required 'source' field")
+        normalised = posixpath.normpath("/" + str(target)).lstrip("/")
+        if not target or not normalised:
+            raise MountError(f"Invalid mount target {target!r}: must be a path below the chroot root")
+        values = (source, normalised, fstype, options, bind, mkdir, idmap, defer)
+        for name, value in zip(self._FIELDS, values, strict=True):
+            object.__setattr__(self, name, value)
+        if idmap is not None:
+            if not bind:
+                raise MountError(f"Mount at '{normalised}' has an idmap but is not a bind mount")
+            _parse_idmap(idmap)
+            self.idmap_attributes()
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"cannot assign to field '{name}' of an immutable MountSpec")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"cannot delete field '{name}' of an immutable MountSpec")
+
+    def __eq__(self, other: object) -> bool:
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self.astuple() == other.astuple()
+
+    def __hash__(self) -> int:
+        return hash(self.astuple())
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self._FIELDS)
+        return f"MountSpec({fields})"
+
+    def astuple(self) -> tuple:
+        """The fields in constructor order."""
+        return tuple(getattr(self, name) for name in self._FIELDS)
+
+    def idmap_attributes(self) -> int:
+        """mount_setattr(2) attributes for the options of an idmapped bind mount."""
+        supported = _syscalls().MOUNT_ATTR_OPTIONS
+        attributes = 0
+        for option in (self.options or "").split(","):
+            option = option.strip()
+            if option in supported:
+                attributes |= supported[option]
+            elif option not in ("", "bind", "rw"):
+                raise MountError(f"Option '{option}' is not supported on idmapped mounts")
+        return attributes
+
+    @classmethod
+    def parse(cls, spec: "MountSpec | dict[str, Any]") -> "MountSpec":
+        """Build a MountSpec from a mount specification dict (or return it unchanged)."""
+        if isinstance(spec, MountSpec):
+            return spec
+        if "source" not in spec:
+            raise MountError("Mount specification missing required 'source' field")
+        if "target" not in spec:
+            raise MountError("Mount specification missing required 'target' field")
+        unknown = set(spec) - set(cls.__slots__)
+        if unknown:
+            raise MountError(f"Unknown mount specification fields: {', '.join(sorted(unknown))}")
+        return cls(**spec)
+
+    @property
+    def depth(self) -> int:
+        """Number of path components in the target."""
+        return self.target.count("/") + 1
+
+    def is_below(self, other: "MountSpec") -> bool:
+        """Whether this mount's target is inside the target of other."""
+        return self.target.startswith(other.target + "/")
+
+    def mount_args(self) -> list[str]:
+        """Arguments for mount(8) before source and target."""
+        args = []
+        if self.bind:
+            args.append("--bind")
+        elif self.fstype:
+            args.extend(["-t", self.fstype])
+        if self.options:
+            args.extend(["-o", self.options])
+        return args
+
+
+def _syscalls():
+    """The ctypes based _linux module, imported on first use so that 'import chorut' does not load ctypes."""
+    from . import _linux
+
+    return _linux
+
+
+def _parse_idmap(idmap: str) -> tuple[list[tuple[int, int, int]], list[tuple[int, int, int]]]:
+    """
+    Parse the idmap of a mount into uid and gid ranges of (host id, chroot id, count).
+
+    An idmap is a space separated list of [u|g|b:]HOST:CHROOT[:COUNT] ranges:
+    files owned by HOST on disk appear owned by CHROOT inside the chroot.
+    Ranges without a type (or with 'b') apply to both users and groups.
+    """
+    uids: list[tuple[int, int, int]] = []
+    gids: list[tuple[int, int, int]] = []
+    for item in idmap.split():
+        kind, fields = "b", item.split(":")
+        if fields[0] in ("u", "g", "b"):
+            kind = fields.pop(0)
+        if len(fields) == 2:
+            fields.append("1")
+        if len(fields) != 3 or not all(field.isdigit() for field in fields) or int(fields[2]) < 1:
+            raise MountError(f"Invalid idmap range '{item}': expected [u|g|b:]HOST:CHROOT[:COUNT]")
+        host, chroot, count = map(int, fields)
+        if kind in ("u", "b"):
+            uids.append((host, chroot, count))
+        if kind in ("g", "b"):
+            gids.append((host, chroot, count))
+    if not uids and not gids:
+        raise MountError(f"Invalid idmap {idmap!r}: no ranges")
+    return uids, gids
+
+
+def _map_ranges(ranges: list[tuple[int, int, int]], id_map: list[tuple[int, int, int]]) -> list[tuple[int, int, int]]:
+    """Translate the chroot ids of idmap ranges through a user namespace id map to ids outside of it."""
+    mapped = []
+    for host, chroot, count in ranges:
+        covered = 0
+        for inside, outside, length in id_map:
+            low, high = max(chroot, inside), min(chroot + count, inside + length)
+            if low < high:
+                mapped.append((host + low - chroot, outside + low - inside, high - low))
+                covered += high - low
+        if covered != count:
+            raise MountError(f"Ids {chroot}-{chroot + count - 1} are not mapped in the unshare mode user namespace")
+    return mapped
+
+
+@functools.cache
+def _unshare_id_maps() -> tuple[list[tuple[int, int, int]], list[tuple[int, int, int]]]:
+    """Return the uid and gid maps that unshare mode sets up, read from a throwaway namespace."""
+    import subprocess
+
+    script = "cat /proc/self/uid_map; echo; cat /proc/self/gid_map"
+    try:
+        result = subprocess.run(
+            ["unshare", "--user", "--map-root-user", "--map-auto", "/bin/sh", "-c", script],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise MountError(f"Cannot read the unshare mode id maps: {getattr(e, 'stderr', None) or e}") from None
+    uid_map, _, gid_map = result.stdout.partition("\n\n")
+    return (
+        [tuple(map(int, line.split())) for line in uid_map.splitlines()],
+        [tuple(map(int, line.split())) for line in gid_map.splitlines()],
+    )
+
+
+def compile_mounts(specs: Iterable[MountSpec | dict[str, Any]]) -> tuple[tuple[MountSpec, ...], ...]:
+    """
+    Validate custom mounts and order them into waves.
+
+    Every mount comes after all mounts whose targets contain its target.
+    Mounts in the same wave never contain each other, so they can be
+    performed concurrently. Exact duplicates are dropped; two different
+    mounts on the same target raise MountError.
+    """
+    by_target: dict[str, MountSpec] = {}
+    for spec in specs:
+        mount_spec = MountSpec.parse(spec)
+        existing = by_target.get(mount_spec.target)
+        if existing is not None and existing != mount_spec:
+            raise MountError(f"Conflicting mounts for target '{mount_spec.target}': {existing} and {mount_spec}")
+        by_target[mount_spec.target] = mount_spec
+
+    waves: list[list[MountSpec]] = []
+    level: dict[str, int] = {}
+    for mount_spec in sorted(by_target.values(), key=lambda m: m.depth):
+        parents = [level[other.target] for other in by_target.values() if mount_spec.is_below(other)]
+        wave = max(parents, default=-1) + 1
+        level[mount_spec.target] = wave
+        if wave == len(waves):
+            waves.append([])
+        waves[wave].append(mount_spec)
+
+    return tuple(tuple(wave) for wave in waves)
+
+
+def _standard_mounts(profile: str, overrides: dict[str, bool] | None) -> tuple[str, ...]:
+    """Return the standard mounts of a setup profile, with mounts enabled or disabled by overrides."""
+    if profile not in SETUP_PROFILES:
+        raise ChrootError(f"Unknown setup profile: {profile} (expected one of {', '.join(SETUP_PROFILES)})")
+    enabled = set(SETUP_PROFILES[profile])
+    for name, enable in (overrides or {}).items():
+        if name not in STANDARD_MOUNTS:
+            raise ChrootError(f"Unknown standard mount: {name} (expected one of {', '.join(STANDARD_MOUNTS)})")
+        if enable:
+            enabled.add(name)
+        else:
+            enabled.discard(name)
+    return tuple(name for name in STANDARD_MOUNTS if name in enabled)
+
+
+# Commands made only of these characters can be split on whitespace without further parsing
+_SIMPLE_COMMAND = re.compile(r"[^\s'\"\\|&;<>()`$*?~#{}\[\]=]*(?:[ \t]+[^\s'\"\\|&;<>()`$*?~#{}\[\]=]*)*")
+
+
+def _stdin_source(stdin: Any) -> tuple[Any, Iterator[bytes | str] | None]:
+    """Split an execute() stdin into the Popen stdin argument and, for data to write, its chunks."""
+    import subprocess
+
+    if stdin is None or isinstance(stdin, int):
+        return stdin, None
+    if isinstance(stdin, bytes | bytearray | memoryview | str):
+        return subprocess.PIPE, iter((stdin,))
+    if hasattr(stdin, "read"):
+        try:
+            stdin.fileno()
+        except (OSError, ValueError, AttributeError):
+            # In-memory files (BytesIO, ...) are read in chunks
+            return subprocess.PIPE, iter(functools.partial(stdin.read, _STDIN_CHUNK), stdin.read(0))
+        return stdin, None
+    if isinstance(stdin, Iterable):
+        return subprocess.PIPE, iter(stdin)
+    raise TypeError(f"Unsupported stdin for execute(): {type(stdin).__name__}")
+
+
+def _pump_stdin(
+    process: "subprocess.Popen", writer: IO, chunks: Iterator[bytes | str], errors: list[BaseException]
+) -> None:
+    """Write chunks to a command's stdin, then close it. Killing the command if the chunks fail to come."""
+    raw = writer.buffer if isinstance(writer, io.TextIOWrapper) else writer
+    try:
+        for chunk in chunks:
+            raw.write(chunk.encode() if isinstance(chunk, str) else chunk)
+    except BrokenPipeError:
+        # The command exited or closed its stdin; the rest of the input is not wanted
+        pass
+    except BaseException as e:
+        errors.append(e)
+        process.kill()
+    finally:
+        with contextlib.suppress(OSError):
+            raw.close()
+
+
+def _shell_quote(value: str) -> str:
+    """Quote a string for safe use as a single word in a shell script."""
+    if value and re.fullmatch(r"[\w@%+=:,./-]+", value):
+        return value
+    return "'" + value.replace("'", "'\"'\"'") + "'"
+
+
+def _scan_command(command: str) -> tuple[tuple[str, ...], bool]:
+    """
+    Split a command string into words and detect shell features in one pass.
+
+    Words are split exactly like shlex.split(). Shell features are only
+    reported when they appear outside of quotes (or, for $ and backticks,
+    inside double quotes): pipes, logical operators, separators, redirects,
+    subshells, command substitution, variable expansion, globs, brace
+    expansion, leading ~, comments and leading VAR=value assignments.
+
+    Returns:
+        The words and whether the command needs a shell to run as intended
+    """
+    if _SIMPLE_COMMAND.fullmatch(command):
+        return tuple(command.split()), False
+
+    words: list[str] = []
+    word: list[str] = []
+    in_word = False
+    needs_shell = False
+    brace = brace_list = bracket = False
+    i, n = 0, len(command)
+
+    while i < n:
+        char = command[i]
+
+        if char in " \t\r\n":
+            if char == "\n":
+                needs_shell = True
+            if in_word:
+                words.append("".join(word))
+                word = []
+                in_word = False
+                brace = brace_list = bracket = False
+            i += 1
+            continue
+
+        word_start = not in_word
+        in_word = True
+
+        if char == "'":
+            end = command.find("'", i + 1)
+            if end < 0:
+                raise ValueError("No closing quotation")
+            word.append(command[i + 1 : end])
+            i = end + 1
+        elif char == '"':
+            i += 1
+            while True:
+                if i >= n:
+                    raise ValueError("No closing quotation")
+                char = command[i]
+                if char == '"':
+                    i += 1
+                    break
+                if char == "\\" and i + 1 < n and command[i + 1] in '"\\':
+                    word.append(command[i + 1])
+                    i += 2
+                    continue
+                if char in "$`":
+                    needs_shell = True
+                word.append(char)
+                i += 1
+        elif char == "\\":
+            if i + 1 >= n:
+                raise ValueError("No escaped character")
+            word.append(command[i + 1])
+            i += 2
+        else:
+            if (
+                char in "|&;<>()`$*?"
+                or (char in "~#" and word_start)
+                or (char == "=" and not words and "".join(word).isidentifier())
+            ):
+                needs_shell = True
+            elif char == "{":
+                brace, brace_list = True, False
+            elif brace and (char == "," or (char == "." and command.startswith("..", i))):
+                brace_list = True
+            elif char == "}" and brace_list:
+                needs_shell = True
+            elif char == "[":
+                bracket = True
+            elif char == "]" and bracket:
+                needs_shell = True
+            word.append(char)
+            i += 1
+
+    if in_word:
+        words.append("".join(word))
+
+    return tuple(words), needs_shell
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_command(command: str, auto_shell: bool = True) -> tuple[str, ...]:
+    """
+    Turn a command string into an argv, wrapping it with 'bash -c' if it needs a shell.
+
+    Results are cached, since the same command strings tend to be executed
+    over and over.
+    """
+    words, needs_shell = _scan_command(command)
+    if auto_shell and needs_shell and not command.strip().startswith(("bash -c", "sh -c")):
+        return ("bash", "-c", command)
+    return words
+
+
 class MountManager:
-    """Manages filesystem mounts for chroot environments."""
+    """
+    Manages filesystem mounts for chroot environments.
+
+    Every change to the system goes through _spawn(), _symlink(), _touch(),
+    _unlink() and _bind_idmapped(), so a subclass can stand in for the real
+    operations (see chorut.recording).
+    """
+
+    # Whether the operations need root; root mode ChrootManagers check it before setup
+    requires_root = True
 
     def __init__(self):
         self.active_mounts: list[str] = []
         self.active_lazy: list[str] = []
         self.active_files: list[str] = []
 
+    def _spawn(self, cmd: list[str]) -> tuple[int, str]:
+        """Run a helper command and return its exit code and error output."""
+        import subprocess
+
+        result = subprocess.run(cmd, check=False, capture_output=True, text=True)
+        return result.returncode, result.stderr
+
+    def _symlink(self, source: str, target: str) -> None:
+        os.symlink(source, target)
+
+    def _touch(self, path: str) -> None:
+        Path(path).touch()
+
+    def _unlink(self, path: str) -> None:
+        os.unlink(path)
+
+    def _bind_idmapped(self, source: str, target: str, uid_map: str, gid_map: str, attributes: int) -> None:
+        userns_fd = _syscalls().user_namespace(uid_map, gid_map)
+        try:
+            _syscalls().bind_idmapped(source, target, userns_fd, attributes)
+        finally:
+            os.close(userns_fd)
+
     def mount(
         self, source: str, target: str, fstype: str | None = None, options: str | None = None, bind: bool = False
     ) -> None:
@@ -57,12 +497,11 @@ class MountManager:
 
         cmd.extend([source, target])
 
-        try:
-            subprocess.run(cmd, check=True, capture_output=True, text=True)
-            self.active_mounts.insert(0, target)  # Insert at beginning for reverse order unmount
-            logger.debug(f"Mounted {source} at {target}")
-        except subprocess.CalledProcessError as e:
-            raise MountError(f"Failed to mount {source} at {target}: {e.stderr}") from None
+        returncode, stderr = self._spawn(cmd)
+        if returncode != 0:
+            raise MountError(f"Failed to mount {source} at {target}: {stderr}")
+        self.active_mounts.insert(0, target)  # Insert at beginning for reverse order unmount
+        logger.debug(f"Mounted {source} at {target}")
 
     def mount_lazy(self, source: str, target: str, bind: bool = False) -> None:
         """Mount with lazy unmount tracking."""
@@ -75,41 +514,67 @@ class MountManager:
     def bind_device(self, source: str, target: str) -> None:
         """Bind mount a device file."""
         # Create the target file
-        Path(target).touch()
+        self._touch(target)
         self.active_files.insert(0, target)
         self.mount(source, target, bind=True)
 
+    def bind_idmapped(
+        self,
+        source: str,
+        target: str,
+        uids: list[tuple[int, int, int]],
+        gids: list[tuple[int, int, int]],
+        attributes: int = 0,
+    ) -> None:
+        """Bind mount source at target, mapping owners by (on-disk id, shown id, count) ranges."""
+        uid_map = "".join(f"{disk} {shown} {count}\n" for disk, shown, count in uids)
+        gid_map = "".join(f"{disk} {shown} {count}\n" for disk, shown, count in gids)
+        try:
+            self._bind_idmapped(source, target, uid_map, gid_map, attributes)
+        except OSError as e:
+            raise MountError(f"Failed to create idmapped mount of {source} at {target}: {e}") from None
+        self.active_mounts.insert(0, target)
+        logger.debug(f"Mounted {source} at {target} with idmap")
+
     def create_symlink(self, source: str, target: str) -> None:
         """Create a symbolic link and track it for cleanup."""
         try:
-            os.symlink(source, target)
+            self._symlink(source, target)
             self.active_files.insert(0, target)
             logger.debug(f"Created symlink {target} -> {source}")
         except OSError as e:
             raise MountError(f"Failed to create symlink {target} -> {source}: {e}") from None
 
+    def is_mountpoint(self, path: str) -> bool | None:
+        """Whether path is a mount point, or None if mountpoint(1) is not available."""
+        try:
+            returncode, _ = self._spawn(["mountpoint", "-q", path])
+        except FileNotFoundError:
+            return None
+        return returncode == 0
+
     def unmount_all(self) -> None:
         """Unmount all tracked mounts."""
         # Unmount regular mounts
         for mount_point in self.active_mounts:
-            try:
-                subprocess.run(["umount", mount_point], check=True, capture_output=True)
+            returncode, stderr = self._spawn(["umount", mount_point])
+            if returncode == 0:
                 logger.debug(f"Unmounted {mount_point}")
-            except subprocess.CalledProcessError as e:
-                logger.warning(f"Failed to unmount {mount_point}: {e.stderr}")
+            else:
+                logger.warning(f"Failed to unmount {mount_point}: {stderr}")
 
         # Lazy unmount
         for mount_point in self.active_lazy:
-            try:
-                subprocess.run(["umount", "--lazy", mount_point], check=True, capture_output=True)
+            returncode, stderr = self._spawn(["umount", "--lazy", mount_point])
+            if returncode == 0:
                 logger.debug(f"Lazy unmounted {mount_point}")
-            except subprocess.CalledProcessError as e:
-                logger.warning(f"Failed to lazy unmount {mount_point}: {e.stderr}")
+            else:
+                logger.warning(f"Failed to lazy unmount {mount_point}: {stderr}")
 
         # Remove created files/symlinks
         for file_path in self.active_files:
             try:
-                os.unlink(file_path)
+                self._unlink(file_path)
                 logger.debug(f"Removed {file_path}")
             except OSError as e:
                 logger.warning(f"Failed to remove {file_path}: {e}")
@@ -133,8 +598,18 @@ class ChrootManager:
         self,
         chroot_dir: str | Path,
         unshare_mode: bool = False,
-        custom_mounts: list[MountSpec] | None = None,
+        custom_mounts: list[MountSpec | dict[str, Any]] | None = None,
         auto_shell: bool = True,
+        action_cache: "ActionCache | None" = None,
+        image: str | Path | None = None,
+        image_overlay: bool | str | Path = False,
+        cache_mounts: dict[str, "str | dict[str, Any] | CacheMount"] | None = None,
+        cache_store: str | Path | None = None,
+        prefetch_profile: str | Path | None = None,
+        setup_profile: str = "full",
+        standard_mounts: dict[str, bool] | None = None,
+        mount_manager: MountManager | None = None,
+        process_sampling: float | None = None,
     ):
         """
         Initialize the chroot manager.
@@ -142,27 +617,100 @@ class ChrootManager:
         Args:
             chroot_dir: Path to the chroot directory
             unshare_mode: Whether to use unshare mode (for non-root users)
-            custom_mounts: Optional list of custom mount specifications
-                Each mount spec is a dict with keys:
+            custom_mounts: Optional list of custom mount specifications, validated and
+                ordered once here (raises MountError if invalid).
+                Each mount spec is a MountSpec or a dict with keys:
                 - source: Source path/device (required)
                 - target: Target path relative to chroot (required)
                 - fstype: Filesystem type (optional, defaults to auto-detect)
                 - options: Mount options (optional)
                 - bind: Whether this is a bind mount (optional, defaults to False)
                 - mkdir: Whether to create target directory (optional, defaults to True)
+                - idmap: Remap file ownership of a bind mount in constant time instead of chown -R,
+                  as space separated [u|g|b:]HOST:CHROOT[:COUNT] ranges, e.g. "1000:1001" shows files
+                  owned by host uid and gid 1000 as owned by 1001 inside the chroot. Ids outside the
+                  ranges show up as nobody. Only ro, nosuid, nodev and noexec options are allowed.
+                  Requires root; in unshare mode CHROOT ids are translated through the namespace's
+                  uid_map and gid_map, and the mount is made on the host side during setup().
+                - defer: Skip the mount in setup(), and make it for the first command that declares it
+                  in execute(mounts=...) (optional, defaults to False). Mounts below it are deferred too.
             auto_shell: Whether to automatically detect shell features in string commands
                 and wrap them with 'bash -c' (default: True)
+            action_cache: Optional chorut.cache.ActionCache used by execute() calls that declare inputs
+            image: Optional squashfs or erofs image to use as the root. setup() attaches it to a loop
+                device with direct I/O and mounts it read-only at chroot_dir (created if missing);
+                teardown() unmounts it and releases the loop device. Requires root.
+            image_overlay: Put a writable overlay on top of the image: True for a tmpfs upper layer
+                that is discarded on teardown, or a directory to keep the changes in
+            cache_mounts: Optional named caches that persist across chroots, mapping a name to
+                its target inside the chroot, e.g. {"pip": "/root/.cache/pip"}, or to a dict with:
+                - target: Target path inside the chroot (required)
+                - lock: 'shared' (default) or 'exclusive', held from setup() to teardown()
+                - max_size: Size in bytes above which least recently used files are pruned
+                  on teardown, when no other chroot holds the cache
+            cache_store: Host directory holding the caches (default: $XDG_CACHE_HOME/chorut/cache-mounts)
+            prefetch_profile: Optional file in which execute() records the files below the root that
+                commands use. setup() reads them into the page cache in the background, so cold
+                starts overlap disk reads with mounting. teardown() saves the updated profile.
+            setup_profile: The standard mounts setup() makes: 'full' (default) for all of them,
+                'build' for proc, dev, devpts, shm, tmp and resolv.conf, or 'minimal' for
+                only proc and dev. See SETUP_PROFILES.
+            standard_mounts: Standard mounts to enable (True) or disable (False) on top of the
+                profile, e.g. {"tmp": True} or {"sys": False}. See STANDARD_MOUNTS.
+            mount_manager: The MountManager that performs and tracks the mounts of root mode, e.g. a
+                chorut.recording.RecordingMountManager to run setup() and teardown() without root
+            process_sampling: Seconds between samples of the CPU time, memory and I/O of the processes
+                each execute() call starts (default: off). The result then has a processes attribute
+                with a chorut.procstats.ProcessReport of every process and its counters over time.
         """
         self.chroot_dir = Path(chroot_dir).resolve()
         self.unshare_mode = unshare_mode
         self.custom_mounts = custom_mounts or []
+        self.cache_mounts: list[CacheMount] = []
+        self._cache_locks: list[tuple[CacheMount, int]] = []
+        cache_specs = []
+        if cache_mounts:
+            from . import cachemounts
+
+            self.cache_store = cachemounts.CacheStore(cache_store)
+            self.cache_mounts = [cachemounts.CacheMount.parse(name, spec) for name, spec in cache_mounts.items()]
+            cache_specs = [self.cache_store.mount_spec(cache) for cache in self.cache_mounts]
+        self.mount_plan = compile_mounts([*self.custom_mounts, *cache_specs])
+        self.standard_mounts = _standard_mounts(setup_profile, standard_mounts)
+        # Deferred mounts, and the mounts below them, by target
+        self._deferred: dict[str, MountSpec] = {}
+        for wave in self.mount_plan:
+            for mount_spec in wave:
+                if mount_spec.defer or any(mount_spec.is_below(other) for other in self._deferred.values()):
+                    self._deferred[mount_spec.target] = mount_spec
+        self._deferred_mounted: set[str] = set()
+        self._deferred_lock = threading.Lock()
+        if unshare_mode:
+            self._check_unshare_idmaps()
+        self._mount_script_lines: dict[tuple[bool, frozenset[str]], list[str]] = {}
         self.auto_shell = auto_shell
-        self.mount_manager = MountManager()
+        self.action_cache = action_cache
+        self.mount_manager = mount_manager if mount_manager is not None else MountManager()
         self._is_setup = False
+        self._root_fd: int | None = None
+        self._manifest: Manifest | None = None
+        self.image = Path(image).resolve() if image is not None else None
+        self.image_overlay = image_overlay
+        self._loop_device: str | None = None
+        self._image_dirs: list[str] = []
+        self.profile: Profile | None = None
+        if prefetch_profile is not None:
+            from . import prefetch
+
+            self.profile = prefetch.Profile.load(prefetch_profile)
+        self._prefetch_thread: threading.Thread | None = None
+        if process_sampling is not None and process_sampling <= 0:
+            raise ChrootError("process_sampling must be positive")
+        self.process_sampling = process_sampling
 
     def _check_root(self) -> None:
         """Check if running as root (required for normal mode)."""
-        if not self.unshare_mode and os.getuid() != 0:
+        if not self.unshare_mode and os.getuid() != 0 and self.mount_manager.requires_root:
             raise ChrootError("This operation requires root privileges. Use unshare_mode=True for non-root operation.")
 
     def _check_chroot_dir(self) -> None:
@@ -170,53 +718,139 @@ class ChrootManager:
         if not self.chroot_dir.is_dir():
             raise ChrootError(f"Chroot directory does not exist: {self.chroot_dir}")
 
+    def _check_unshare_idmaps(self) -> None:
+        """Reject idmapped mounts that the unshare mode namespace would cover with its own mounts."""
+        mounts = [mount_spec for wave in self.mount_plan for mount_spec in wave]
+        covered = {"proc", "sys", "dev", "run", "tmp"}
+        covered.update(mount_spec.target for mount_spec in mounts if not mount_spec.idmap)
+        for mount_spec in mounts:
+            if mount_spec.idmap and any(
+                mount_spec.target == target or mount_spec.target.startswith(f"{target}/") for target in covered
+            ):
+                raise MountError(
+                    f"Idmapped mount at '{mount_spec.target}' would be hidden by a mount made inside the namespace"
+                )
+
+    def _release_caches(self) -> None:
+        """Release the cache locks taken by setup(), pruning caches that have a size limit."""
+        while self._cache_locks:
+            cache, lock_fd = self._cache_locks.pop()
+            try:
+                self.cache_store.release(cache, lock_fd)
+            except OSError as e:
+                logger.warning(f"Failed to release cache '{cache.name}': {e}")
+
+    @staticmethod
+    def _image_fstype(path: Path) -> str | None:
+        """Detect squashfs and erofs images by their superblock magic; None lets mount(8) probe."""
+        with open(path, "rb") as f:
+            if f.read(4) == b"hsqs":
+                return "squashfs"
+            f.seek(1024)
+            if f.read(4) == b"\xe2\xe1\xf5\xe0":
+                return "erofs"
+        return None
+
+    def _setup_image(self) -> None:
+        """Attach the root image to a loop device and mount it (under an overlay if requested) at chroot_dir."""
+        import tempfile
+
+        if os.geteuid() != 0 and self.mount_manager.requires_root:
+            raise ChrootError("Mounting a root image requires root privileges")
+
+        fstype = self._image_fstype(self.image)
+        self.chroot_dir.mkdir(parents=True, exist_ok=True)
+        if self.image_overlay:
+            # The image and the tmpfs holding upper and work go to private directories next to the root
+            lower = tempfile.mkdtemp(prefix=f".{self.chroot_dir.name}.image-", dir=self.chroot_dir.parent)
+            self._image_dirs.append(lower)
+        else:
+            lower = str(self.chroot_dir)
+
+        device, device_fd = _syscalls().loop_attach(str(self.image), read_only=True, direct_io=True)
+        self._loop_device = device
+        try:
+            self.mount_manager.mount(device, lower, fstype=fstype, options="ro")
+        finally:
+            # Mounted (or failed): either way the descriptor no longer needs to hold the device
+            os.close(device_fd)
+        logger.debug(f"Mounted {self.image} ({fstype or 'auto'}) from {device} at {lower}")
+
+        if not self.image_overlay:
+            return
+
+        if self.image_overlay is True:
+            state = tempfile.mkdtemp(prefix=f".{self.chroot_dir.name}.state-", dir=self.chroot_dir.parent)
+            self._image_dirs.append(state)
+            self.mount_manager.mount("tmpfs", state, fstype="tmpfs", options="mode=0755")
+        else:
+            state = str(Path(self.image_overlay).resolve())
+        upper = os.path.join(state, "upper")
+        work = os.path.join(state, "work")
+        os.makedirs(upper, exist_ok=True)
+        os.makedirs(work, exist_ok=True)
+        self.mount_manager.mount(
+            "overlay",
+            str(self.chroot_dir),
+            fstype="overlay",
+            options=f"lowerdir={lower},upperdir={upper},workdir={work}",
+        )
+
     def _setup_standard_mounts(self) -> None:
-        """Set up standard filesystem mounts for chroot."""
+        """Set up the standard filesystem mounts enabled for the chroot."""
+        enabled = self.standard_mounts
         proc_dir = self.chroot_dir / "proc"
         sys_dir = self.chroot_dir / "sys"
         dev_dir = self.chroot_dir / "dev"
 
-        # Create directories if they don't exist
-        proc_dir.mkdir(exist_ok=True)
-        sys_dir.mkdir(exist_ok=True)
-        dev_dir.mkdir(exist_ok=True)
-
         # Mount proc
-        self.mount_manager.mount("proc", str(proc_dir), fstype="proc", options="nosuid,noexec,nodev")
+        if "proc" in enabled:
+            proc_dir.mkdir(exist_ok=True)
+            self.mount_manager.mount("proc", str(proc_dir), fstype="proc", options="nosuid,noexec,nodev")
 
         # Mount sys
-        self.mount_manager.mount("sys", str(sys_dir), fstype="sysfs", options="nosuid,noexec,nodev,ro")
+        if "sys" in enabled:
+            sys_dir.mkdir(exist_ok=True)
+            self.mount_manager.mount("sys", str(sys_dir), fstype="sysfs", options="nosuid,noexec,nodev,ro")
 
         # Mount efivarfs if available
         efivarfs_dir = sys_dir / "firmware/efi/efivars"
-        if efivarfs_dir.exists():
+        if "efivarfs" in enabled and efivarfs_dir.exists():
             with contextlib.suppress(MountError):
                 self.mount_manager.mount(
                     "efivarfs", str(efivarfs_dir), fstype="efivarfs", options="nosuid,noexec,nodev"
                 )
 
         # Mount dev
-        self.mount_manager.mount("udev", str(dev_dir), fstype="devtmpfs", options="mode=0755,nosuid")
+        if "dev" in enabled:
+            dev_dir.mkdir(exist_ok=True)
+            self.mount_manager.mount("udev", str(dev_dir), fstype="devtmpfs", options="mode=0755,nosuid")
 
         # Mount devpts
-        devpts_dir = dev_dir / "pts"
-        devpts_dir.mkdir(exist_ok=True)
-        self.mount_manager.mount("devpts", str(devpts_dir), fstype="devpts", options="mode=0620,gid=5,nosuid,noexec")
+        if "devpts" in enabled:
+            devpts_dir = dev_dir / "pts"
+            devpts_dir.mkdir(parents=True, exist_ok=True)
+            self.mount_manager.mount(
+                "devpts", str(devpts_dir), fstype="devpts", options="mode=0620,gid=5,nosuid,noexec"
+            )
 
         # Mount shm
-        shm_dir = dev_dir / "shm"
-        shm_dir.mkdir(exist_ok=True)
-        self.mount_manager.mount("shm", str(shm_dir), fstype="tmpfs", options="mode=1777,nosuid,nodev")
+        if "shm" in enabled:
+            shm_dir = dev_dir / "shm"
+            shm_dir.mkdir(parents=True, exist_ok=True)
+            self.mount_manager.mount("shm", str(shm_dir), fstype="tmpfs", options="mode=1777,nosuid,nodev")
 
         # Mount run
-        run_dir = self.chroot_dir / "run"
-        run_dir.mkdir(exist_ok=True)
-        self.mount_manager.mount("run", str(run_dir), fstype="tmpfs", options="nosuid,nodev,mode=0755")
+        if "run" in enabled:
+            run_dir = self.chroot_dir / "run"
+            run_dir.mkdir(exist_ok=True)
+            self.mount_manager.mount("run", str(run_dir), fstype="tmpfs", options="nosuid,nodev,mode=0755")
 
         # Mount tmp
-        tmp_dir = self.chroot_dir / "tmp"
-        tmp_dir.mkdir(exist_ok=True)
-        self.mount_manager.mount("tmp", str(tmp_dir), fstype="tmpfs", options="mode=1777,strictatime,nodev,nosuid")
+        if "tmp" in enabled:
+            tmp_dir = self.chroot_dir / "tmp"
+            tmp_dir.mkdir(exist_ok=True)
+            self.mount_manager.mount("tmp", str(tmp_dir), fstype="tmpfs", options="mode=1777,strictatime,nodev,nosuid")
 
     def _setup_unshare_mounts(self) -> None:
         """Set up mounts for unshare mode."""
@@ -277,66 +911,93 @@ class ChrootManager:
         Detect if a command string contains shell metacharacters that require bash -c wrapping.
 
         Returns True if the command contains shell features like pipes, redirects,
-        command substitution, logical operators, etc.
-        """
-        import re
-
-        # Shell metacharacters that require shell interpretation
-        shell_patterns = [
-            r"\|",  # Pipes: cmd1 | cmd2
-            r"&&",  # Logical AND: cmd1 && cmd2
-            r"\|\|",  # Logical OR: cmd1 || cmd2
-            r"[;&]",  # Command separators: cmd1; cmd2 or cmd1 & cmd2
-            r"[<>]",  # Redirects: cmd > file, cmd < file
-            r"`[^`]*`",  # Command substitution: `cmd`
-            r"\$\([^)]*\)",  # Command substitution: $(cmd)
-            r"\*",  # Glob patterns: *.txt
-            r"\?",  # Glob patterns: file?.txt
-            r"~",  # Home directory expansion
-            r"\$\w+",  # Variable expansion: $VAR
-            r"\{[^}]*\}",  # Brace expansion: {a,b,c}
-        ]
-
+        command substitution, logical operators, etc. outside of quotes.
+        """
         # Skip detection if already wrapped with bash -c
         if command_str.strip().startswith(("bash -c", "sh -c")):
             return False
 
-        # Check for any shell metacharacters outside of quotes
-        # This is a simplified approach - a more robust version would need
-        # proper quote-aware parsing
-        return any(re.search(pattern, command_str) for pattern in shell_patterns)
+        return _scan_command(command_str)[1]
+
+    def _mount_custom(self, mount_spec: MountSpec) -> None:
+        """Perform a single custom mount."""
+        target = str(self.chroot_dir / mount_spec.target)
+        try:
+            if mount_spec.mkdir:
+                Path(target).mkdir(parents=True, exist_ok=True)
+
+            if mount_spec.idmap:
+                uids, gids = _parse_idmap(mount_spec.idmap)
+                if self.unshare_mode:
+                    # The chroot sees namespace ids; the mount has to map to the ids outside of it
+                    ns_uids, ns_gids = _unshare_id_maps()
+                    uids, gids = _map_ranges(uids, ns_uids), _map_ranges(gids, ns_gids)
+                self.mount_manager.bind_idmapped(mount_spec.source, target, uids, gids, mount_spec.idmap_attributes())
+            else:
+                self.mount_manager.mount(
+                    mount_spec.source,
+                    target,
+                    fstype=mount_spec.fstype,
+                    options=mount_spec.options,
+                    bind=mount_spec.bind,
+                )
+            logger.debug(f"Custom mount: {mount_spec.source} -> {target}")
+        except Exception as e:
+            logger.error(f"Failed to setup custom mount {mount_spec}: {e}")
+            raise MountError(f"Failed to setup custom mount: {e}") from None
 
     def _setup_custom_mounts(self) -> None:
-        """Set up user-defined custom mounts."""
-        for mount_spec in self.custom_mounts:
-            try:
-                # Validate required fields
-                if "source" not in mount_spec:
-                    raise MountError("Mount specification missing required 'source' field")
-                if "target" not in mount_spec:
-                    raise MountError("Mount specification missing required 'target' field")
-
-                source = mount_spec["source"]
-                target_rel = mount_spec["target"].lstrip("/")  # Remove leading slash for relative path
-                target = str(self.chroot_dir / target_rel)
-
-                # Get optional parameters
-                fstype = mount_spec.get("fstype")
-                options = mount_spec.get("options")
-                bind = mount_spec.get("bind", False)
-                mkdir = mount_spec.get("mkdir", True)
-
-                # Create target directory if requested
-                if mkdir:
-                    Path(target).mkdir(parents=True, exist_ok=True)
-
-                # Perform the mount
-                self.mount_manager.mount(source, target, fstype=fstype, options=options, bind=bind)
-                logger.debug(f"Custom mount: {source} -> {target}")
+        """Set up user-defined custom mounts, running independent mounts of each wave concurrently."""
+        for wave in self.mount_plan:
+            wave = [mount_spec for mount_spec in wave if mount_spec.target not in self._deferred]
+            if not wave:
+                continue
+            if len(wave) == 1:
+                self._mount_custom(wave[0])
+                continue
+
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=min(len(wave), 8)) as pool:
+                futures = [pool.submit(self._mount_custom, mount_spec) for mount_spec in wave]
+            # Wait for the whole wave first so every successful mount is tracked for teardown
+            for future in futures:
+                future.result()
+
+    def _deferred_targets(self, mounts: Iterable[str | Path]) -> frozenset[str]:
+        """
+        Return the targets of the deferred mounts that commands declaring mounts need.
 
-            except Exception as e:
-                logger.error(f"Failed to setup custom mount {mount_spec}: {e}")
-                raise MountError(f"Failed to setup custom mount: {e}") from None
+        A declared mount brings the deferred mounts it is below (so it has somewhere
+        to go) and the ones below it along.
+
+        Raises:
+            MountError: If a declared path is not the target of a custom mount
+        """
+        targets = {mount_spec.target for wave in self.mount_plan for mount_spec in wave}
+        needed = set()
+        for path in mounts:
+            target = posixpath.normpath("/" + os.fspath(path)).lstrip("/")
+            if target not in targets:
+                raise MountError(f"No custom mount at '{path}'")
+            needed.update(
+                other
+                for other in self._deferred
+                if other == target or target.startswith(other + "/") or other.startswith(target + "/")
+            )
+        return frozenset(needed)
+
+    def _mount_deferred(self, targets: Iterable[str]) -> None:
+        """Make the deferred mounts among targets that are not mounted yet, parents first."""
+        targets = set(targets) - self._deferred_mounted
+        if not targets:
+            return
+        with self._deferred_lock:
+            for wave in self.mount_plan:
+                for mount_spec in wave:
+                    if mount_spec.target in targets and mount_spec.target not in self._deferred_mounted:
+                        self._mount_custom(mount_spec)
+                        self._deferred_mounted.add(mount_spec.target)
 
     def _setup_resolv_conf(self) -> None:
         """Set up resolv.conf in the chroot."""
@@ -368,28 +1029,56 @@ class ChrootManager:
         if self._is_setup:
             return
 
-        self._check_chroot_dir()
+        # Before anything that would need releasing
+        self._check_root()
 
-        # For unshare mode, skip mount setup as it will be done in the unshared namespace
-        if not self.unshare_mode:
-            self._check_root()
+        if self.image is not None:
+            try:
+                self._setup_image()
+            except (OSError, MountError) as e:
+                self.teardown()
+                raise ChrootError(f"Failed to mount image {self.image}: {e}") from None
 
+        try:
+            self._check_chroot_dir()
+        except ChrootError:
+            # Release the image mounted above
+            self.teardown()
+            raise
+
+        try:
+            for cache in self.cache_mounts:
+                self._cache_locks.append((cache, self.cache_store.acquire(cache)))
+        except OSError as e:
+            self.teardown()
+            raise ChrootError(f"Failed to prepare cache mounts: {e}") from None
+
+        if self.profile:
+            self._prefetch_thread = threading.Thread(target=self.prefetch, name="chorut-prefetch", daemon=True)
+            self._prefetch_thread.start()
+
+        # For unshare mode, skip mount setup as it will be done in the unshared namespace
+        if self.unshare_mode:
+            # Except for idmapped mounts: the kernel only allows them for filesystems mounted by an owner
+            # of the initial user namespace, so they are made here and inherited by the namespace
+            try:
+                for wave in self.mount_plan:
+                    for mount_spec in wave:
+                        if mount_spec.idmap and mount_spec.target not in self._deferred:
+                            self._mount_custom(mount_spec)
+            except MountError as e:
+                self.teardown()
+                raise ChrootError(f"Failed to setup chroot: {e}") from None
+        else:
             try:
                 self._setup_standard_mounts()
-                self._setup_resolv_conf()
+                if "resolv.conf" in self.standard_mounts:
+                    self._setup_resolv_conf()
                 self._setup_custom_mounts()
 
-                # Check if chroot_dir is a mountpoint
-                try:
-                    result = subprocess.run(
-                        ["mountpoint", "-q", str(self.chroot_dir)], check=False, capture_output=True
-                    )
-                    if result.returncode != 0:
-                        logger.warning(
-                            f"{self.chroot_dir} is not a mountpoint. This may have undesirable side effects."
-                        )
-                except FileNotFoundError:
-                    pass  # mountpoint command not available
+                # Check if chroot_dir is a mountpoint (None when the mountpoint command is not available)
+                if self.mount_manager.is_mountpoint(str(self.chroot_dir)) is False:
+                    logger.warning(f"{self.chroot_dir} is not a mountpoint. This may have undesirable side effects.")
 
             except Exception as e:
                 self.teardown()
@@ -399,14 +1088,85 @@ class ChrootManager:
 
     def teardown(self) -> None:
         """Tear down the chroot environment."""
-        if self._is_setup:
-            self.mount_manager.unmount_all()
-            self._is_setup = False
+        # Also after a failed setup(), which calls this to undo the mounts made so far
+        self.mount_manager.unmount_all()
+        self._deferred_mounted.clear()
+        self._is_setup = False
+
+        self._release_caches()
 
-    def _create_unshare_script(self, command: list[str], userspec: str | None = None) -> str:
-        """Create a script to run within the unshared namespace."""
+        if self._prefetch_thread is not None:
+            self._prefetch_thread.join()
+            self._prefetch_thread = None
+        if self.profile is not None:
+            try:
+                self.profile.save()
+            except OSError as e:
+                logger.warning(f"Failed to save prefetch profile {self.profile.path}: {e}")
+
+        if self._loop_device is not None:
+            # Autoclear detached it when its mount went away; detaching by name now could hit
+            # a device that another process has attached since
+            logger.debug(f"Released {self._loop_device}")
+            self._loop_device = None
+        for directory in reversed(self._image_dirs):
+            with contextlib.suppress(OSError):
+                os.rmdir(directory)
+        self._image_dirs.clear()
+
+        if self._root_fd is not None:
+            os.close(self._root_fd)
+            self._root_fd = None
+
+    def _custom_mount_script(self, verbose: bool, deferred: frozenset[str] = frozenset()) -> list[str]:
+        """
+        Render the custom mount plan as script lines, including the deferred mounts in deferred.
+
+        The lines are cached, as the plan never changes.
+        """
+        key = (verbose, deferred)
+        if key in self._mount_script_lines:
+            return self._mount_script_lines[key]
+
+        lines = []
+        if self.mount_plan and verbose:
+            lines.append("echo 'Setting up custom mounts...'")
+
+        for wave in self.mount_plan:
+            # Idmapped mounts are made on the host side
+            wave = [
+                mount_spec
+                for mount_spec in wave
+                if not mount_spec.idmap and (mount_spec.target not in self._deferred or mount_spec.target in deferred)
+            ]
+            concurrent = len(wave) > 1
+            if concurrent:
+                lines.append("pids=()")
+            for mount_spec in wave:
+                source = _shell_quote(mount_spec.source)
+                target = _shell_quote(mount_spec.target)
+                if verbose:
+                    lines.append(f"echo {_shell_quote(f'Mounting {mount_spec.source} -> {mount_spec.target}')}")
+                if mount_spec.mkdir:
+                    lines.append(f"mkdir -p {target}")
+                mount_cmd = " ".join(["mount", *mount_spec.mount_args(), source, target])
+                lines.append(f"{mount_cmd} & pids+=($!)" if concurrent else mount_cmd)
+            if concurrent:
+                lines.append('for pid in "${pids[@]}"; do wait "$pid"; done')
+
+        self._mount_script_lines[key] = lines
+        return lines
+
+    def _create_unshare_script(self, userspec: str | None = None, deferred: frozenset[str] = frozenset()) -> str:
+        """
+        Create a script to run within the unshared namespace.
+
+        The command to execute is passed to the script as its positional parameters.
+        The deferred mounts in deferred are made along with the other custom mounts.
+        """
         # Check if verbose logging is enabled
         verbose = logger.isEnabledFor(logging.DEBUG)
+        enabled = self.standard_mounts
 
         script_lines = [
             "#!/bin/bash",
@@ -426,101 +1186,84 @@ class ChrootManager:
         script_lines.extend(
             [
                 "# Set up basic directories",
-                f"cd '{self.chroot_dir}'",
+                f"cd {_shell_quote(str(self.chroot_dir))}",
             ]
         )
 
         if verbose:
             script_lines.append("echo 'Creating directory structure...'")
 
-        script_lines.extend(
-            [
-                "mkdir -p proc sys dev dev/pts dev/shm run tmp",
-                "",
-            ]
-        )
+        directories = {
+            "proc": "proc",
+            "sys": "sys",
+            "dev": "dev",
+            "devpts": "dev/pts",
+            "shm": "dev/shm",
+            "run": "run",
+            "tmp": "tmp",
+        }
+        needed = [directory for name, directory in directories.items() if name in enabled]
+        if needed:
+            script_lines.extend([f"mkdir -p {' '.join(needed)}", ""])
 
         if verbose:
             script_lines.append("echo 'Mounting essential filesystems...'")
 
-        script_lines.extend(
-            [
-                "# Mount essential filesystems",
-                "mount -t proc proc proc",
-                "mount --bind /sys sys 2>/dev/null || mkdir -p sys",
-                "mount -t tmpfs udev dev",
-                "mkdir -p dev/pts dev/shm",
-                "mount -t devpts devpts dev/pts -o mode=0620,gid=5,nosuid,noexec",
-                "mount -t tmpfs shm dev/shm -o mode=1777,nosuid,nodev",
-                "mount -t tmpfs run run -o nosuid,nodev,mode=0755",
-                "mount -t tmpfs tmp tmp -o mode=1777,strictatime,nodev,nosuid",
-                "",
-            ]
-        )
-
-        if verbose:
-            script_lines.append("echo 'Setting up device files...'")
-
-        script_lines.extend(
-            [
-                "# Create device symlinks",
-                "ln -sf /proc/self/fd dev/fd",
-                "ln -sf /proc/self/fd/0 dev/stdin",
-                "ln -sf /proc/self/fd/1 dev/stdout",
-                "ln -sf /proc/self/fd/2 dev/stderr",
-                "",
-                "# Create essential device files",
-            ]
-        )
-
-        for device in ["full", "null", "random", "tty", "urandom", "zero"]:
-            script_lines.append(f"touch dev/{device}")
-            script_lines.append(f"mount --bind /dev/{device} dev/{device}")
-
-        script_lines.extend(
-            [
-                "",
-                "# Set up resolv.conf if available",
-                "if [ -f /etc/resolv.conf ] && [ -d etc ]; then",
-                "    mkdir -p etc",
-                "    if [ ! -f etc/resolv.conf ]; then",
-                "        touch etc/resolv.conf",
-                "    fi",
-                "    mount --bind /etc/resolv.conf etc/resolv.conf 2>/dev/null || true",
-                "fi",
-                "",
-            ]
-        )
-
-        # Add custom mounts
-        if self.custom_mounts and verbose:
-            script_lines.append("echo 'Setting up custom mounts...'")
-
-        for mount_spec in self.custom_mounts:
-            source = mount_spec["source"]
-            target_rel = mount_spec["target"].lstrip("/")
-            fstype = mount_spec.get("fstype")
-            options = mount_spec.get("options")
-            bind = mount_spec.get("bind", False)
-            mkdir = mount_spec.get("mkdir", True)
-
+        script_lines.append("# Mount essential filesystems")
+        if "proc" in enabled:
+            script_lines.append("mount -t proc proc proc")
+        if "sys" in enabled:
+            script_lines.append("mount --bind /sys sys 2>/dev/null || mkdir -p sys")
+        if "dev" in enabled:
+            script_lines.append("mount -t tmpfs udev dev")
+        if "devpts" in enabled:
+            script_lines.extend(["mkdir -p dev/pts", "mount -t devpts devpts dev/pts -o mode=0620,gid=5,nosuid,noexec"])
+        if "shm" in enabled:
+            script_lines.extend(["mkdir -p dev/shm", "mount -t tmpfs shm dev/shm -o mode=1777,nosuid,nodev"])
+        if "run" in enabled:
+            script_lines.append("mount -t tmpfs run run -o nosuid,nodev,mode=0755")
+        if "tmp" in enabled:
+            script_lines.append("mount -t tmpfs tmp tmp -o mode=1777,strictatime,nodev,nosuid")
+        script_lines.append("")
+
+        if "dev" in enabled:
             if verbose:
-                script_lines.append(f"echo 'Mounting {source} -> {target_rel}'")
+                script_lines.append("echo 'Setting up device files...'")
 
-            if mkdir:
-                script_lines.append(f"mkdir -p '{target_rel}'")
+            script_lines.extend(
+                [
+                    "# Create device symlinks",
+                    "ln -sf /proc/self/fd dev/fd",
+                    "ln -sf /proc/self/fd/0 dev/stdin",
+                    "ln -sf /proc/self/fd/1 dev/stdout",
+                    "ln -sf /proc/self/fd/2 dev/stderr",
+                    "",
+                    "# Create essential device files",
+                ]
+            )
 
-            mount_cmd = ["mount"]
-            if bind:
-                mount_cmd.append("--bind")
-            elif fstype:
-                mount_cmd.extend(["-t", fstype])
+            for device in ["full", "null", "random", "tty", "urandom", "zero"]:
+                script_lines.append(f"touch dev/{device}")
+                script_lines.append(f"mount --bind /dev/{device} dev/{device}")
+            script_lines.append("")
 
-            if options:
-                mount_cmd.extend(["-o", options])
+        if "resolv.conf" in enabled:
+            script_lines.extend(
+                [
+                    "# Set up resolv.conf if available",
+                    "if [ -f /etc/resolv.conf ] && [ -d etc ]; then",
+                    "    mkdir -p etc",
+                    "    if [ ! -f etc/resolv.conf ]; then",
+                    "        touch etc/resolv.conf",
+                    "    fi",
+                    "    mount --bind /etc/resolv.conf etc/resolv.conf 2>/dev/null || true",
+                    "fi",
+                    "",
+                ]
+            )
 
-            mount_cmd.extend([f"'{source}'", f"'{target_rel}'"])
-            script_lines.append(" ".join(mount_cmd))
+        # Add custom mounts
+        script_lines.extend(self._custom_mount_script(verbose, deferred))
 
         script_lines.extend(
             [
@@ -535,9 +1278,8 @@ class ChrootManager:
 
         chroot_cmd = ["chroot"]
         if userspec:
-            chroot_cmd.extend(["--userspec", userspec])
-        chroot_cmd.append(".")
-        chroot_cmd.extend(f"'{arg}'" for arg in command)
+            chroot_cmd.extend(["--userspec", _shell_quote(userspec)])
+        chroot_cmd.extend([".", '"$@"'])
 
         script_lines.append(" ".join(chroot_cmd))
 
@@ -549,7 +1291,11 @@ class ChrootManager:
         userspec: str | None = None,
         capture_output: bool = False,
         text: bool = True,
-    ) -> subprocess.CompletedProcess:
+        inputs: Iterable[str | Path] | None = None,
+        outputs: Iterable[str | Path] | None = None,
+        stdin: Any = None,
+        mounts: Iterable[str | Path] | None = None,
+    ) -> "subprocess.CompletedProcess":
         """
         Execute a command in the chroot environment.
 
@@ -558,15 +1304,28 @@ class ChrootManager:
                     When auto_shell=True (default), string commands containing shell metacharacters
                     (pipes |, logical operators &&/||, redirects <>, command substitution `cmd`/$(cmd),
                     glob patterns *, variable expansion $VAR, etc.) are automatically wrapped with 'bash -c'.
-                    Simple commands are parsed with shlex.split().
+                    Simple commands are split like shlex.split().
                     Set auto_shell=False during initialization to disable this behavior and require explicit 'bash -c' wrapping.
             userspec: User specification in format 'user' or 'user:group'
             capture_output: If True, capture stdout and stderr. If False, output goes to the terminal (default: False)
             text: If True, decode output as text. If False, return bytes (default: True)
+            inputs: Paths inside the chroot the command reads. Declaring them (even as an empty list)
+                    makes the call cacheable when the manager has an action_cache: the result is looked up
+                    by a hash of the command, environment, userspec, input contents and mounts, and on a
+                    hit it is returned, and its outputs restored, without running anything.
+            outputs: Paths inside the chroot the command produces, stored in and restored from the cache
+            stdin: Standard input of the command (default: inherited). A file descriptor or a file
+                    object with a file descriptor is passed straight to the command. bytes, str, other
+                    file objects and iterables of bytes or str chunks are written to it from a thread
+                    while its output is read, so large inputs stream through in constant memory.
+                    Calls with stdin are never looked up in or stored to the action cache.
+            mounts: Targets of deferred custom mounts the command needs. They are made before
+                    it runs, and stay mounted until teardown() in root mode.
 
         Returns:
             CompletedProcess object with the result. When capture_output=True, the stdout and stderr
-            attributes will contain the captured output.
+            attributes will contain the captured output. With process_sampling, its processes attribute
+            is a chorut.procstats.ProcessReport of the processes the command started.
 
         Examples:
             # Simple commands (both formats work identically):
@@ -587,6 +1346,11 @@ class ChrootManager:
             result = chroot.execute("echo `date`", capture_output=True)                  # Command substitution
             result = chroot.execute("ls *.txt", capture_output=True)                     # Glob patterns
 
+            # Feed input, e.g. a dump streamed from the host:
+            result = chroot.execute("wc -l", stdin=b"one\ntwo\n", capture_output=True)
+            with open("dump.sql", "rb") as f:
+                chroot.execute("psql app", stdin=f)
+
             # Manual shell invocation still works:
             result = chroot.execute("bash -c 'echo hello && echo world'", capture_output=True)
 
@@ -594,70 +1358,1135 @@ class ChrootManager:
             chroot_manual = ChrootManager('/path', auto_shell=False)
             result = chroot_manual.execute("bash -c 'ls | wc -l'")  # Explicit bash -c needed
         """
-        if not self._is_setup:
-            raise ChrootError("Chroot environment not set up. Call setup() first.")
+        import subprocess
 
-        if command is None:
-            command = ["/bin/bash"]
-        elif isinstance(command, str):
-            import shlex
+        if inputs is not None and self.action_cache is not None and stdin is None:
+            if not self._is_setup:
+                raise ChrootError("Chroot environment not set up. Call setup() first.")
+            return self.action_cache.run(
+                self, command, userspec, capture_output, text, inputs, outputs or [], mounts=mounts
+            )
+
+        chroot_cmd, env = self._build_command(command, userspec, mounts)
+        stdin, chunks = _stdin_source(stdin)
+        if self.profile is None and chunks is None and self.process_sampling is None:
+            return subprocess.run(
+                chroot_cmd, check=False, env=env, stdin=stdin, capture_output=capture_output, text=text
+            )
 
+        pipe = subprocess.PIPE if capture_output else None
+        errors: list[BaseException] = []
+        sampler = None
+        with (
+            subprocess.Popen(chroot_cmd, env=env, stdin=stdin, stdout=pipe, stderr=pipe, text=text) as process,
+            contextlib.ExitStack() as stack,
+        ):
+            if self.profile is not None:
+                stack.enter_context(self.profile.record(self.chroot_dir, process.pid))
+            if self.process_sampling is not None:
+                from .procstats import Sampler
+
+                # Processes of unshare mode cannot leave its pid namespace, those of root mode can
+                root = None if self.unshare_mode else str(self.chroot_dir)
+                sampler = stack.enter_context(Sampler(process.pid, self.process_sampling, root))
+            pump = None
+            if chunks is not None:
+                # The thread owns stdin, so communicate() only reads the output
+                writer, process.stdin = process.stdin, None
+                pump = threading.Thread(
+                    target=_pump_stdin, args=(process, writer, chunks, errors), name="chorut-stdin", daemon=True
+                )
+                pump.start()
+            try:
+                stdout, stderr = process.communicate()
+            except BaseException:
+                process.kill()
+                raise
+            finally:
+                if pump is not None:
+                    pump.join()
+        if errors:
+            raise errors[0]
+        result = subprocess.CompletedProcess(chroot_cmd, process.returncode, stdout, stderr)
+        if sampler is not None:
+            result.processes = sampler.report
+        return result
+
+    def _command_argv(self, command: list[str] | str | None) -> list[str]:
+        """Return the argv that runs inside the chroot for a command as accepted by execute()."""
+        if command is None:
+            return ["/bin/bash"]
+        if isinstance(command, str):
             # Auto-detect shell features and wrap with bash -c if needed
-            if self.auto_shell and self._needs_shell(command):
+            argv = _parse_command(command, self.auto_shell)
+            if argv == ("bash", "-c", command):
                 logger.debug(f"Auto-detected shell features in command: {command}")
-                command = ["bash", "-c", command]
-            else:
-                command = shlex.split(command)
+            return list(argv)
+        return list(command)
+
+    @staticmethod
+    def _command_env() -> dict[str, str]:
+        """Return the environment commands run with."""
+        env = os.environ.copy()
+        env["SHELL"] = "/bin/bash"
+        return env
+
+    def _build_command(
+        self, command: list[str] | str | None, userspec: str | None, mounts: Iterable[str | Path] | None = None
+    ) -> tuple[list[str], dict[str, str]]:
+        """Build the host command line and environment that run command inside the chroot."""
+        if not self._is_setup:
+            raise ChrootError("Chroot environment not set up. Call setup() first.")
+
+        command = self._command_argv(command)
+        env = self._command_env()
+        deferred = self._deferred_targets(mounts) if mounts else frozenset()
+        if deferred:
+            # In unshare mode only idmapped mounts are made on the host side, the others by the script
+            self._mount_deferred(target for target in deferred if not self.unshare_mode or self._deferred[target].idmap)
 
         if self.unshare_mode:
             # For unshare mode, create a script and run it in unshared namespace
             logger.debug("Creating unshare script for command: %s", command)
-            script_content = self._create_unshare_script(command, userspec)
+            script_content = self._create_unshare_script(userspec, deferred)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Script content:\n%s", script_content)
 
-            # Write script to a temporary file
-            import tempfile
+            # The script is passed inline and the command as its arguments, so nothing is written to disk
+            unshare_cmd = [
+                "unshare",
+                "--fork",
+                "--pid",
+                "--mount",
+                "--map-auto",
+                "--map-root-user",
+                "/bin/bash",
+                "-c",
+                script_content,
+                "chorut",
+                *command,
+            ]
 
-            with tempfile.NamedTemporaryFile(mode="w", suffix=".sh", delete=False) as f:
-                f.write(script_content)
-                script_path = f.name
+            logger.debug("Executing unshare command: %s", " ".join([*unshare_cmd[:7], "<script>", *command]))
+            return unshare_cmd, env
 
-            logger.debug("Unshare script written to: %s", script_path)
-            if logger.isEnabledFor(logging.DEBUG):
-                logger.debug("Script content:\n%s", script_content)
+        # Standard chroot mode
+        chroot_cmd = ["chroot"]
+        if userspec:
+            chroot_cmd.extend(["--userspec", userspec])
+
+        chroot_cmd.append(str(self.chroot_dir))
+        chroot_cmd.extend(command)
+        return chroot_cmd, env
 
+    def popen(
+        self,
+        command: list[str] | str | None = None,
+        userspec: str | None = None,
+        mounts: Iterable[str | Path] | None = None,
+        **kwargs: Any,
+    ) -> "subprocess.Popen":
+        """
+        Start a command in the chroot environment without waiting for it.
+
+        Accepts the same command, userspec and mounts as execute(). Any other keyword
+        arguments (stdin, stdout, stderr, text, pass_fds, ...) are passed to
+        subprocess.Popen.
+
+        Returns:
+            The subprocess.Popen object of the started command
+        """
+        import subprocess
+
+        chroot_cmd, env = self._build_command(command, userspec, mounts)
+        kwargs.setdefault("env", env)
+        return subprocess.Popen(chroot_cmd, **kwargs)
+
+    def _needs_teardown(self) -> bool:
+        """Whether teardown() has anything to undo on the host."""
+        return bool(
+            not self.unshare_mode
+            or self.mount_manager.active_mounts
+            or self.mount_manager.active_lazy
+            or self.mount_manager.active_files
+            or self._cache_locks
+            or self._loop_device is not None
+            or self._image_dirs
+        )
+
+    def _fork_reaper(self) -> None:
+        """
+        Fork a process that calls teardown() once the current process exits.
+
+        The reaper watches the current process through a pidfd, so it also
+        cleans up after a command that is killed. It starts its own session,
+        so signals from the terminal reach only the command, and it lets go
+        of stdin, stdout and stderr, so readers of the command's output see
+        EOF as soon as the command exits. It is forked twice, so that it is never a
+        child of the command, which could wait for it. The current process
+        forgets what it set up, leaving the teardown to the reaper alone.
+        """
+        pidfd = os.pidfd_open(os.getpid())
+        pid = os.fork()
+        if pid == 0:
+            status = 0
             try:
-                # Make script executable
-                os.chmod(script_path, 0o755)
+                import select
+
+                os.setsid()
+                if os.fork() != 0:
+                    os._exit(0)
+                devnull = os.open(os.devnull, os.O_RDWR)
+                os.dup2(devnull, 0)
+                os.dup2(devnull, 1)
+                os.dup2(devnull, 2)
+                os.close(devnull)
+                poller = select.poll()
+                poller.register(pidfd, select.POLLIN)
+                while not poller.poll():
+                    pass
+                self.teardown()
+            except BaseException as e:
+                logger.error(f"Failed to tear down {self.chroot_dir}: {e}")
+                status = 1
+            finally:
+                os._exit(status)
 
-                # Run the script in unshared namespace
-                unshare_cmd = ["unshare", "--fork", "--pid", "--mount", "--map-auto", "--map-root-user", script_path]
+        os.close(pidfd)
+        os.waitpid(pid, 0)
+        logger.debug(f"Teardown of {self.chroot_dir} handed over to a reaper process")
+        self.mount_manager = MountManager()
+        self._cache_locks = []
+        self._loop_device = None
+        self._image_dirs = []
+        self._deferred_mounted = set()
+        self.profile = None
+        self._is_setup = False
+
+    def exec(self, command: list[str] | str | None = None, userspec: str | None = None) -> NoReturn:
+        """
+        Replace the current process with a command in the chroot environment.
+
+        Unlike execute(), no Python process stays around while the command
+        runs: the command keeps the pid, parent, terminal and file descriptors
+        of the caller, and its exit status is the caller's. In unshare mode the
+        process becomes unshare(1), whose namespace goes away with the command.
+        In root mode the process enters the chroot itself and execs the
+        command, and the mounts are undone by a small reaper process forked
+        beforehand, which waits for the command to exit and calls teardown().
+        The reaper is also used in unshare mode when setup() left something on
+        the host, such as idmapped mounts or cache locks. Commands run this way
+        are not recorded into a prefetch profile.
+
+        Args:
+            command: Command to execute, as accepted by execute() (defaults to ['/bin/bash'])
+            userspec: User specification in format 'user' or 'user:group'
+
+        Raises:
+            ChrootError: If the chroot is not set up
+            OSError: If the command cannot be executed. In root mode the calling process is
+                inside the chroot by then, and the teardown is still left to the reaper.
+        """
+        argv, env = self._build_command(command, userspec)
+        if not self.unshare_mode:
+            argv = self._command_argv(command)
+
+        # Prefetching threads would not survive the exec
+        if self._prefetch_thread is not None:
+            self._prefetch_thread.join()
+            self._prefetch_thread = None
+
+        if self._needs_teardown():
+            for stream in (sys.stdout, sys.stderr):
+                stream.flush()
+            self._fork_reaper()
+
+        if not self.unshare_mode:
+            self._enter_chroot(userspec)
+        logger.debug(f"Executing {argv[0]}")
+        os.execvpe(argv[0], argv, env)
 
-                logger.debug("Executing unshare command: %s", " ".join(unshare_cmd))
+    def _setup_namespace_mounts(self) -> None:
+        """
+        Set up the unshare mode mounts from inside freshly unshared namespaces.
+
+        This mirrors the script generated by _create_unshare_script(), but calls
+        mount(2) directly so no helper processes are needed.
+        """
+        linux = _syscalls()
+
+        root = str(self.chroot_dir)
+        enabled = self.standard_mounts
+        linux.mount(None, "/", None, linux.MS_REC | linux.MS_PRIVATE)
+        linux.mount(root, root, None, linux.MS_BIND | linux.MS_REC)
+        os.chdir(root)
+
+        for directory in ["proc", "sys", "dev", "run", "tmp"]:
+            if directory in enabled:
+                os.makedirs(directory, exist_ok=True)
+
+        # Mount essential filesystems
+        if "proc" in enabled:
+            linux.mount_options("proc", "proc", "proc", "nosuid,noexec,nodev")
+        if "sys" in enabled:
+            with contextlib.suppress(OSError):
+                linux.mount("/sys", "sys", None, linux.MS_BIND | linux.MS_REC)
+        if "dev" in enabled:
+            linux.mount("udev", "dev", "tmpfs")
+        if "devpts" in enabled:
+            os.makedirs("dev/pts", exist_ok=True)
+            try:
+                linux.mount_options("devpts", "dev/pts", "devpts", "newinstance,mode=0620,gid=5,nosuid,noexec")
+            except OSError:
+                # gid 5 is not mapped when only the calling user is mapped into the namespace
+                linux.mount_options("devpts", "dev/pts", "devpts", "newinstance,mode=0620,nosuid,noexec")
+        if "shm" in enabled:
+            os.makedirs("dev/shm", exist_ok=True)
+            linux.mount_options("shm", "dev/shm", "tmpfs", "mode=1777,nosuid,nodev")
+        if "run" in enabled:
+            linux.mount_options("run", "run", "tmpfs", "nosuid,nodev,mode=0755")
+        if "tmp" in enabled:
+            linux.mount_options("tmp", "tmp", "tmpfs", "mode=1777,strictatime,nodev,nosuid")
+
+        if "dev" in enabled:
+            # Create device symlinks
+            os.symlink("/proc/self/fd", "dev/fd")
+            os.symlink("/proc/self/fd/0", "dev/stdin")
+            os.symlink("/proc/self/fd/1", "dev/stdout")
+            os.symlink("/proc/self/fd/2", "dev/stderr")
+
+            # Create essential device files
+            for device in ["full", "null", "random", "tty", "urandom", "zero"]:
+                Path("dev", device).touch()
+                linux.mount(f"/dev/{device}", f"dev/{device}", None, linux.MS_BIND)
+
+        # Set up resolv.conf if available
+        if "resolv.conf" in enabled and os.path.isfile("/etc/resolv.conf") and os.path.isdir("etc"):
+            with contextlib.suppress(OSError):
+                Path("etc/resolv.conf").touch()
+                linux.mount("/etc/resolv.conf", "etc/resolv.conf", None, linux.MS_BIND)
+
+        for wave in self.mount_plan:
+            for mount_spec in wave:
+                if mount_spec.idmap or mount_spec.target in self._deferred:
+                    continue
+                if mount_spec.mkdir:
+                    os.makedirs(mount_spec.target, exist_ok=True)
+                linux.mount_options(
+                    mount_spec.source,
+                    mount_spec.target,
+                    fstype=mount_spec.fstype,
+                    options=mount_spec.options,
+                    bind=mount_spec.bind,
+                )
+
+    def _enter_chroot(self, userspec: str | None = None) -> None:
+        """Change the root of the current process to the chroot and switch to userspec."""
+        import grp
+        import pwd
+
+        os.chroot(self.chroot_dir)
+        os.chdir("/")
 
-                env = os.environ.copy()
-                env["SHELL"] = "/bin/bash"
+        if not userspec:
+            return
+
+        # User and group names are looked up in the chroot's own databases, like chroot --userspec
+        user, _, group = userspec.partition(":")
+        if user.isdigit():
+            uid, gid, name = int(user), None, None
+        else:
+            entry = pwd.getpwnam(user)
+            uid, gid, name = entry.pw_uid, entry.pw_gid, entry.pw_name
+        if group:
+            gid = int(group) if group.isdigit() else grp.getgrnam(group).gr_gid
+        if gid is None:
+            gid = os.getgid()
+
+        if name:
+            os.initgroups(name, gid)
+        else:
+            os.setgroups([])
+        os.setgid(gid)
+        os.setuid(uid)
+
+    def _run_callable_child(
+        self,
+        write_fd: int,
+        sync_fds: tuple[int, int] | None,
+        fn: Callable[..., Any],
+        args: tuple,
+        kwargs: dict,
+        userspec: str | None,
+    ) -> NoReturn:
+        """
+        Body of the forked child used by run_callable(). Never returns.
 
-                return subprocess.run(unshare_cmd, check=False, env=env, capture_output=capture_output, text=text)
+        In unshare mode, the child reports on the first of sync_fds once it has
+        its user namespace and waits on the second until the parent has set up
+        the id maps.
+        """
+        import pickle
+
+        linux = _syscalls()
+
+        status = 1
+        try:
+            try:
+                try:
+                    if sync_fds is not None:
+                        ready_w, mapped_r = sync_fds
+                        linux.unshare(linux.CLONE_NEWUSER | linux.CLONE_NEWNS | linux.CLONE_NEWPID)
+                        os.write(ready_w, b"1")
+                        os.close(ready_w)
+                        if os.read(mapped_r, 1) != b"1":
+                            raise ChrootError("Failed to enter chroot: no id maps for the user namespace")
+                        os.close(mapped_r)
+
+                        # Only children of this process end up in the new pid namespace
+                        pid = os.fork()
+                        if pid != 0:
+                            os.close(write_fd)
+                            _, wait_status = os.waitpid(pid, 0)
+                            code = os.waitstatus_to_exitcode(wait_status)
+                            os._exit(code if code >= 0 else 128 - code)
+
+                        self._setup_namespace_mounts()
+
+                    self._enter_chroot(userspec)
+                except (OSError, KeyError) as e:
+                    raise ChrootError(f"Failed to enter chroot: {e}") from None
+
+                payload = (True, fn(*args, **kwargs))
+                status = 0
+            except BaseException as e:
+                payload = (False, e)
+
+            try:
+                data = pickle.dumps(payload)
+            except Exception as e:
+                data = pickle.dumps((False, ChrootError(f"Failed to pickle result of {fn!r}: {e}")))
+                status = 1
+
+            with os.fdopen(write_fd, "wb") as pipe:
+                # Length first: a process fn left behind may keep the pipe open, so EOF is not the end
+                pipe.write(len(data).to_bytes(8, "big") + data)
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(status)
+
+    def run_callable(self, fn: Callable[..., Any], *args: Any, userspec: str | None = None, **kwargs: Any) -> Any:
+        """
+        Call a Python function inside the chroot environment and return its result.
+
+        The current process is forked, the child enters the chroot (and the
+        namespaces, in unshare mode) and calls fn(*args, **kwargs). The result,
+        or the exception raised, is pickled and sent back over a pipe. No new
+        interpreter is started, so this is much cheaper than running python3
+        inside the chroot through execute(). In unshare mode the user namespace
+        gets the same id maps as execute() sets up, so userspec works the same.
+
+        Args:
+            fn: Callable to run. It only needs to be available in this process, not in the chroot.
+            *args: Positional arguments for fn
+            userspec: User specification in format 'user' or 'user:group'
+            **kwargs: Keyword arguments for fn
+
+        Returns:
+            The value returned by fn. It must be picklable.
+
+        Raises:
+            The exception raised by fn, or ChrootError if the chroot could not be entered.
+
+        Examples:
+            # Check for a file as seen from inside the chroot
+            exists = chroot.run_callable(os.path.exists, "/etc/os-release")
+        """
+        import pickle
+
+        if not self._is_setup:
+            raise ChrootError("Chroot environment not set up. Call setup() first.")
+
+        # Avoid writing buffered output twice
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        if self.unshare_mode:
+            # The same id maps as execute(), which runs unshare --map-root-user --map-auto
+            try:
+                id_maps = _unshare_id_maps()
+            except MountError as e:
+                raise ChrootError(str(e)) from None
+
+        read_fd, write_fd = os.pipe()
+        # In unshare mode: the child reports that it has unshared, the parent that it has mapped the ids
+        ready_r, ready_w = os.pipe() if self.unshare_mode else (-1, -1)
+        mapped_r, mapped_w = os.pipe() if self.unshare_mode else (-1, -1)
+        parent_fds = [fd for fd in (read_fd, ready_r, mapped_w) if fd >= 0]
+        child_fds = [fd for fd in (write_fd, ready_w, mapped_r) if fd >= 0]
+        try:
+            pid = os.fork()
+        except OSError:
+            for fd in parent_fds + child_fds:
+                os.close(fd)
+            raise
+
+        if pid == 0:
+            for fd in parent_fds:
+                os.close(fd)
+            sync_fds = (ready_w, mapped_r) if self.unshare_mode else None
+            self._run_callable_child(write_fd, sync_fds, fn, args, kwargs, userspec)
+
+        for fd in child_fds:
+            os.close(fd)
+        try:
+            pidfd = os.pidfd_open(pid)
+            parent_fds.append(pidfd)
+            # Nothing arrives if the child failed before unsharing; it then reports the error itself
+            if self.unshare_mode and os.read(ready_r, 1) == b"1":
+                self._map_namespace_ids(pid, *id_maps)
+                os.write(mapped_w, b"1")
+            data = self._read_callable_result(read_fd, pidfd)
+        finally:
+            for fd in parent_fds:
+                os.close(fd)
+            _, wait_status = os.waitpid(pid, 0)
+
+        if not data:
+            raise ChrootError(
+                f"Callable {fn!r} exited without a result (exit status {os.waitstatus_to_exitcode(wait_status)})"
+            )
+
+        ok, value = pickle.loads(data)
+        if ok:
+            return value
+        raise value
+
+    @staticmethod
+    def _map_namespace_ids(pid: int, uids: list[tuple[int, int, int]], gids: list[tuple[int, int, int]]) -> None:
+        """Write the id maps of a process that has just unshared its user namespace, like unshare(1) does."""
+        import subprocess
+
+        for helper, ranges in (("newuidmap", uids), ("newgidmap", gids)):
+            try:
+                subprocess.run(
+                    [helper, str(pid), *(str(value) for id_range in ranges for value in id_range)],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                )
+            except (OSError, subprocess.CalledProcessError) as e:
+                # The child sees the closed pipe and gives up
+                raise ChrootError(f"Failed to run {helper}: {getattr(e, 'stderr', None) or e}") from None
+
+    @staticmethod
+    def _read_callable_result(read_fd: int, pidfd: int) -> bytes:
+        """
+        Read the length-prefixed result of run_callable() from its pipe.
+
+        Returns:
+            The pickled result, or b"" if the child exited without sending it
+        """
+        import select
+
+        poller = select.poll()
+        poller.register(read_fd, select.POLLIN)
+        poller.register(pidfd, select.POLLIN)
+        data = bytearray()
+        size = None
+        while size is None or len(data) < 8 + size:
+            events = dict(poller.poll())
+            if read_fd in events:
+                chunk = os.read(read_fd, 1 << 20)
+                if not chunk:
+                    return b""
+                data += chunk
+                if size is None and len(data) >= 8:
+                    size = int.from_bytes(data[:8], "big")
+            elif pidfd in events:
+                # Exited with the pipe drained but still held open by a process it left behind
+                return b""
+        return bytes(data[8:])
+
+    def _open_in_root(self, path: str | Path, flags: int, mode: int = 0o666) -> int:
+        """
+        Open a path as seen from inside the chroot and return the file descriptor.
+
+        Symlinks and '..' are resolved relative to chroot_dir, so they can never
+        point outside of it.
+        """
+        if self._root_fd is None:
+            self._check_chroot_dir()
+            self._root_fd = os.open(self.chroot_dir, os.O_PATH | os.O_DIRECTORY | os.O_CLOEXEC)
+        return _syscalls().open_in_root(self._root_fd, str(path), flags, mode)
+
+    def _makedirs_in_root(self, path: str) -> int:
+        """Create a directory and its parents inside the chroot and return an O_PATH descriptor for it."""
+        try:
+            return self._open_in_root(path, os.O_PATH | os.O_DIRECTORY)
+        except FileNotFoundError:
+            pass
+
+        parent, _, name = path.rstrip("/").rpartition("/")
+        parent_fd = self._makedirs_in_root(parent)
+        try:
+            with contextlib.suppress(FileExistsError):
+                os.mkdir(name, 0o755, dir_fd=parent_fd)
+        finally:
+            os.close(parent_fd)
+        return self._open_in_root(path, os.O_PATH | os.O_DIRECTORY)
+
+    def put(self, host_path: str | Path, chroot_path: str | Path) -> int:
+        """
+        Copy a regular file from the host into the chroot.
+
+        The data is copied with a reflink when the filesystem supports it, and
+        otherwise with copy_file_range(2) or sendfile(2), so it never passes
+        through Python. chroot_path is resolved inside chroot_dir and cannot
+        escape it through symlinks. The chroot does not need to be set up.
+
+        Returns:
+            The number of bytes in the file
+        """
+        try:
+            src_fd = os.open(host_path, os.O_RDONLY | os.O_CLOEXEC)
+            try:
+                st = os.fstat(src_fd)
+                if not stat.S_ISREG(st.st_mode):
+                    raise ChrootError(f"Not a regular file: {host_path}")
+                dst_fd = self._open_in_root(chroot_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, st.st_mode & 0o7777)
+                try:
+                    if not _syscalls().reflink(src_fd, dst_fd):
+                        _syscalls().copy_fd(src_fd, dst_fd)
+                    os.fchmod(dst_fd, st.st_mode & 0o7777)
+                finally:
+                    os.close(dst_fd)
+            finally:
+                os.close(src_fd)
+        except OSError as e:
+            raise ChrootError(f"Failed to copy {host_path} to {chroot_path}: {e}") from None
+
+        logger.debug(f"Copied {host_path} -> {chroot_path} ({st.st_size} bytes)")
+        return st.st_size
+
+    def get(self, chroot_path: str | Path, host_path: str | Path) -> int:
+        """
+        Copy a regular file from the chroot to the host.
+
+        This is the reverse of put() and uses the same copy strategy.
+
+        Returns:
+            The number of bytes in the file
+        """
+        try:
+            src_fd = self._open_in_root(chroot_path, os.O_RDONLY)
+            try:
+                st = os.fstat(src_fd)
+                if not stat.S_ISREG(st.st_mode):
+                    raise ChrootError(f"Not a regular file in chroot: {chroot_path}")
+                dst_fd = os.open(host_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, st.st_mode & 0o7777)
+                try:
+                    if not _syscalls().reflink(src_fd, dst_fd):
+                        _syscalls().copy_fd(src_fd, dst_fd)
+                finally:
+                    os.close(dst_fd)
             finally:
-                # Clean up script file
+                os.close(src_fd)
+        except OSError as e:
+            raise ChrootError(f"Failed to copy {chroot_path} to {host_path}: {e}") from None
+
+        logger.debug(f"Copied {chroot_path} -> {host_path} ({st.st_size} bytes)")
+        return st.st_size
+
+    @staticmethod
+    def _open_tar(target: Any, mode: str):
+        """Open a tar stream on a path or a binary file object."""
+        import tarfile
+
+        if isinstance(target, str | os.PathLike):
+            return tarfile.open(name=os.fspath(target), mode=mode)
+        return tarfile.open(fileobj=target, mode=mode)
+
+    def _extract_tar_member(self, tar, member, dest: str, directories: list) -> None:
+        """Create a single tar member below dest, resolving every path inside the chroot."""
+        parts = [part for part in member.name.split("/") if part and part != "."]
+        if not parts:
+            return
+        if ".." in parts:
+            logger.warning(f"Skipping tar member with '..' in its path: {member.name}")
+            return
+
+        parent = "/".join([dest, *parts[:-1]])
+        name = parts[-1]
+        parent_fd = self._makedirs_in_root(parent)
+        try:
+            if member.isdir():
+                with contextlib.suppress(FileExistsError):
+                    os.mkdir(name, 0o700, dir_fd=parent_fd)
+                directories.append(member)
+                return
+
+            # Never write through an existing symlink or replace a file in place
+            with contextlib.suppress(FileNotFoundError, IsADirectoryError):
+                os.unlink(name, dir_fd=parent_fd)
+
+            if member.isreg():
+                fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, 0o600, dir_fd=parent_fd)
+                with os.fdopen(fd, "wb") as f:
+                    source = tar.extractfile(member)
+                    if source is not None:
+                        import shutil
+
+                        shutil.copyfileobj(source, f, 1 << 20)
+                    f.flush()
+                    self._apply_tar_metadata(member, f.fileno())
+                return
+            elif member.issym():
+                os.symlink(member.linkname, name, dir_fd=parent_fd)
+            elif member.islnk():
+                link_parts = [part for part in member.linkname.split("/") if part and part != "."]
+                link_parent, _, link_name = "/".join([dest, *link_parts]).rpartition("/")
+                link_fd = self._open_in_root(link_parent, os.O_PATH | os.O_DIRECTORY)
                 try:
-                    os.unlink(script_path)
-                    logger.debug("Cleaned up script file: %s", script_path)
-                except OSError:
-                    pass
+                    os.link(link_name, name, src_dir_fd=link_fd, dst_dir_fd=parent_fd, follow_symlinks=False)
+                finally:
+                    os.close(link_fd)
+                return
+            elif member.ischr() or member.isblk() or member.isfifo():
+                kind = stat.S_IFCHR if member.ischr() else stat.S_IFBLK if member.isblk() else stat.S_IFIFO
+                os.mknod(name, kind | 0o600, os.makedev(member.devmajor, member.devminor), dir_fd=parent_fd)
+            else:
+                logger.warning(f"Skipping unsupported tar member: {member.name}")
+                return
+
+            self._apply_tar_metadata(member, name, parent_fd)
+        finally:
+            os.close(parent_fd)
+
+    @staticmethod
+    def _apply_tar_metadata(member, path: int | str, dir_fd: int | None = None) -> None:
+        """
+        Restore ownership, mode and modification time of an extracted tar member.
+
+        path is either an open file descriptor or a name relative to dir_fd;
+        names are never followed if they are symlinks.
+        """
+        by_name = {} if isinstance(path, int) else {"dir_fd": dir_fd}
+        no_follow = {} if isinstance(path, int) else {"dir_fd": dir_fd, "follow_symlinks": False}
+
+        if os.geteuid() == 0:
+            os.chown(path, member.uid, member.gid, **no_follow)
+        if not member.issym():
+            os.chmod(path, member.mode & 0o7777, **by_name)
+        mtime_ns = int(member.mtime * 1_000_000_000)
+        os.utime(path, ns=(mtime_ns, mtime_ns), **no_follow)
+
+    def _add_tar_member(self, tar, path_fd: int, arcname: str, hardlinks: dict[tuple[int, int], str]) -> int:
+        """
+        Add the file behind an O_PATH descriptor to a tar stream, and the tree below it for a directory.
+
+        Entries are opened relative to their directory's descriptor without
+        following symlinks, and contents are read through the descriptors, so
+        no path is ever resolved on the host.
+
+        Returns:
+            The number of members added
+        """
+        import tarfile
+
+        st = os.fstat(path_fd)
+        info = tarfile.TarInfo(arcname)
+        info.mode = stat.S_IMODE(st.st_mode)
+        info.uid, info.gid = st.st_uid, st.st_gid
+        info.mtime = int(st.st_mtime)
+
+        if stat.S_ISREG(st.st_mode):
+            if st.st_nlink > 1:
+                key = (st.st_dev, st.st_ino)
+                if key in hardlinks:
+                    info.type, info.linkname = tarfile.LNKTYPE, hardlinks[key]
+                    tar.addfile(info)
+                    return 1
+                hardlinks[key] = arcname
+            info.size = st.st_size
+            with open(f"/proc/self/fd/{path_fd}", "rb") as f:
+                tar.addfile(info, f)
+            return 1
+        if stat.S_ISLNK(st.st_mode):
+            info.type, info.linkname = tarfile.SYMTYPE, os.readlink("", dir_fd=path_fd)
+        elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+            info.type = tarfile.CHRTYPE if stat.S_ISCHR(st.st_mode) else tarfile.BLKTYPE
+            info.devmajor, info.devminor = os.major(st.st_rdev), os.minor(st.st_rdev)
+        elif stat.S_ISFIFO(st.st_mode):
+            info.type = tarfile.FIFOTYPE
+        elif stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
         else:
-            # Standard chroot mode
-            chroot_cmd = ["chroot"]
-            if userspec:
-                chroot_cmd.extend(["--userspec", userspec])
+            # Sockets have no tar representation
+            return 0
+        tar.addfile(info)
+        if info.type != tarfile.DIRTYPE:
+            return 1
+
+        count = 1
+        dir_fd = os.open(".", os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC, dir_fd=path_fd)
+        try:
+            for name in sorted(os.listdir(dir_fd)):
+                child_fd = os.open(name, os.O_PATH | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=dir_fd)
+                try:
+                    count += self._add_tar_member(tar, child_fd, f"{arcname}/{name}", hardlinks)
+                finally:
+                    os.close(child_fd)
+        finally:
+            os.close(dir_fd)
+        return count
+
+    def import_tar(self, source: Any, chroot_path: str | Path = "/") -> int:
+        """
+        Extract a tar stream into the chroot.
+
+        The archive is read as a stream, so it can come from a pipe or socket,
+        and may be compressed with any method the tarfile module supports.
+        Every member is created relative to chroot_path with paths resolved
+        inside chroot_dir, so neither the archive nor symlinks already in the
+        chroot can write outside of it.
+
+        Args:
+            source: Path to an archive, or a binary file object to read it from
+            chroot_path: Directory inside the chroot to extract into (default: '/')
+
+        Returns:
+            The number of members extracted
+        """
+        import tarfile
+
+        dest = str(chroot_path).strip("/")
+        directories: list = []
+        count = 0
+        try:
+            with self._open_tar(source, "r|*") as tar:
+                for member in tar:
+                    self._extract_tar_member(tar, member, dest, directories)
+                    count += 1
+
+            # Directory permissions are applied last so read-only directories can still be filled
+            for member in reversed(directories):
+                path = "/".join([dest, *(part for part in member.name.split("/") if part and part != ".")])
+                dir_fd = self._open_in_root(path, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    self._apply_tar_metadata(member, dir_fd)
+                finally:
+                    os.close(dir_fd)
+        except (OSError, tarfile.TarError) as e:
+            raise ChrootError(f"Failed to import tar archive into {chroot_path}: {e}") from None
+
+        logger.debug(f"Imported {count} tar members into {chroot_path}")
+        return count
+
+    def export_tar(self, chroot_path: str | Path, dest: Any, compression: str | None = None) -> int:
+        """
+        Write a file or directory tree from the chroot as a tar stream.
+
+        Args:
+            chroot_path: File or directory inside the chroot to export
+            dest: Path of the archive to create, or a binary file object to write it to
+            compression: Optional compression ('gz', 'bz2' or 'xz')
+
+        Returns:
+            The number of members written
+        """
+        import tarfile
+
+        try:
+            fd = self._open_in_root(chroot_path, os.O_PATH)
+        except OSError as e:
+            raise ChrootError(f"Failed to export {chroot_path}: {e}") from None
 
-            chroot_cmd.append(str(self.chroot_dir))
-            chroot_cmd.extend(command)
+        arcname = os.path.basename(str(chroot_path).rstrip("/")) or "."
+        try:
+            with self._open_tar(dest, f"w|{compression or ''}") as tar:
+                count = self._add_tar_member(tar, fd, arcname, {})
+        except (OSError, tarfile.TarError) as e:
+            raise ChrootError(f"Failed to export {chroot_path}: {e}") from None
+        finally:
+            os.close(fd)
+
+        logger.debug(f"Exported {count} tar members from {chroot_path}")
+        return count
+
+    def open(
+        self,
+        path: str | Path,
+        mode: str = "r",
+        buffering: int = -1,
+        encoding: str | None = None,
+        errors: str | None = None,
+        newline: str | None = None,
+    ):
+        """
+        Open a file inside the chroot, like the builtin open().
+
+        The path is resolved as if the calling process were inside the chroot:
+        absolute symlinks and '..' stay within chroot_dir. No process is spawned
+        and the chroot does not need to be set up. Errors are raised as OSError,
+        exactly like the builtin.
+        """
+        flags = {
+            "r": os.O_RDONLY,
+            "w": os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+            "a": os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+            "x": os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+        }
+        kind = next((char for char in mode if char in flags), None)
+        if kind is None:
+            raise ValueError(f"invalid mode: {mode!r}")
+        open_flags = flags[kind]
+        if "+" in mode:
+            open_flags = (open_flags & ~(os.O_RDONLY | os.O_WRONLY)) | os.O_RDWR
+
+        fd = self._open_in_root(path, open_flags)
+        try:
+            return open(fd, mode, buffering=buffering, encoding=encoding, errors=errors, newline=newline)
+        except Exception:
+            os.close(fd)
+            raise
+
+    def stat(self, path: str | Path, follow_symlinks: bool = True) -> os.stat_result:
+        """Return os.stat() information for a path inside the chroot."""
+        if not follow_symlinks:
+            parent, name = os.path.split(str(path).rstrip("/"))
+            if name not in ("", ".", ".."):
+                parent_fd = self._open_in_root(parent or "/", os.O_PATH | os.O_DIRECTORY)
+                try:
+                    return os.stat(name, dir_fd=parent_fd, follow_symlinks=False)
+                finally:
+                    os.close(parent_fd)
+
+        fd = self._open_in_root(path, os.O_PATH)
+        try:
+            return os.stat(fd)
+        finally:
+            os.close(fd)
+
+    def readlink(self, path: str | Path) -> str:
+        """Return the target of a symlink inside the chroot, as stored (it is not resolved)."""
+        parent, name = os.path.split(str(path).rstrip("/"))
+        parent_fd = self._open_in_root(parent or "/", os.O_PATH | os.O_DIRECTORY)
+        try:
+            return os.readlink(name, dir_fd=parent_fd)
+        finally:
+            os.close(parent_fd)
+
+    def listdir(self, path: str | Path = "/") -> list[str]:
+        """Return the names of the entries in a directory inside the chroot."""
+        fd = self._open_in_root(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            return os.listdir(fd)
+        finally:
+            os.close(fd)
+
+    def exists(self, path: str | Path) -> bool:
+        """Return whether a path exists inside the chroot, following symlinks within it."""
+        try:
+            os.close(self._open_in_root(path, os.O_PATH))
+        except OSError:
+            return False
+        return True
+
+    @staticmethod
+    def clone(
+        base: str | Path,
+        dest: str | Path,
+        strategy: str = "auto",
+        private_paths: tuple[str, ...] | None = None,
+        workers: int | None = None,
+    ) -> "CloneResult":
+        """
+        Create a private copy of a base root filesystem, sharing file data where possible.
+
+        Meant for one throwaway root per job when overlayfs is not available.
+        Directories are always recreated, so entries can be added, removed
+        and renamed in the clone without affecting the base. Mount points in
+        base are recreated as empty directories. The tree is walked in
+        parallel.
+
+        Args:
+            base: Root filesystem to clone
+            dest: Directory to create the clone in (must be empty or not exist)
+            strategy: How file data is shared:
+                - 'reflink': FICLONE reflinks (Btrfs, XFS); writes to either side are private
+                - 'hardlink': hardlinks to the base files. Files replaced by rename, as package
+                  managers do, stay private, but writing a file in place also changes the base,
+                  so files below private_paths are copied instead; use break_links() for others
+                - 'copy': plain copies with copy_file_range(2)
+                - 'auto' (default): 'reflink' if the filesystem supports it, else 'copy'
+            private_paths: Paths copied rather than hardlinked by the 'hardlink' strategy
+                (default: /etc, /var, /root, /home, /tmp and /run)
+            workers: Number of threads (default: the number of CPUs plus 4, at most 32)
+
+        Returns:
+            A chorut.clone.CloneResult with the strategy used, file and directory counts,
+            bytes_copied, bytes_shared and the duration in seconds
+
+        Raises:
+            ChrootError: If the clone cannot be made with the requested strategy
+        """
+        from .clone import DEFAULT_PRIVATE_PATHS, clone_tree
+
+        return clone_tree(
+            base, dest, strategy, DEFAULT_PRIVATE_PATHS if private_paths is None else private_paths, workers
+        )
+
+    def break_links(self, *paths: str | Path) -> int:
+        """
+        Give hardlinked files inside the chroot their own copy, so they can be written in place.
+
+        Use this on a 'hardlink' clone before modifying files that are shared
+        with its base. Each file is copied next to itself and renamed over the
+        original, keeping its mode, ownership and times.
+
+        Returns:
+            The number of files that were copied
+        """
+        count = 0
+        for path in paths:
+            parent, name = os.path.split(str(path).rstrip("/"))
+            try:
+                parent_fd = self._open_in_root(parent or "/", os.O_PATH | os.O_DIRECTORY)
+                try:
+                    src_fd = os.open(name, os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=parent_fd)
+                    try:
+                        st = os.fstat(src_fd)
+                        if not stat.S_ISREG(st.st_mode) or st.st_nlink == 1:
+                            continue
+                        tmp = f".{name}.chorut-{os.getpid()}"
+                        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, 0o600, dir_fd=parent_fd)
+                        try:
+                            if not _syscalls().reflink(src_fd, fd):
+                                _syscalls().copy_fd(src_fd, fd)
+                            if os.geteuid() == 0:
+                                os.fchown(fd, st.st_uid, st.st_gid)
+                            os.fchmod(fd, stat.S_IMODE(st.st_mode))
+                            os.utime(fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+                        finally:
+                            os.close(fd)
+                        os.rename(tmp, name, src_dir_fd=parent_fd, dst_dir_fd=parent_fd)
+                        count += 1
+                    finally:
+                        os.close(src_fd)
+                finally:
+                    os.close(parent_fd)
+            except OSError as e:
+                raise ChrootError(f"Failed to break links of {path}: {e}") from None
+        return count
+
+    def run_graph(
+        self,
+        steps: Iterable["Step | dict[str, Any]"],
+        jobs: int | None = None,
+        log_dir: str | Path | None = None,
+        on_output: Callable[[str, bytes], None] | None = None,
+    ) -> "GraphReport":
+        """
+        Run a graph of dependent commands, running independent steps in parallel.
+
+        A step starts once all of its dependencies succeeded. When a step fails,
+        every step that depends on it, directly or not, is skipped; the other
+        branches keep running. Steps that become ready together start in order
+        of the length of the chain of steps waiting on them.
+
+        Args:
+            steps: chorut.graph.Step objects or dicts with keys:
+                - name: Unique step name (required)
+                - command: Command to execute, as accepted by execute() (required)
+                - deps: Names of the steps that must succeed first (optional)
+                - userspec: User specification for this step (optional)
+                - timeout: Seconds after which the step is killed (optional)
+            jobs: Maximum number of steps running at once (default: the number of CPUs)
+            log_dir: Directory to stream each step's stdout and stderr to, as <name>.log;
+                without it the output is kept in the report
+            on_output: Called with the step name and each chunk of output as it arrives
+
+        Returns:
+            A chorut.graph.GraphReport with per-step status, exit code and timings, and the
+            critical path: the chain of dependent steps with the largest total duration
+
+        Raises:
+            GraphError: If the steps do not form a valid graph
+        """
+        from .graph import run_graph
+
+        if not self._is_setup:
+            raise ChrootError("Chroot environment not set up. Call setup() first.")
+        return run_graph(self, steps, jobs, log_dir, on_output)
+
+    def prefetch(self, workers: int = 16) -> "PrefetchResult":
+        """
+        Read the files of the prefetch profile into the page cache.
+
+        setup() runs this in the background; it can also be called directly,
+        e.g. to warm the cache before setup(). Files that no longer exist are
+        dropped from the profile.
+
+        Args:
+            workers: Number of threads opening files in parallel
+
+        Returns:
+            A chorut.prefetch.PrefetchResult
+        """
+        from .prefetch import PrefetchResult, prefetch
+
+        if self.profile is None:
+            return PrefetchResult()
+        try:
+            result = prefetch(self.chroot_dir, list(self.profile.files), workers)
+        except OSError as e:
+            logger.warning(f"Prefetching files of {self.chroot_dir} failed: {e}")
+            return PrefetchResult()
+        self.profile.discard(result.missing)
+        logger.debug(
+            f"Prefetched {result.files} files ({result.bytes} bytes) of {self.chroot_dir} in {result.duration:.3f}s"
+        )
+        return result
+
+    def snapshot(self, hash: bool = False, base: "Manifest | None" = None) -> "Manifest":
+        """
+        Record the state of every file in chroot_dir.
 
-            env = os.environ.copy()
-            env["SHELL"] = "/bin/bash"
+        The scan is incremental: directories whose mtime did not change since
+        base (or since the last snapshot taken by this manager) are not read
+        again. Mounted filesystems below chroot_dir, like /proc, are skipped.
+        Save the result with Manifest.save() to reuse it across runs.
 
-            return subprocess.run(chroot_cmd, check=False, env=env, capture_output=capture_output, text=text)
+        Args:
+            hash: Whether to record the SHA-256 of regular files, so that files
+                whose content did not change are not reported as modified
+            base: A previous manifest to scan incrementally from
+
+        Returns:
+            A chorut.manifest.Manifest
+        """
+        from .manifest import scan
+
+        self._check_chroot_dir()
+        manifest = scan(self.chroot_dir, base if base is not None else self._manifest, hash=hash)
+        self._manifest = manifest
+        return manifest
+
+    def diff_since(self, snapshot: "Manifest") -> "ManifestDiff":
+        """
+        Return the paths created, modified and deleted since a snapshot.
+
+        Example:
+            before = chroot.snapshot()
+            chroot.execute('make install')
+            changes = chroot.diff_since(before)
+            print(sorted(changes.created))
+        """
+        base = self._manifest if self._manifest is not None else snapshot
+        current = self.snapshot(hash=snapshot.hashed, base=base)
+        return snapshot.diff(current)
 
     def __enter__(self):
         self.setup()
@@ -667,9 +2496,47 @@ class ChrootManager:
         self.teardown()
 
 
+def _parse_mount_option(mount_spec: str) -> dict[str, Any]:
+    """Parse a SOURCE:TARGET[:OPTIONS] command-line mount into a mount specification dict."""
+    parts = mount_spec.split(":")
+    if len(parts) < 2:
+        raise ValueError(f"Invalid mount specification '{mount_spec}'. Format: source:target[:options]")
+
+    mount_dict: dict[str, Any] = {
+        "source": parts[0],
+        "target": parts[1],
+    }
+
+    # Parse options if provided; an idmap contains colons itself
+    if len(parts) > 2:
+        options = []
+        for option in ":".join(parts[2:]).split(","):
+            if option.startswith("idmap="):
+                mount_dict["idmap"] = option.removeprefix("idmap=")
+            else:
+                options.append(option)
+        options = ",".join(options)
+        if "bind" in options:
+            mount_dict["bind"] = True
+        if options:
+            mount_dict["options"] = options
+
+    return mount_dict
+
+
 # Main entry point for command-line usage
 def main():
     """Command-line interface for chorut."""
+    # Only the bare words are subcommands: a chroot directory called serve or import is given as ./serve or ./import
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        from .server import main as serve_main
+
+        return serve_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "import":
+        from .image import main as import_main
+
+        return import_main(sys.argv[2:])
+
     import argparse
 
     parser = argparse.ArgumentParser(
@@ -678,6 +2545,17 @@ def main():
         epilog="""
 If 'command' is unspecified, chorut will launch /bin/bash.
 
+Use 'chorut serve --help' to run chorut as a daemon that keeps chroots set up, and
+'chorut import --help' to build a chroot directory from OCI images or layer tarballs.
+To chroot into a directory named 'serve' or 'import' in the current directory,
+give it as './serve' or './import'.
+
+With --batch, commands are read one per line from FILE (or stdin for '-') and
+run against a single setup. Lines may also be JSON objects such as
+{"command": ["make", "-j4"], "id": "build", "userspec": "builder", "capture": true}.
+Commands read /dev/null, or the "stdin" string of their JSON line.
+One JSON result line with the exit code and duration is written to stdout per command.
+
 Note that when using chorut, the target chroot directory *should* be a
 mountpoint. This ensures that tools such as pacman(8) or findmnt(8) have an
 accurate hierarchy of the mounted filesystems within the chroot.
@@ -701,43 +2579,106 @@ itself to make it a mountpoint, i.e. 'mount --bind /your/chroot /your/chroot'.
         metavar="SOURCE:TARGET[:OPTIONS]",
         help="Add custom mount (can be used multiple times). Format: source:target[:options]",
     )
+    parser.add_argument(
+        "-p",
+        "--profile",
+        choices=list(SETUP_PROFILES),
+        default="full",
+        help="Standard mounts to set up: minimal (proc, dev), build (no sys, efivarfs and run) or full (default)",
+    )
+    parser.add_argument(
+        "--with",
+        dest="with_mounts",
+        action="append",
+        choices=STANDARD_MOUNTS,
+        metavar="MOUNT",
+        help="Also set up a standard mount the profile leaves out (can be used multiple times)",
+    )
+    parser.add_argument(
+        "--without",
+        dest="without_mounts",
+        action="append",
+        choices=STANDARD_MOUNTS,
+        metavar="MOUNT",
+        help="Leave out a standard mount of the profile (can be used multiple times)",
+    )
+    parser.add_argument(
+        "-b", "--batch", metavar="FILE", help="Run commands read one per line from FILE ('-' for stdin)"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, metavar="N", help="Number of batch commands to run in parallel"
+    )
+    parser.add_argument(
+        "--capture", action="store_true", help="Include command output in batch results instead of stderr"
+    )
+    parser.add_argument(
+        "--exec",
+        action="store_true",
+        help="Replace chorut with the command instead of waiting for it; teardown is left to a reaper process",
+    )
+    parser.add_argument(
+        "--process-stats",
+        action="store_true",
+        help="Sample the CPU time, memory and I/O of the processes of the command and print a summary to stderr",
+    )
+    parser.add_argument(
+        "--process-interval",
+        type=float,
+        default=0.1,
+        metavar="SECONDS",
+        help="Seconds between two samples of --process-stats (default: 0.1)",
+    )
 
     args = parser.parse_args()
 
+    if args.batch and args.command:
+        parser.error("a command cannot be combined with --batch")
+    if args.batch and args.exec:
+        parser.error("--exec cannot be combined with --batch")
+    if args.process_stats and (args.batch or args.exec):
+        parser.error("--process-stats cannot be combined with --batch or --exec")
+    if args.process_interval <= 0:
+        parser.error("--process-interval must be positive")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
 
     # Parse custom mounts
-    custom_mounts = []
-    if args.mount:
-        for mount_spec in args.mount:
-            parts = mount_spec.split(":")
-            if len(parts) < 2:
-                print(
-                    f"Error: Invalid mount specification '{mount_spec}'. Format: source:target[:options]",
-                    file=sys.stderr,
-                )
-                return 1
-
-            mount_dict = {
-                "source": parts[0],
-                "target": parts[1],
-            }
-
-            # Parse options if provided
-            if len(parts) > 2:
-                options = parts[2]
-                if "bind" in options:
-                    mount_dict["bind"] = True
-                mount_dict["options"] = options
+    try:
+        custom_mounts = [_parse_mount_option(mount_spec) for mount_spec in args.mount or []]
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
 
-            custom_mounts.append(mount_dict)
+    standard_mounts = dict.fromkeys(args.with_mounts or [], True)
+    standard_mounts.update(dict.fromkeys(args.without_mounts or [], False))
 
     try:
-        with ChrootManager(args.chroot_dir, unshare_mode=args.unshare, custom_mounts=custom_mounts) as chroot:
+        with ChrootManager(
+            args.chroot_dir,
+            unshare_mode=args.unshare,
+            custom_mounts=custom_mounts,
+            setup_profile=args.profile,
+            standard_mounts=standard_mounts,
+            process_sampling=args.process_interval if args.process_stats else None,
+        ) as chroot:
+            if args.batch:
+                from .batch import run_batch
+
+                with contextlib.ExitStack() as stack:
+                    lines = sys.stdin if args.batch == "-" else stack.enter_context(open(args.batch))
+                    return run_batch(chroot, lines, jobs=args.jobs, userspec=args.userspec, capture=args.capture)
+
+            if args.exec:
+                chroot.exec(args.command if args.command else None, userspec=args.userspec)
+
             result = chroot.execute(args.command if args.command else None, userspec=args.userspec)
+            if args.process_stats:
+                print(result.processes.format(), file=sys.stderr)
             return result.returncode
-    except ChrootError as e:
+    except (ChrootError, MountError, OSError) as e:
         print(f"Error: {e}", file=sys.stderr)
         return 1
     except KeyboardInterrupt:
@@ -748,8 +2689,12 @@ if __name__ == "__main__":
     sys.exit(main())
 
 __all__ = [
+    "SETUP_PROFILES",
+    "STANDARD_MOUNTS",
     "ChrootError",
     "ChrootManager",
     "MountError",
     "MountManager",
+    "MountSpec",
+    "compile_mounts",
 ]
@@ -0,0 +1,461 @@
+"""
+Thin wrappers around Linux system calls that the os module does not expose.
+
+Everything here is private to chorut. The wrappers raise OSError with the
+errno reported by the kernel, just like the functions in the os module.
+"""
+
+import contextlib
+import ctypes
+import errno as _errno
+import fcntl
+import os
+import struct
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+# unshare(2) flags
+CLONE_NEWNS = 0x00020000
+CLONE_NEWUSER = 0x10000000
+CLONE_NEWPID = 0x20000000
+
+# mount(2) flags
+MS_RDONLY = 0x1
+MS_NOSUID = 0x2
+MS_NODEV = 0x4
+MS_NOEXEC = 0x8
+MS_SYNCHRONOUS = 0x10
+MS_REMOUNT = 0x20
+MS_NOATIME = 0x400
+MS_NODIRATIME = 0x800
+MS_BIND = 0x1000
+MS_REC = 0x4000
+MS_PRIVATE = 0x40000
+MS_SLAVE = 0x80000
+MS_RELATIME = 0x200000
+MS_STRICTATIME = 0x1000000
+
+# umount2(2) flags
+MNT_DETACH = 0x2
+
+# openat2(2) resolve flags
+RESOLVE_NO_MAGICLINKS = 0x02
+RESOLVE_IN_ROOT = 0x10
+
+# The same numbers on every architecture, since they were allocated after the syscall tables were unified
+SYS_OPEN_TREE = 428
+SYS_MOVE_MOUNT = 429
+SYS_OPENAT2 = 437
+SYS_MOUNT_SETATTR = 442
+
+# open_tree(2), move_mount(2) and mount_setattr(2) flags
+AT_FDCWD = -100
+OPEN_TREE_CLONE = 0x1
+AT_EMPTY_PATH = 0x1000
+AT_RECURSIVE = 0x8000
+MOVE_MOUNT_F_EMPTY_PATH = 0x4
+MOUNT_ATTR_RDONLY = 0x1
+MOUNT_ATTR_NOSUID = 0x2
+MOUNT_ATTR_NODEV = 0x4
+MOUNT_ATTR_NOEXEC = 0x8
+MOUNT_ATTR_IDMAP = 0x100000
+
+# Mount options that can be set on an idmapped bind mount
+MOUNT_ATTR_OPTIONS = {
+    "ro": MOUNT_ATTR_RDONLY,
+    "nosuid": MOUNT_ATTR_NOSUID,
+    "nodev": MOUNT_ATTR_NODEV,
+    "noexec": MOUNT_ATTR_NOEXEC,
+}
+
+# ioctl(2) request to share the extents of another file (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# Loop device ioctl(2) requests and flags
+LOOP_SET_FD = 0x4C00
+LOOP_CLR_FD = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_SET_DIRECT_IO = 0x4C08
+LOOP_CONFIGURE = 0x4C0A
+LOOP_CTL_GET_FREE = 0x4C82
+LO_FLAGS_READ_ONLY = 1
+LO_FLAGS_AUTOCLEAR = 4
+LO_FLAGS_DIRECT_IO = 16
+
+# struct loop_info64, and struct loop_config (fd, block_size, loop_info64, 64 reserved bytes)
+_LOOP_INFO64 = struct.Struct("=QQQQQIIII64s64s32s2Q")
+_LOOP_CONFIG = struct.Struct(f"=II{_LOOP_INFO64.size}s64x")
+
+# Errors that mean "this copy method is not available here", as opposed to a real I/O failure
+_UNSUPPORTED = {_errno.ENOSYS, _errno.EXDEV, _errno.EINVAL, _errno.EOPNOTSUPP, _errno.ENOTTY, _errno.EPERM}
+
+_MAX_SYMLINKS = 40
+
+# Mount options understood by mount(8) that map to mount(2) flags rather than
+# being passed through to the filesystem as data.
+_OPTION_FLAGS = {
+    "ro": (MS_RDONLY, True),
+    "rw": (MS_RDONLY, False),
+    "nosuid": (MS_NOSUID, True),
+    "suid": (MS_NOSUID, False),
+    "nodev": (MS_NODEV, True),
+    "dev": (MS_NODEV, False),
+    "noexec": (MS_NOEXEC, True),
+    "exec": (MS_NOEXEC, False),
+    "sync": (MS_SYNCHRONOUS, True),
+    "async": (MS_SYNCHRONOUS, False),
+    "noatime": (MS_NOATIME, True),
+    "atime": (MS_NOATIME, False),
+    "nodiratime": (MS_NODIRATIME, True),
+    "diratime": (MS_NODIRATIME, False),
+    "relatime": (MS_RELATIME, True),
+    "norelatime": (MS_RELATIME, False),
+    "strictatime": (MS_STRICTATIME, True),
+    "rbind": (MS_BIND | MS_REC, True),
+    "bind": (MS_BIND, True),
+}
+
+_libc.mount.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p]
+_libc.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+_libc.unshare.argtypes = [ctypes.c_int]
+_libc.syscall.restype = ctypes.c_long
+
+_openat2_supported = True
+
+
+def _encode(value: str | None) -> bytes | None:
+    return os.fsencode(value) if value is not None else None
+
+
+def _raise_errno(what: str, filename: str | None = None) -> None:
+    errno = ctypes.get_errno()
+    if filename is not None:
+        raise OSError(errno, os.strerror(errno), filename)
+    raise OSError(errno, f"{what}: {os.strerror(errno)}")
+
+
+def parse_mount_options(options: str | None) -> tuple[int, str | None]:
+    """Split a mount(8) style option string into mount(2) flags and filesystem data."""
+    flags = 0
+    data = []
+    for option in (options or "").split(","):
+        option = option.strip()
+        if not option:
+            continue
+        if option in _OPTION_FLAGS:
+            flag, enable = _OPTION_FLAGS[option]
+            flags = flags | flag if enable else flags & ~flag
+        else:
+            data.append(option)
+    return flags, ",".join(data) or None
+
+
+def mount(source: str | None, target: str, fstype: str | None = None, flags: int = 0, data: str | None = None) -> None:
+    """Call mount(2) directly."""
+    if _libc.mount(_encode(source), _encode(target), _encode(fstype), flags, _encode(data)) != 0:
+        _raise_errno(f"mount {source} on {target}")
+
+
+def mount_options(
+    source: str, target: str, fstype: str | None = None, options: str | None = None, bind: bool = False
+) -> None:
+    """
+    Mount with a mount(8) style option string.
+
+    Bind mounts ignore most flags on the initial mount, so they are applied
+    with a follow-up remount just like mount(8) does.
+    """
+    flags, data = parse_mount_options(options)
+    if bind:
+        flags |= MS_BIND
+    if flags & MS_BIND:
+        mount(source, target, None, flags & (MS_BIND | MS_REC))
+        extra = flags & ~(MS_BIND | MS_REC)
+        if extra:
+            mount(None, target, None, MS_REMOUNT | MS_BIND | extra)
+    else:
+        mount(source, target, fstype, flags, data)
+
+
+def umount(target: str, flags: int = 0) -> None:
+    """Call umount2(2) directly."""
+    if _libc.umount2(_encode(target), flags) != 0:
+        _raise_errno(f"umount {target}")
+
+
+def unshare(flags: int) -> None:
+    """Call unshare(2) directly."""
+    if _libc.unshare(flags) != 0:
+        _raise_errno("unshare")
+
+
+def openat2(dirfd: int, path: str, flags: int, mode: int = 0, resolve: int = 0) -> int:
+    """Call openat2(2) directly and return the new file descriptor."""
+    how = struct.pack("QQQ", flags, mode, resolve)
+    fd = _libc.syscall(
+        ctypes.c_long(SYS_OPENAT2),
+        ctypes.c_int(dirfd),
+        ctypes.c_char_p(os.fsencode(path)),
+        ctypes.c_char_p(how),
+        ctypes.c_size_t(len(how)),
+    )
+    if fd < 0:
+        _raise_errno("openat2", path)
+    return fd
+
+
+def _open_in_root_walk(root_fd: int, path: str, flags: int, mode: int) -> int:
+    """Resolve path relative to root_fd one component at a time, treating root_fd as '/'."""
+    parts = [part for part in path.split("/") if part and part != "."]
+    stack = [os.dup(root_fd)]
+    links = 0
+    try:
+        while parts:
+            name = parts.pop(0)
+            if name == "..":
+                if len(stack) > 1:
+                    os.close(stack.pop())
+                continue
+
+            try:
+                target = os.readlink(name, dir_fd=stack[-1])
+            except OSError as e:
+                if e.errno not in (_errno.EINVAL, _errno.ENOENT) or (e.errno == _errno.ENOENT and parts):
+                    raise
+                target = None
+
+            if target is not None:
+                links += 1
+                if links > _MAX_SYMLINKS:
+                    raise OSError(_errno.ELOOP, os.strerror(_errno.ELOOP), path)
+                if target.startswith("/"):
+                    while len(stack) > 1:
+                        os.close(stack.pop())
+                parts[:0] = [part for part in target.split("/") if part and part != "."]
+                continue
+
+            if not parts:
+                return os.open(name, flags | os.O_NOFOLLOW | os.O_CLOEXEC, mode, dir_fd=stack[-1])
+            stack.append(os.open(name, os.O_PATH | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=stack[-1]))
+
+        return os.open(".", flags | os.O_CLOEXEC, mode, dir_fd=stack[-1])
+    finally:
+        for fd in stack:
+            os.close(fd)
+
+
+def open_in_root(root_fd: int, path: str, flags: int, mode: int = 0o666) -> int:
+    """
+    Open path as if root_fd were the root directory.
+
+    Absolute symlinks and '..' components cannot climb above root_fd. Uses
+    openat2(2) with RESOLVE_IN_ROOT when the kernel supports it, and an
+    equivalent component-by-component walk otherwise.
+    """
+    global _openat2_supported
+
+    path = path or "/"
+    if _openat2_supported:
+        try:
+            return openat2(
+                root_fd,
+                path,
+                flags | os.O_CLOEXEC,
+                mode if flags & os.O_CREAT else 0,
+                RESOLVE_IN_ROOT | RESOLVE_NO_MAGICLINKS,
+            )
+        except OSError as e:
+            if e.errno not in (_errno.ENOSYS, _errno.EPERM):
+                raise
+            _openat2_supported = False
+    return _open_in_root_walk(root_fd, path, flags, mode)
+
+
+def reflink(src_fd: int, dst_fd: int) -> bool:
+    """Make dst_fd share the extents of src_fd. Returns False if the filesystem cannot do it."""
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except OSError as e:
+        if e.errno in _UNSUPPORTED:
+            return False
+        raise
+
+
+def copy_fd(src_fd: int, dst_fd: int) -> int:
+    """
+    Copy everything from the current offset of src_fd to dst_fd and return the byte count.
+
+    Tries copy_file_range(2), then sendfile(2), then a plain read/write loop,
+    so data stays in the kernel whenever possible.
+    """
+    chunk = 1 << 30
+    total = 0
+
+    try:
+        while copied := os.copy_file_range(src_fd, dst_fd, chunk):
+            total += copied
+        return total
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED:
+            raise
+
+    try:
+        while copied := os.sendfile(dst_fd, src_fd, None, chunk):
+            total += copied
+        return total
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED:
+            raise
+
+    while data := os.read(src_fd, 1 << 20):
+        view = memoryview(data)
+        while view:
+            written = os.write(dst_fd, view)
+            view = view[written:]
+        total += len(data)
+    return total
+
+
+def loop_attach(path: str, read_only: bool = True, direct_io: bool = True) -> tuple[str, int]:
+    """
+    Attach a file to a free loop device.
+
+    LOOP_CONFIGURE sets the file and flags in one step; on kernels before 5.8
+    LOOP_SET_FD and LOOP_SET_STATUS64 are used instead. The device is set to
+    autoclear, so the kernel detaches it once it is unmounted and closed; the
+    returned descriptor keeps it attached until the caller has mounted it.
+
+    Returns:
+        The device path and an open descriptor of it, which the caller must close
+    """
+    mode = os.O_RDONLY if read_only else os.O_RDWR
+    lo_flags = LO_FLAGS_AUTOCLEAR | (LO_FLAGS_READ_ONLY if read_only else 0) | (LO_FLAGS_DIRECT_IO if direct_io else 0)
+    info = _LOOP_INFO64.pack(0, 0, 0, 0, 0, 0, 0, 0, lo_flags, os.fsencode(path)[:63], b"", b"", 0, 0)
+
+    backing_fd = os.open(path, mode | os.O_CLOEXEC)
+    try:
+        control_fd = os.open("/dev/loop-control", os.O_RDWR | os.O_CLOEXEC)
+        try:
+            # Another process can take the free device between GET_FREE and CONFIGURE
+            for _ in range(64):
+                device = f"/dev/loop{fcntl.ioctl(control_fd, LOOP_CTL_GET_FREE)}"
+                device_fd = os.open(device, mode | os.O_CLOEXEC)
+                try:
+                    fcntl.ioctl(device_fd, LOOP_CONFIGURE, _LOOP_CONFIG.pack(backing_fd, 0, info))
+                    return device, device_fd
+                except OSError as e:
+                    if e.errno == _errno.EBUSY:
+                        os.close(device_fd)
+                        continue
+                    if e.errno not in (_errno.EINVAL, _errno.ENOTTY):
+                        os.close(device_fd)
+                        raise
+
+                try:
+                    fcntl.ioctl(device_fd, LOOP_SET_FD, backing_fd)
+                except OSError as e:
+                    os.close(device_fd)
+                    if e.errno == _errno.EBUSY:
+                        continue
+                    raise
+                try:
+                    fcntl.ioctl(device_fd, LOOP_SET_STATUS64, info)
+                    if direct_io:
+                        with contextlib.suppress(OSError):
+                            fcntl.ioctl(device_fd, LOOP_SET_DIRECT_IO, 1)
+                except OSError:
+                    with contextlib.suppress(OSError):
+                        fcntl.ioctl(device_fd, LOOP_CLR_FD)
+                    os.close(device_fd)
+                    raise
+                return device, device_fd
+        finally:
+            os.close(control_fd)
+    finally:
+        os.close(backing_fd)
+    raise OSError(_errno.EBUSY, "No free loop device", path)
+
+
+def user_namespace(uid_map: str, gid_map: str) -> int:
+    """
+    Create a user namespace with the given id mappings and return a descriptor for it.
+
+    The maps use the /proc/<pid>/uid_map format, one "inside outside count"
+    line per range. Mapping ids other than our own needs CAP_SETUID and
+    CAP_SETGID.
+    """
+    ready_r, ready_w = os.pipe()
+    done_r, done_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # The child only holds the namespace open until the parent has a descriptor for it
+        try:
+            os.close(ready_r)
+            os.close(done_w)
+            unshare(CLONE_NEWUSER)
+            os.write(ready_w, b"1")
+            os.read(done_r, 1)
+        finally:
+            os._exit(0)
+
+    os.close(ready_w)
+    os.close(done_r)
+    try:
+        if os.read(ready_r, 1) != b"1":
+            raise OSError(_errno.EPERM, "Cannot create a user namespace")
+        for name, content in (("uid_map", uid_map), ("gid_map", gid_map)):
+            fd = os.open(f"/proc/{pid}/{name}", os.O_WRONLY | os.O_CLOEXEC)
+            try:
+                # The kernel only accepts the whole map in a single write
+                os.write(fd, content.encode())
+            finally:
+                os.close(fd)
+        return os.open(f"/proc/{pid}/ns/user", os.O_RDONLY | os.O_CLOEXEC)
+    finally:
+        os.close(ready_r)
+        os.close(done_w)
+        os.waitpid(pid, 0)
+
+
+def bind_idmapped(source: str, target: str, userns_fd: int, attr_set: int = 0) -> None:
+    """
+    Bind mount source at target with ownership mapped through a user namespace.
+
+    The bind mount is created detached with open_tree(2), marked idmapped
+    with mount_setattr(2) and attached with move_mount(2), as a mount must
+    not be visible yet when it is idmapped.
+    """
+    tree_fd = _libc.syscall(
+        ctypes.c_long(SYS_OPEN_TREE),
+        ctypes.c_int(AT_FDCWD),
+        ctypes.c_char_p(os.fsencode(source)),
+        ctypes.c_uint(OPEN_TREE_CLONE | os.O_CLOEXEC),
+    )
+    if tree_fd < 0:
+        _raise_errno("open_tree", source)
+    try:
+        # struct mount_attr: attr_set, attr_clr, propagation, userns_fd
+        attr = struct.pack("QQQQ", attr_set | MOUNT_ATTR_IDMAP, 0, 0, userns_fd)
+        result = _libc.syscall(
+            ctypes.c_long(SYS_MOUNT_SETATTR),
+            ctypes.c_int(tree_fd),
+            ctypes.c_char_p(b""),
+            ctypes.c_uint(AT_EMPTY_PATH),
+            ctypes.c_char_p(attr),
+            ctypes.c_size_t(len(attr)),
+        )
+        if result < 0:
+            _raise_errno("mount_setattr", source)
+        result = _libc.syscall(
+            ctypes.c_long(SYS_MOVE_MOUNT),
+            ctypes.c_int(tree_fd),
+            ctypes.c_char_p(b""),
+            ctypes.c_int(AT_FDCWD),
+            ctypes.c_char_p(os.fsencode(target)),
+            ctypes.c_uint(MOVE_MOUNT_F_EMPTY_PATH),
+        )
+        if result < 0:
+            _raise_errno("move_mount", target)
+    finally:
+        os.close(tree_fd)
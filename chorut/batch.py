@@ -0,0 +1,175 @@
+"""
+Batch execution of many commands against a single chroot setup.
+
+Used by 'chorut --batch'. Commands are read one per line, either as plain
+command strings or as JSON objects with per-command options, and results
+are written as JSON lines.
+"""
+
+import json
+import logging
+import subprocess
+import sys
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, TextIO
+
+from . import ChrootError, ChrootManager
+
+logger = logging.getLogger(__name__)
+
+# Keys accepted in a JSON batch line
+BATCH_KEYS = {"command", "id", "userspec", "capture", "stdin"}
+
+
+class BatchError(ChrootError):
+    """Exception raised for malformed batch input."""
+
+    pass
+
+
+def parse_batch_line(line: str) -> dict[str, Any] | None:
+    """
+    Parse one line of batch input.
+
+    Blank lines and lines starting with '#' are ignored (None is returned).
+    Lines starting with '{' are JSON objects with a required 'command' (a
+    string or a list of strings) and optional 'id', 'userspec', 'capture' and
+    'stdin' (a string fed to the command) keys. Any other line is a command
+    string.
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+
+    if not line.startswith("{"):
+        return {"command": line}
+
+    try:
+        entry = json.loads(line)
+    except json.JSONDecodeError as e:
+        raise BatchError(f"Invalid JSON batch line: {e}") from None
+
+    if not isinstance(entry, dict) or "command" not in entry:
+        raise BatchError("JSON batch line must be an object with a 'command' key")
+    unknown = set(entry) - BATCH_KEYS
+    if unknown:
+        raise BatchError(f"Unknown batch keys: {', '.join(sorted(unknown))}")
+    command = entry["command"]
+    if not isinstance(command, str) and not (
+        isinstance(command, list) and all(isinstance(arg, str) for arg in command)
+    ):
+        raise BatchError("'command' must be a string or a list of strings")
+    if not isinstance(entry.get("stdin", ""), str):
+        raise BatchError("'stdin' must be a string")
+    return entry
+
+
+def _run_entry(
+    chroot: ChrootManager, index: int, entry: dict[str, Any], userspec: str | None, capture: bool
+) -> dict[str, Any]:
+    """Run a single batch entry and build its result record."""
+    record: dict[str, Any] = {"line": index}
+    if "id" in entry:
+        record["id"] = entry["id"]
+    command = entry["command"]
+    record["command"] = command
+    entry_userspec = entry.get("userspec", userspec)
+    captured = entry.get("capture", capture)
+    # Never the batch's own stdin, which may be the batch input itself ('--batch -')
+    data = entry.get("stdin")
+    start = time.monotonic()
+    try:
+        if captured:
+            stdin = subprocess.DEVNULL if data is None else data
+            result = chroot.execute(command, userspec=entry_userspec, capture_output=True, stdin=stdin)
+            returncode = result.returncode
+        else:
+            # Keep stdout for the JSON results; the command's own output streams to stderr as it is written
+            sys.stderr.flush()
+            stdin = subprocess.DEVNULL if data is None else subprocess.PIPE
+            with chroot.popen(command, entry_userspec, stdin=stdin, stdout=sys.stderr, stderr=sys.stderr) as process:
+                process.communicate(None if data is None else data.encode())
+                returncode = process.returncode
+    except Exception as e:
+        record["returncode"] = None
+        record["error"] = str(e)
+        record["duration"] = round(time.monotonic() - start, 6)
+        return record
+
+    record["returncode"] = returncode
+    record["duration"] = round(time.monotonic() - start, 6)
+    if captured:
+        record["stdout"] = result.stdout
+        record["stderr"] = result.stderr
+    return record
+
+
+def run_batch(
+    chroot: ChrootManager,
+    lines: Iterable[str],
+    jobs: int = 1,
+    output: TextIO | None = None,
+    userspec: str | None = None,
+    capture: bool = False,
+) -> int:
+    """
+    Run batch commands against an already set up chroot.
+
+    At most `jobs` commands run at the same time, and input is only read as
+    fast as commands complete, so arbitrarily long streams can be processed.
+    A JSON line with line (the input line number), id, command, returncode
+    and duration (in seconds) is written to output as each command finishes.
+    Captured output is included as stdout/stderr when capture is set
+    (globally or per line); otherwise the command writes it straight to
+    stderr while it runs. Commands read the line's 'stdin' string, or
+    /dev/null.
+
+    Returns:
+        0 if every command succeeded, 1 otherwise
+    """
+    output = output or sys.stdout
+    jobs = max(1, jobs)
+    write_lock = threading.Lock()
+    slots = threading.BoundedSemaphore(jobs)
+    failed = False
+
+    def emit(record: dict[str, Any]) -> None:
+        nonlocal failed
+        if record.get("returncode") != 0:
+            failed = True
+        with write_lock:
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+
+    def task(index: int, entry: dict[str, Any]) -> None:
+        try:
+            emit(_run_entry(chroot, index, entry, userspec, capture))
+        finally:
+            slots.release()
+
+    def entries() -> Iterator[tuple[int, dict[str, Any] | None, str | None]]:
+        for index, line in enumerate(lines, 1):
+            try:
+                entry = parse_batch_line(line)
+            except BatchError as e:
+                yield index, None, str(e)
+                continue
+            if entry is not None:
+                yield index, entry, None
+
+    start = time.monotonic()
+    count = 0
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for index, entry, error in entries():
+            count += 1
+            if entry is None:
+                emit({"line": index, "returncode": None, "error": error})
+                continue
+            slots.acquire()
+            pool.submit(task, index, entry)
+
+    logger.debug(f"Batch of {count} commands finished in {time.monotonic() - start:.3f}s with {jobs} jobs")
+    return 1 if failed else 0
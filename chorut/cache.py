@@ -0,0 +1,464 @@
+"""
+Content-addressed cache of chroot command results.
+
+An action is a command run with a given argv, environment, userspec, set of
+declared input paths and mount configuration. Its key is a SHA-256 over all
+of these, including the contents of every input file. The stored result is
+the exit code, the captured stdout and stderr, and the declared output files,
+each kept as a blob named after its own SHA-256, so identical outputs of
+different actions are stored once.
+
+The store lives in a plain directory:
+
+    actions/<key>.json    exit code, output digests and output file metadata
+    blobs/<xx>/<digest>   file contents and captured output
+
+Entries are evicted least recently used first once the store grows beyond
+its size limit; a hit refreshes the mtime of the action and its blobs.
+"""
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections.abc import Iterable
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from . import ChrootError, _linux
+
+if TYPE_CHECKING:
+    from . import ChrootManager
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the key derivation or the record format changes
+_FORMAT = 4
+
+# Standard mounts that unshare mode makes inside the namespace of each command, by target
+_NAMESPACE_MOUNTS = {
+    "proc": "proc",
+    "sys": "sys",
+    "dev": "dev",
+    "devpts": "dev/pts",
+    "shm": "dev/shm",
+    "run": "run",
+    "tmp": "tmp",
+}
+
+
+def _write_output(stream: Any, data: bytes) -> None:
+    """Write command output to a stream, which may be a replacement of sys.stdout without a binary buffer."""
+    stream.flush()
+    buffer = getattr(stream, "buffer", None)
+    if buffer is not None:
+        buffer.write(data)
+        buffer.flush()
+    else:
+        stream.write(data.decode(errors="replace"))
+        stream.flush()
+
+
+class ActionCache:
+    """A local content-addressed store of command results."""
+
+    def __init__(
+        self,
+        directory: str | Path,
+        max_size: int = 1 << 30,
+        env_keys: Iterable[str] | None = None,
+        cache_failures: bool = False,
+    ):
+        """
+        Open (and create if needed) an action cache.
+
+        Args:
+            directory: Directory holding the store
+            max_size: Size in bytes above which least recently used entries are evicted
+            env_keys: Environment variables that take part in the key (default: the whole environment)
+            cache_failures: Whether results with a non-zero exit code are stored too
+        """
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.env_keys = None if env_keys is None else sorted(set(env_keys))
+        self.cache_failures = cache_failures
+        self.hits = 0
+        self.misses = 0
+        self._actions = self.directory / "actions"
+        self._blobs = self.directory / "blobs"
+        self._actions.mkdir(parents=True, exist_ok=True)
+        self._blobs.mkdir(parents=True, exist_ok=True)
+        self._size: int | None = None
+        self._lock = threading.Lock()
+        # (dev, ino, size, mtime_ns, ctime_ns) -> digest, so unchanged inputs are not read again
+        self._file_digests: dict[tuple[int, ...], str] = {}
+
+    # Keys
+
+    def _file_digest(self, chroot: "ChrootManager", path: str, st: os.stat_result) -> str:
+        identity = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+        digest = self._file_digests.get(identity)
+        if digest is None:
+            with chroot.open(path, "rb") as f:
+                digest = hashlib.file_digest(f, "sha256").hexdigest()
+            self._file_digests[identity] = digest
+        return digest
+
+    def _hash_input(self, chroot: "ChrootManager", path: str, h: "hashlib._Hash") -> None:
+        try:
+            st = chroot.stat(path, follow_symlinks=False)
+        except FileNotFoundError:
+            h.update(f"missing {path}\0".encode())
+            return
+
+        if stat.S_ISLNK(st.st_mode):
+            h.update(f"link {path} {chroot.readlink(path)}\0".encode())
+        elif stat.S_ISDIR(st.st_mode):
+            h.update(f"dir {path} {st.st_mode:o}\0".encode())
+            for name in sorted(chroot.listdir(path)):
+                self._hash_input(chroot, f"{path.rstrip('/')}/{name}", h)
+        elif stat.S_ISREG(st.st_mode):
+            h.update(f"file {path} {st.st_mode:o} {self._file_digest(chroot, path, st)}\0".encode())
+        else:
+            h.update(f"special {path} {st.st_mode:o} {st.st_rdev}\0".encode())
+
+    def action_key(
+        self,
+        chroot: "ChrootManager",
+        argv: list[str],
+        env: dict[str, str],
+        userspec: str | None,
+        inputs: Iterable[str | Path],
+        mounts: Iterable[str | Path] | None = None,
+        outputs: Iterable[str | Path] = (),
+    ) -> str:
+        """
+        Compute the key of an action.
+
+        Input paths are resolved inside the chroot. Directories are hashed
+        recursively; symlinks by their target, without following them. mounts
+        are the deferred custom mounts the command declares, as in execute().
+        The declared outputs are part of the key, since a record only holds
+        the outputs it was stored with.
+
+        Inputs are hashed from the host side. In unshare mode the standard
+        mounts and the custom mounts (other than idmapped ones) only exist
+        inside the namespace of each command, so inputs at or below them are
+        rejected, and directories above them are hashed without them.
+
+        Raises:
+            ChrootError: If an input is below a mount that only exists inside the namespace
+            MountError: If a declared mount is not the target of a custom mount
+        """
+        inputs = sorted({"/" + str(path).lstrip("/") for path in inputs})
+        if chroot.unshare_mode:
+            hidden = [_NAMESPACE_MOUNTS[name] for name in chroot.standard_mounts if name in _NAMESPACE_MOUNTS]
+            hidden += [spec.target for wave in chroot.mount_plan for spec in wave if not spec.idmap]
+            for path in inputs:
+                relative = path.lstrip("/")
+                for target in hidden:
+                    if relative == target or relative.startswith(f"{target}/"):
+                        raise ChrootError(
+                            f"Cannot hash input {path}: /{target} is only mounted inside the namespace of each command"
+                        )
+        if self.env_keys is not None:
+            env = {key: env[key] for key in self.env_keys if key in env}
+        h = hashlib.sha256()
+        header = {
+            "format": _FORMAT,
+            "argv": argv,
+            "env": sorted(env.items()),
+            "userspec": userspec,
+            "chroot_dir": str(chroot.chroot_dir),
+            "unshare_mode": chroot.unshare_mode,
+            "mounts": [[spec.astuple() for spec in wave] for wave in chroot.mount_plan],
+            "standard_mounts": list(chroot.standard_mounts),
+            "deferred": sorted(chroot._deferred_targets(mounts)) if mounts else [],
+            "outputs": sorted({"/" + str(path).lstrip("/") for path in outputs}),
+        }
+        h.update(json.dumps(header, sort_keys=True).encode())
+        for path in inputs:
+            self._hash_input(chroot, path, h)
+        return h.hexdigest()
+
+    # Blobs
+
+    def _blob_path(self, digest: str) -> Path:
+        return self._blobs / digest[:2] / digest
+
+    def _store_fd(self, src_fd: int) -> tuple[str, int]:
+        """Copy an open file into the store and return its digest and size."""
+        with open(src_fd, "rb", closefd=False) as f:
+            f.seek(0)
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+        path = self._blob_path(digest)
+        if path.exists():
+            return digest, 0
+
+        path.parent.mkdir(exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            try:
+                os.lseek(src_fd, 0, os.SEEK_SET)
+                if not _linux.reflink(src_fd, fd):
+                    _linux.copy_fd(src_fd, fd)
+                os.fchmod(fd, 0o444)
+                size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+            os.rename(tmp, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp)
+            raise
+        return digest, size
+
+    def _store_bytes(self, data: bytes) -> tuple[str, int]:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest)
+        if path.exists():
+            return digest, 0
+
+        path.parent.mkdir(exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with open(fd, "wb") as f:
+                f.write(data)
+            os.chmod(tmp, 0o444)
+            os.rename(tmp, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp)
+            raise
+        return digest, len(data)
+
+    def _collect_output(self, chroot: "ChrootManager", path: str, record: dict[str, Any]) -> int:
+        """Store an output path (recursively for directories) and return the number of new bytes."""
+        try:
+            st = chroot.stat(path, follow_symlinks=False)
+        except FileNotFoundError:
+            record[path] = None
+            return 0
+
+        mode = stat.S_IMODE(st.st_mode)
+        if stat.S_ISLNK(st.st_mode):
+            record[path] = {"symlink": chroot.readlink(path)}
+            return 0
+        if stat.S_ISDIR(st.st_mode):
+            record[path] = {"dir": mode}
+            return sum(
+                self._collect_output(chroot, f"{path.rstrip('/')}/{name}", record)
+                for name in sorted(chroot.listdir(path))
+            )
+        if not stat.S_ISREG(st.st_mode):
+            raise ChrootError(f"Cannot cache output {path}: not a regular file, directory or symlink")
+
+        fd = chroot._open_in_root(path, os.O_RDONLY)
+        try:
+            digest, size = self._store_fd(fd)
+        finally:
+            os.close(fd)
+        record[path] = {"digest": digest, "mode": mode}
+        return size
+
+    def _restore_output(self, chroot: "ChrootManager", path: str, entry: dict[str, Any] | None) -> None:
+        if entry is None:
+            return
+        parent, _, name = path.rstrip("/").rpartition("/")
+        if "dir" in entry:
+            os.close(chroot._makedirs_in_root(path))
+            fd = chroot._open_in_root(path, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fchmod(fd, entry["dir"])
+            finally:
+                os.close(fd)
+            return
+
+        parent_fd = chroot._makedirs_in_root(parent or "/")
+        try:
+            with contextlib.suppress(FileNotFoundError):
+                if stat.S_ISLNK(os.stat(name, dir_fd=parent_fd, follow_symlinks=False).st_mode):
+                    os.unlink(name, dir_fd=parent_fd)
+            if "symlink" in entry:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(name, dir_fd=parent_fd)
+                os.symlink(entry["symlink"], name, dir_fd=parent_fd)
+                return
+        finally:
+            os.close(parent_fd)
+
+        src_fd = os.open(self._blob_path(entry["digest"]), os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            dst_fd = chroot._open_in_root(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, entry["mode"])
+            try:
+                if not _linux.reflink(src_fd, dst_fd):
+                    _linux.copy_fd(src_fd, dst_fd)
+                os.fchmod(dst_fd, entry["mode"])
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+
+    # Actions
+
+    def lookup(self, key: str) -> dict[str, Any] | None:
+        """Return the stored record of an action, or None if it is not cached (or was partly evicted)."""
+        action_path = self._actions / f"{key}.json"
+        try:
+            record = json.loads(action_path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        digests = [record["stdout"], record["stderr"]]
+        digests += [entry["digest"] for entry in record["outputs"].values() if entry and "digest" in entry]
+        now = time.time()
+        try:
+            for digest in filter(None, digests):
+                os.utime(self._blob_path(digest), (now, now))
+            os.utime(action_path, (now, now))
+        except FileNotFoundError:
+            with contextlib.suppress(FileNotFoundError):
+                action_path.unlink()
+            return None
+        return record
+
+    def _read_blob(self, digest: str | None) -> bytes:
+        return b"" if digest is None else self._blob_path(digest).read_bytes()
+
+    def run(
+        self,
+        chroot: "ChrootManager",
+        command: list[str] | str | None,
+        userspec: str | None,
+        capture_output: bool,
+        text: bool,
+        inputs: Iterable[str | Path],
+        outputs: Iterable[str | Path],
+        mounts: Iterable[str | Path] | None = None,
+    ) -> subprocess.CompletedProcess:
+        """
+        Execute a command through the cache. Used by ChrootManager.execute() when inputs are declared.
+
+        On a hit the outputs are restored into the chroot and the stored result
+        is returned without spawning anything. The command always runs with
+        captured output so it can be stored; without capture_output the output
+        is written to sys.stdout and sys.stderr instead, on a miss and on a hit.
+        """
+        argv = chroot._command_argv(command)
+        env = chroot._command_env()
+        outputs = sorted({"/" + str(path).lstrip("/") for path in outputs})
+        key = self.action_key(chroot, argv, env, userspec, inputs, mounts, outputs)
+
+        record = self.lookup(key)
+        if record is not None:
+            self.hits += 1
+            logger.debug(f"Action cache hit {key[:12]} for {argv}")
+            try:
+                for path, entry in record["outputs"].items():
+                    self._restore_output(chroot, path, entry)
+            except OSError as e:
+                raise ChrootError(f"Failed to restore cached outputs: {e}") from None
+            returncode = record["returncode"]
+            stdout, stderr = self._read_blob(record["stdout"]), self._read_blob(record["stderr"])
+        else:
+            self.misses += 1
+            logger.debug(f"Action cache miss {key[:12]} for {argv}")
+            result = chroot.execute(command, userspec, capture_output=True, text=False, mounts=mounts)
+            returncode, stdout, stderr = result.returncode, result.stdout, result.stderr
+            if returncode == 0 or self.cache_failures:
+                try:
+                    self._store(chroot, key, returncode, stdout, stderr, outputs)
+                except OSError as e:
+                    logger.warning(f"Could not store action {key[:12]} in cache: {e}")
+
+        if not capture_output:
+            _write_output(sys.stdout, stdout)
+            _write_output(sys.stderr, stderr)
+            return subprocess.CompletedProcess(argv, returncode)
+        if text:
+            stdout, stderr = stdout.decode(), stderr.decode()
+        return subprocess.CompletedProcess(argv, returncode, stdout, stderr)
+
+    def _store(
+        self, chroot: "ChrootManager", key: str, returncode: int, stdout: bytes, stderr: bytes, outputs: list[str]
+    ) -> None:
+        added = 0
+        files: dict[str, Any] = {}
+        for path in outputs:
+            added += self._collect_output(chroot, path, files)
+        stdout_digest, size = self._store_bytes(stdout) if stdout else (None, 0)
+        added += size
+        stderr_digest, size = self._store_bytes(stderr) if stderr else (None, 0)
+        added += size
+
+        record = {"returncode": returncode, "stdout": stdout_digest, "stderr": stderr_digest, "outputs": files}
+        data = json.dumps(record).encode()
+        fd, tmp = tempfile.mkstemp(dir=self._actions, prefix=".tmp-")
+        with open(fd, "wb") as f:
+            f.write(data)
+        os.rename(tmp, self._actions / f"{key}.json")
+        added += len(data)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self.size()
+            else:
+                self._size += added
+            over = self._size > self.max_size
+        if over:
+            self.prune()
+
+    # Eviction
+
+    def _entries(self) -> list[tuple[float, int, Path]]:
+        entries = []
+        for root in (self._actions, self._blobs):
+            for dirpath, _, filenames in os.walk(root):
+                for name in filenames:
+                    path = Path(dirpath) / name
+                    with contextlib.suppress(FileNotFoundError):
+                        st = path.stat()
+                        entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def size(self) -> int:
+        """Return the total size of the store in bytes."""
+        return sum(size for _, size, _ in self._entries())
+
+    def prune(self, max_size: int | None = None) -> int:
+        """
+        Evict least recently used actions and blobs until the store fits in max_size.
+
+        Actions whose blobs were evicted are treated as misses by lookup(), so
+        the store stays consistent whatever gets removed first.
+
+        Returns:
+            The number of bytes freed
+        """
+        limit = self.max_size if max_size is None else max_size
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda entry: entry[0])
+            total = sum(size for _, size, _ in entries)
+            freed = 0
+            for _, size, path in entries:
+                if total - freed <= limit:
+                    break
+                with contextlib.suppress(FileNotFoundError):
+                    path.unlink()
+                    freed += size
+            self._size = total - freed
+
+        if freed:
+            logger.debug(f"Pruned {freed} bytes from action cache {self.directory}")
+        return freed
+
+    def clear(self) -> None:
+        """Remove every entry from the store."""
+        self.prune(0)
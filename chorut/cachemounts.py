@@ -0,0 +1,160 @@
+"""
+Named persistent cache directories bound into chroots.
+
+Package manager and compiler caches (apt, pacman, pip, ccache, ...) are
+kept in a host-side store, one directory per name, and bind mounted into
+every chroot that asks for them, so repeated builds start warm. A chroot
+holds a lock on each of its caches from setup to teardown: shared by
+default, so any number of chroots can use a cache at once, or exclusive,
+for caches whose tools cannot cope with concurrent users. A cache can be
+capped in size; its least recently used files are then removed when the
+last chroot using it releases it.
+"""
+
+import contextlib
+import fcntl
+import logging
+import os
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+from . import MountError, MountSpec
+
+logger = logging.getLogger(__name__)
+
+LOCK_MODES = ("shared", "exclusive")
+
+_NAME = re.compile(r"[A-Za-z0-9][A-Za-z0-9._-]*")
+
+
+def default_store() -> Path:
+    """Return the cache store used when none is given ($XDG_CACHE_HOME/chorut/cache-mounts)."""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return Path(base) / "chorut" / "cache-mounts"
+
+
+@dataclass(frozen=True, slots=True)
+class CacheMount:
+    """A named cache and where it is mounted inside the chroot."""
+
+    name: str
+    target: str
+    lock: str = "shared"
+    max_size: int | None = None
+
+    def __post_init__(self):
+        if not _NAME.fullmatch(self.name):
+            raise MountError(f"Invalid cache name {self.name!r}: use letters, digits, '.', '_' and '-'")
+        if self.lock not in LOCK_MODES:
+            raise MountError(f"Invalid lock mode for cache '{self.name}': {self.lock!r}")
+
+    @classmethod
+    def parse(cls, name: str, spec: "str | dict[str, Any] | CacheMount") -> "CacheMount":
+        """Build a CacheMount from a target path or a dict with target, lock and max_size keys."""
+        if isinstance(spec, CacheMount):
+            return spec
+        if isinstance(spec, str | os.PathLike):
+            return cls(name, os.fspath(spec))
+        if "target" not in spec:
+            raise MountError(f"Cache mount '{name}' is missing its 'target'")
+        unknown = set(spec) - {"target", "lock", "max_size"}
+        if unknown:
+            raise MountError(f"Unknown cache mount fields: {', '.join(sorted(unknown))}")
+        return cls(name, **spec)
+
+
+class CacheStore:
+    """A host directory holding named caches, with a lock file per cache."""
+
+    def __init__(self, directory: str | Path | None = None):
+        self.directory = Path(directory) if directory is not None else default_store()
+
+    def path(self, name: str) -> Path:
+        return self.directory / name
+
+    def mount_spec(self, cache: CacheMount) -> MountSpec:
+        """Return the bind mount that puts a cache at its target."""
+        return MountSpec(source=str(self.path(cache.name)), target=cache.target, bind=True)
+
+    def acquire(self, cache: CacheMount) -> int:
+        """
+        Create a cache directory if needed and take its lock, blocking until it is available.
+
+        Returns:
+            The descriptor holding the lock
+        """
+        self.path(cache.name).mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.directory / f"{cache.name}.lock", os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        operation = fcntl.LOCK_SH if cache.lock == "shared" else fcntl.LOCK_EX
+        try:
+            try:
+                fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info(f"Waiting for the {cache.lock} lock of cache '{cache.name}'")
+                fcntl.flock(fd, operation)
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    def release(self, cache: CacheMount, lock_fd: int) -> None:
+        """Prune a cache if it has a size limit and nobody else holds it, then release its lock."""
+        try:
+            if cache.max_size is not None:
+                # Only prune while nobody else uses the cache, so files never disappear under a running build
+                try:
+                    fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    logger.debug(f"Cache '{cache.name}' is in use, not pruning it")
+                else:
+                    self.prune(cache.name, cache.max_size)
+        finally:
+            os.close(lock_fd)
+
+    def size(self, name: str) -> int:
+        """Return the number of bytes used by the files of a cache."""
+        return sum(size for _, size, _ in self._files(self.path(name)))
+
+    @staticmethod
+    def _files(root: Path) -> list[tuple[int, int, str]]:
+        files = []
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                with contextlib.suppress(FileNotFoundError):
+                    st = os.lstat(path)
+                    files.append((max(st.st_atime_ns, st.st_mtime_ns), st.st_blocks * 512, path))
+        return files
+
+    def prune(self, name: str, max_size: int) -> int:
+        """
+        Remove the least recently used files of a cache until it fits in max_size bytes.
+
+        Files are ordered by the later of their access and modification times,
+        and directories left empty are removed. The caller must make sure the
+        cache is not in use.
+
+        Returns:
+            The number of bytes freed
+        """
+        root = self.path(name)
+        files = sorted(self._files(root))
+        total = sum(size for _, size, _ in files)
+        freed = 0
+        for _, size, path in files:
+            if total - freed <= max_size:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+                freed += size
+
+        if freed:
+            for dirpath, _, _ in os.walk(root, topdown=False):
+                if dirpath != str(root):
+                    # Fails, as intended, for directories that still have entries
+                    with contextlib.suppress(OSError):
+                        os.rmdir(dirpath)
+            logger.debug(f"Pruned {freed} bytes from cache '{name}'")
+        return freed
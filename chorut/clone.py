@@ -0,0 +1,249 @@
+"""
+Fast copies of a base root filesystem, for one private root per job.
+
+A clone shares file data with its base instead of copying it: with reflinks
+(FICLONE) on filesystems that support them, such as Btrfs and XFS, or with
+hardlinks anywhere on the same filesystem. Directories are recreated, so
+files can be added, removed and renamed in the clone without touching the
+base. The tree is walked level by level on a thread pool; the copying
+syscalls release the GIL, so files are cloned in parallel.
+"""
+
+import contextlib
+import logging
+import os
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+from . import ChrootError, _linux
+
+logger = logging.getLogger(__name__)
+
+STRATEGIES = ("auto", "reflink", "hardlink", "copy")
+
+# Paths that are usually written in place, copied rather than hardlinked by the hardlink strategy
+DEFAULT_PRIVATE_PATHS = ("/etc", "/var", "/root", "/home", "/tmp", "/run")
+
+# Fewest directories handed to a thread at once
+_MIN_BATCH = 16
+
+
+@dataclass(slots=True)
+class CloneResult:
+    """What clone_tree() did."""
+
+    strategy: str
+    files: int = 0
+    directories: int = 0
+    bytes_copied: int = 0
+    bytes_shared: int = 0
+    duration: float = 0.0
+
+
+def _copy_xattrs(src: str, dst: int | str) -> None:
+    try:
+        names = os.listxattr(src, follow_symlinks=False)
+    except OSError:
+        return
+    no_follow = {} if isinstance(dst, int) else {"follow_symlinks": False}
+    for name in names:
+        with contextlib.suppress(OSError):
+            os.setxattr(dst, name, os.getxattr(src, name, follow_symlinks=False), **no_follow)
+
+
+def _copy_metadata(st: os.stat_result, path: int | str) -> None:
+    follow = isinstance(path, int)
+    if os.geteuid() == 0:
+        os.chown(path, st.st_uid, st.st_gid, follow_symlinks=follow)
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(path, stat.S_IMODE(st.st_mode))
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=follow)
+
+
+class _Cloner:
+    def __init__(self, base: str, dest: str, strategy: str, private: tuple[str, ...]):
+        self.base = base
+        self.dest = dest
+        self.strategy = strategy
+        self.private = private
+        self.result = CloneResult(strategy)
+        self._lock = threading.Lock()
+        # (dev, ino) of a file with several links in the base -> its first path in the clone
+        self._links: dict[tuple[int, int], str] = {}
+        self._pending_links: list[tuple[str, str]] = []
+        self._base_dev = os.lstat(base).st_dev
+
+    def _is_private(self, rel: str) -> bool:
+        return any(rel == path or rel.startswith(path + "/") for path in self.private)
+
+    def _clone_file(self, src: str, dst: str, st: os.stat_result, rel: str) -> None:
+        strategy = self.strategy
+        if strategy == "hardlink" and not self._is_private(rel):
+            os.link(src, dst, follow_symlinks=False)
+            with self._lock:
+                self.result.files += 1
+                self.result.bytes_shared += st.st_size
+            return
+
+        src_fd = os.open(src, os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC)
+        try:
+            fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, 0o600)
+            try:
+                shared = strategy == "reflink" and _linux.reflink(src_fd, fd)
+                copied = 0 if shared else _linux.copy_fd(src_fd, fd)
+                _copy_xattrs(src, fd)
+                _copy_metadata(st, fd)
+            finally:
+                os.close(fd)
+        finally:
+            os.close(src_fd)
+        with self._lock:
+            self.result.files += 1
+            if shared:
+                self.result.bytes_shared += st.st_size
+            else:
+                self.result.bytes_copied += copied
+
+    def _clone_entry(self, entry: os.DirEntry, rel: str, dst: str, subdirs: list) -> None:
+        st = entry.stat(follow_symlinks=False)
+        if stat.S_ISDIR(st.st_mode):
+            os.mkdir(dst, 0o700)
+            subdirs.append((entry.path, rel, dst, st))
+            return
+
+        if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+            key = (st.st_dev, st.st_ino)
+            with self._lock:
+                first = self._links.setdefault(key, dst)
+            if first != dst:
+                # Keep hardlinks within the base as hardlinks within the clone, once the first copy exists
+                with self._lock:
+                    self._pending_links.append((first, dst))
+                return
+
+        if stat.S_ISREG(st.st_mode):
+            self._clone_file(entry.path, dst, st, rel)
+        elif stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(entry.path), dst)
+            _copy_metadata(st, dst)
+        elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode) or stat.S_ISFIFO(st.st_mode):
+            os.mknod(dst, st.st_mode, st.st_rdev)
+            _copy_metadata(st, dst)
+        else:
+            logger.debug(f"Skipping {entry.path}: unsupported file type")
+
+    def _clone_dir(self, src: str, rel: str, dst: str, subdirs: list) -> None:
+        with os.scandir(src) as it:
+            for entry in it:
+                self._clone_entry(entry, f"{rel}/{entry.name}", f"{dst}/{entry.name}", subdirs)
+
+    def _clone_batch(self, batch: list) -> tuple[list, list]:
+        subdirs: list = []
+        done = []
+        for src, rel, dst, st in batch:
+            # Mount points inside the base are recreated empty, like 'cp -ax'
+            if st.st_dev == self._base_dev:
+                self._clone_dir(src, rel, dst, subdirs)
+            done.append((src, dst, st))
+        return subdirs, done
+
+    def run(self, workers: int) -> CloneResult:
+        start = time.monotonic()
+        root_st = os.lstat(self.base)
+        level = [(self.base, "", self.dest, root_st)]
+        directories = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while level:
+                size = max(_MIN_BATCH, -(-len(level) // (workers * 4)))
+                batches = [level[i : i + size] for i in range(0, len(level), size)]
+                level = []
+                for subdirs, done in pool.map(self._clone_batch, batches):
+                    level.extend(subdirs)
+                    directories.extend(done)
+
+        for first, dst in self._pending_links:
+            os.link(first, dst, follow_symlinks=False)
+
+        # Directory metadata last, deepest first, so read-only directories could be filled
+        for src, dst, st in reversed(directories):
+            _copy_xattrs(src, dst)
+            _copy_metadata(st, dst)
+        self.result.directories = len(directories)
+        self.result.duration = time.monotonic() - start
+        return self.result
+
+
+def _supports_reflink(base: str, dest: str) -> bool:
+    """Check whether files can be reflinked from base to dest, with anonymous scratch files on both sides."""
+    try:
+        src_fd = os.open(base, os.O_RDWR | os.O_TMPFILE | os.O_CLOEXEC, 0o600)
+    except OSError:
+        return False
+    try:
+        dst_fd = os.open(dest, os.O_WRONLY | os.O_TMPFILE | os.O_CLOEXEC, 0o600)
+        try:
+            return _linux.reflink(src_fd, dst_fd)
+        finally:
+            os.close(dst_fd)
+    except OSError:
+        return False
+    finally:
+        os.close(src_fd)
+
+
+def clone_tree(
+    base: str | Path,
+    dest: str | Path,
+    strategy: str = "auto",
+    private_paths: tuple[str, ...] = DEFAULT_PRIVATE_PATHS,
+    workers: int | None = None,
+) -> CloneResult:
+    """
+    Clone a root filesystem tree. See ChrootManager.clone().
+
+    Raises:
+        ChrootError: If the strategy is unknown or not supported between base and dest
+    """
+    if strategy not in STRATEGIES:
+        raise ChrootError(f"Unknown clone strategy: {strategy} (expected one of {', '.join(STRATEGIES)})")
+
+    base = os.path.abspath(base)
+    dest = os.path.abspath(dest)
+    if not os.path.isdir(base):
+        raise ChrootError(f"Base root does not exist: {base}")
+    if dest == base or dest.startswith(base + "/"):
+        raise ChrootError(f"Cannot clone {base} into itself")
+
+    try:
+        os.mkdir(dest, 0o700)
+    except FileExistsError:
+        if os.listdir(dest):
+            raise ChrootError(f"Destination is not empty: {dest}") from None
+    except OSError as e:
+        raise ChrootError(f"Cannot create {dest}: {e}") from None
+
+    if strategy in ("auto", "reflink"):
+        if _supports_reflink(base, dest):
+            strategy = "reflink"
+        elif strategy == "reflink":
+            raise ChrootError(f"Reflinks are not supported from {base} to {dest}")
+        else:
+            strategy = "copy"
+    elif strategy == "hardlink" and os.stat(base).st_dev != os.stat(dest).st_dev:
+        raise ChrootError(f"Hardlinks need {base} and {dest} on the same filesystem")
+
+    cloner = _Cloner(base, dest, strategy, tuple(path.rstrip("/") for path in private_paths))
+    try:
+        result = cloner.run(workers or min(32, (os.cpu_count() or 1) + 4))
+    except OSError as e:
+        raise ChrootError(f"Failed to clone {base} to {dest}: {e}") from None
+
+    logger.debug(
+        f"Cloned {base} to {dest} with {strategy}: {result.files} files, {result.directories} directories, "
+        f"{result.bytes_copied} bytes copied, {result.bytes_shared} bytes shared in {result.duration:.3f}s"
+    )
+    return result
@@ -0,0 +1,324 @@
+"""
+Setup and teardown of many chroots through one shared scheduler.
+
+Setting up a chroot performs a dozen mounts, and every mount takes the
+kernel's global namespace lock. A host managing hundreds of roots that all
+set up at once serialises on that lock and every setup slows down. A
+ChrootFleet funnels setups and teardowns through a single worker pool with
+a global concurrency limit and an optional rate limit (a token bucket), and
+keeps per-root state in flat arrays rather than one object graph per root.
+A root added by directory only gets its ChrootManager while it is being set
+up, is set up, or is being torn down.
+"""
+
+import logging
+import threading
+import time
+from array import array
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+from . import ChrootError, ChrootManager
+
+logger = logging.getLogger(__name__)
+
+# Root states, stored as one byte per root
+IDLE, SETTING_UP, READY, TEARING_DOWN, FAILED = range(5)
+STATE_NAMES = ("idle", "setting up", "ready", "tearing down", "failed")
+
+
+class _TokenBucket:
+    """Allows rate operations per second on average, and bursts of up to burst operations."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Take a token, sleeping until one is available. Returns the seconds waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+def _percentile(samples: list[float], fraction: float) -> float:
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+@dataclass(frozen=True, slots=True)
+class FleetStats:
+    """Aggregate statistics of a fleet. Latencies are in seconds, throughput in operations per second."""
+
+    roots: int
+    ready: int
+    failed: int
+    setups: int
+    teardowns: int
+    errors: int
+    setup_p50: float
+    setup_p95: float
+    setup_max: float
+    teardown_p50: float
+    teardown_p95: float
+    teardown_max: float
+    # Time operations spent waiting for a worker or a rate limit token
+    queue_mean: float
+    throughput: float
+
+
+class ChrootFleet:
+    """
+    Many chroots set up and torn down through a shared scheduler.
+
+    At most max_concurrent setups or teardowns run at any time, and with a
+    rate, at most that many start per second (after an initial burst of
+    max_concurrent). Roots are addressed by the index returned by add().
+    Roots added by directory have their ChrootManager created for setup()
+    and dropped again after teardown(), so idle roots only cost their
+    directory and arguments.
+    """
+
+    def __init__(self, max_concurrent: int = 8, rate: float | None = None):
+        """
+        Args:
+            max_concurrent: Maximum number of setups and teardowns running at the same time
+            rate: Maximum number of setups and teardowns started per second (default: unlimited)
+        """
+        if max_concurrent < 1:
+            raise ChrootError("max_concurrent must be at least 1")
+        if rate is not None and rate <= 0:
+            raise ChrootError("rate must be positive")
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        self._bucket = _TokenBucket(rate, max_concurrent) if rate is not None else None
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="chorut-fleet")
+        self._lock = threading.Lock()
+        # One entry per root: the directory and ChrootManager arguments, or None for a root added as a manager
+        self._specs: list[tuple[str, dict[str, Any]] | None] = []
+        self._state = array("B")
+        # Managers of roots added as managers, and of those set up or in progress, by index
+        self._managers: dict[int, ChrootManager] = {}
+        # One entry per operation, in seconds
+        self._setup_times = array("d")
+        self._teardown_times = array("d")
+        self._queue_times = array("d")
+        self._errors = 0
+        self._first_start = 0.0
+        self._last_end = 0.0
+
+    def __len__(self) -> int:
+        return len(self._state)
+
+    def __getitem__(self, index: int) -> ChrootManager:
+        """
+        Return the ChrootManager of a root.
+
+        A root added by directory that holds no manager, such as an idle one,
+        gets a new manager that the fleet does not keep. Set it up through
+        the fleet rather than directly.
+        """
+        with self._lock:
+            manager = self._managers.get(index)
+            if manager is None:
+                chroot_dir, kwargs = self._specs[index]
+                manager = ChrootManager(chroot_dir, **kwargs)
+            return manager
+
+    def __iter__(self) -> Iterator[ChrootManager]:
+        return (self[index] for index in range(len(self)))
+
+    def _manager(self, index: int) -> ChrootManager:
+        """Return the manager that the fleet keeps for a root, creating it for a root added by directory."""
+        with self._lock:
+            manager = self._managers.get(index)
+            if manager is None:
+                chroot_dir, kwargs = self._specs[index]
+                manager = self._managers[index] = ChrootManager(chroot_dir, **kwargs)
+            return manager
+
+    def _release(self, index: int) -> None:
+        """Drop the manager of a root added by directory once it holds nothing."""
+        with self._lock:
+            if self._specs[index] is not None:
+                self._managers.pop(index, None)
+
+    def add(self, chroot: ChrootManager | str | Path, **kwargs: Any) -> int:
+        """
+        Add a root to the fleet.
+
+        Args:
+            chroot: A ChrootManager, or a chroot directory to create one for when the root is set up
+            **kwargs: ChrootManager arguments, when a directory is given. Invalid arguments
+                are reported when the root is set up.
+
+        Returns:
+            The index of the root
+        """
+        with self._lock:
+            index = len(self._state)
+            if isinstance(chroot, ChrootManager):
+                self._specs.append(None)
+                self._managers[index] = chroot
+            else:
+                self._specs.append((str(chroot), kwargs))
+            self._state.append(IDLE)
+            return index
+
+    def state(self, index: int) -> str:
+        """Return the state of a root: idle, setting up, ready, tearing down or failed."""
+        return STATE_NAMES[self._state[index]]
+
+    def _run(self, index: int, setup: bool, queued: float) -> None:
+        if self._bucket is not None:
+            self._bucket.acquire()
+        start = time.monotonic()
+        try:
+            manager = self._manager(index)
+            if setup:
+                manager.setup()
+            else:
+                manager.teardown()
+        except BaseException:
+            with self._lock:
+                self._state[index] = FAILED
+                self._errors += 1
+            # A failed setup undoes itself; a failed teardown keeps the manager for another attempt
+            if setup:
+                self._release(index)
+            raise
+        finally:
+            end = time.monotonic()
+            with self._lock:
+                self._queue_times.append(start - queued)
+                (self._setup_times if setup else self._teardown_times).append(end - start)
+                self._first_start = min(self._first_start or start, start)
+                self._last_end = max(self._last_end, end)
+        self._state[index] = READY if setup else IDLE
+        if not setup:
+            self._release(index)
+
+    def _submit(self, index: int, setup: bool) -> Future:
+        with self._lock:
+            # A failed root may be retried either way; otherwise only the opposite state can be left
+            if self._state[index] not in ((IDLE, FAILED) if setup else (READY, FAILED)):
+                action = "set up" if setup else "tear down"
+                raise ChrootError(f"Cannot {action} root {index} while it is {STATE_NAMES[self._state[index]]}")
+            # Marked at once, so that the root cannot be submitted twice while it waits for a worker
+            self._state[index] = SETTING_UP if setup else TEARING_DOWN
+        return self._pool.submit(self._run, index, setup, time.monotonic())
+
+    def submit_setup(self, index: int) -> Future:
+        """
+        Schedule the setup of a root and return its Future.
+
+        Raises:
+            ChrootError: If the root is not idle or failed
+        """
+        return self._submit(index, True)
+
+    def submit_teardown(self, index: int) -> Future:
+        """
+        Schedule the teardown of a root and return its Future.
+
+        Raises:
+            ChrootError: If the root is not ready or failed
+        """
+        return self._submit(index, False)
+
+    def _run_all(self, setup: bool, indices: Iterable[int] | None) -> dict[int, BaseException]:
+        if indices is None:
+            wanted = IDLE if setup else READY
+            indices = [index for index, state in enumerate(self._state) if state == wanted]
+        futures = {}
+        failures: dict[int, BaseException] = {}
+        for index in indices:
+            try:
+                futures[self._submit(index, setup)] = index
+            except ChrootError as e:
+                failures[index] = e
+        wait(futures)
+        failures.update((index, future.exception()) for future, index in futures.items() if future.exception())
+        for index, error in failures.items():
+            spec = self._specs[index]
+            chroot_dir = spec[0] if spec is not None else self._managers[index].chroot_dir
+            logger.warning(f"{'Setup' if setup else 'Teardown'} of {chroot_dir} failed: {error}")
+        return failures
+
+    def setup(self, indices: Iterable[int] | None = None) -> dict[int, BaseException]:
+        """
+        Set up roots and wait for them.
+
+        Args:
+            indices: The roots to set up (default: every idle root)
+
+        Returns:
+            The exception of every root that failed, by index
+        """
+        return self._run_all(True, indices)
+
+    def teardown(self, indices: Iterable[int] | None = None) -> dict[int, BaseException]:
+        """
+        Tear down roots and wait for them.
+
+        Args:
+            indices: The roots to tear down (default: every ready root)
+
+        Returns:
+            The exception of every root that failed, by index
+        """
+        return self._run_all(False, indices)
+
+    def stats(self) -> FleetStats:
+        """Return aggregate statistics over every operation so far."""
+        with self._lock:
+            setups = sorted(self._setup_times)
+            teardowns = sorted(self._teardown_times)
+            queued = self._queue_times
+            operations = len(setups) + len(teardowns)
+            elapsed = self._last_end - self._first_start
+            return FleetStats(
+                roots=len(self._state),
+                ready=self._state.count(READY),
+                failed=self._state.count(FAILED),
+                setups=len(setups),
+                teardowns=len(teardowns),
+                errors=self._errors,
+                setup_p50=_percentile(setups, 0.5),
+                setup_p95=_percentile(setups, 0.95),
+                setup_max=setups[-1] if setups else 0.0,
+                teardown_p50=_percentile(teardowns, 0.5),
+                teardown_p95=_percentile(teardowns, 0.95),
+                teardown_max=teardowns[-1] if teardowns else 0.0,
+                queue_mean=sum(queued) / len(queued) if queued else 0.0,
+                throughput=operations / elapsed if elapsed > 0 else 0.0,
+            )
+
+    def close(self) -> None:
+        """Tear down every ready root and stop the scheduler."""
+        try:
+            self.teardown()
+        finally:
+            self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
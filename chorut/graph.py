@@ -0,0 +1,301 @@
+"""
+Dependency-ordered execution of a graph of commands inside one chroot.
+
+A build recipe such as fetch -> configure -> compile N targets -> package
+is a small DAG. run_graph() starts every step whose dependencies succeeded,
+up to a number of concurrent steps, and drives them all from a single
+Supervisor. Output is streamed per step as it arrives, steps downstream of a
+failure are skipped, and the returned report includes the critical path:
+the chain of dependent steps with the largest total duration, which bounds
+how fast the graph can run with any number of workers.
+"""
+
+import contextlib
+import heapq
+import logging
+import os
+import time
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import IO, Any
+
+from . import ChrootError, ChrootManager
+from .supervisor import Job, Supervisor
+
+logger = logging.getLogger(__name__)
+
+# Step states
+PENDING, RUNNING, OK, FAILED, SKIPPED = "pending", "running", "ok", "failed", "skipped"
+
+
+class GraphError(ChrootError):
+    """Exception raised for an invalid step graph."""
+
+    pass
+
+
+@dataclass(frozen=True, slots=True)
+class Step:
+    """A command in a step graph and the names of the steps it depends on."""
+
+    name: str
+    command: list[str] | str
+    deps: tuple[str, ...] = ()
+    userspec: str | None = None
+    timeout: float | None = None
+
+    def __post_init__(self):
+        # Names are used for log file names
+        if not self.name or "/" in self.name or self.name in (".", ".."):
+            raise GraphError(f"Invalid step name {self.name!r}")
+        if isinstance(self.deps, str):
+            raise GraphError(f"Dependencies of step '{self.name}' must be a list of step names")
+        object.__setattr__(self, "deps", tuple(dict.fromkeys(self.deps)))
+
+    @classmethod
+    def parse(cls, spec: "Step | dict[str, Any]") -> "Step":
+        """Build a Step from a dict with name, command and optional deps, userspec and timeout keys."""
+        if isinstance(spec, Step):
+            return spec
+        for key in ("name", "command"):
+            if key not in spec:
+                raise GraphError(f"Step specification missing required '{key}' field")
+        unknown = set(spec) - set(cls.__slots__)
+        if unknown:
+            raise GraphError(f"Unknown step specification fields: {', '.join(sorted(unknown))}")
+        return cls(**spec)
+
+
+@dataclass(slots=True)
+class StepResult:
+    """The outcome of a step. Times are in seconds from the start of the graph."""
+
+    name: str
+    status: str = PENDING
+    returncode: int | None = None
+    start: float | None = None
+    end: float | None = None
+    timed_out: bool = False
+    log: Path | None = None
+    # Combined stdout and stderr, when no log_dir was given
+    output: str | None = None
+    # The failed dependency that caused a skip
+    blocked_by: str | None = None
+
+    @property
+    def duration(self) -> float:
+        return 0.0 if self.start is None or self.end is None else self.end - self.start
+
+
+@dataclass(slots=True)
+class GraphReport:
+    """What run_graph() did."""
+
+    steps: dict[str, StepResult] = field(default_factory=dict)
+    duration: float = 0.0
+    critical_path: list[str] = field(default_factory=list)
+    critical_path_duration: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return all(result.status == OK for result in self.steps.values())
+
+    @property
+    def failed(self) -> list[str]:
+        return [name for name, result in self.steps.items() if result.status == FAILED]
+
+    @property
+    def skipped(self) -> list[str]:
+        return [name for name, result in self.steps.items() if result.status == SKIPPED]
+
+    def format(self) -> str:
+        """Render the report as a table of steps followed by the critical path."""
+        width = max((len(name) for name in self.steps), default=4)
+        lines = [f"{'STEP':<{width}}  {'STATUS':<11}  {'START':>8}  {'TIME':>8}"]
+        for result in sorted(self.steps.values(), key=lambda r: (r.start is None, r.start or 0.0)):
+            start = f"{result.start:8.2f}" if result.start is not None else f"{'-':>8}"
+            status = result.status if result.returncode in (None, 0) else f"{result.status}({result.returncode})"
+            lines.append(f"{result.name:<{width}}  {status:<11}  {start}  {result.duration:8.2f}")
+        lines.append(f"Total {self.duration:.2f}s")
+        if self.critical_path:
+            path = " -> ".join(self.critical_path)
+            lines.append(f"Critical path {self.critical_path_duration:.2f}s: {path}")
+        return "\n".join(lines)
+
+
+def _order(steps: dict[str, Step]) -> list[str]:
+    """Return the step names in dependency order, raising GraphError for unknown names and cycles."""
+    for step in steps.values():
+        for dep in step.deps:
+            if dep not in steps:
+                raise GraphError(f"Step '{step.name}' depends on unknown step '{dep}'")
+
+    order: list[str] = []
+    state: dict[str, int] = {}  # 1: being visited, 2: done
+    for root in steps:
+        if state.get(root) == 2:
+            continue
+        state[root] = 1
+        stack = [(root, iter(steps[root].deps))]
+        while stack:
+            name, deps = stack[-1]
+            for dep in deps:
+                if state.get(dep) == 1:
+                    raise GraphError(f"Dependency cycle through steps '{name}' and '{dep}'")
+                if state.get(dep) is None:
+                    state[dep] = 1
+                    stack.append((dep, iter(steps[dep].deps)))
+                    break
+            else:
+                stack.pop()
+                state[name] = 2
+                order.append(name)
+    return order
+
+
+def _critical_path(steps: dict[str, Step], order: list[str], results: dict[str, StepResult]) -> tuple[list[str], float]:
+    """Return the chain of dependent steps that ran with the largest total duration."""
+    total: dict[str, float] = {}
+    previous: dict[str, str | None] = {}
+    for name in order:
+        if results[name].start is None:
+            continue
+        best = max((dep for dep in steps[name].deps if dep in total), key=total.__getitem__, default=None)
+        total[name] = results[name].duration + (total[best] if best is not None else 0.0)
+        previous[name] = best
+    if not total:
+        return [], 0.0
+
+    name: str | None = max(total, key=total.__getitem__)
+    length = total[name]
+    path = []
+    while name is not None:
+        path.append(name)
+        name = previous[name]
+    return path[::-1], length
+
+
+def run_graph(
+    chroot: ChrootManager,
+    steps: Iterable[Step | dict[str, Any]],
+    jobs: int | None = None,
+    log_dir: str | Path | None = None,
+    on_output: Callable[[str, bytes], None] | None = None,
+) -> GraphReport:
+    """
+    Run a graph of steps in a set up chroot. See ChrootManager.run_graph().
+
+    Raises:
+        GraphError: If a step is invalid, a name is used twice, a dependency is unknown or the graph has a cycle
+    """
+    graph: dict[str, Step] = {}
+    for spec in steps:
+        step = Step.parse(spec)
+        if step.name in graph:
+            raise GraphError(f"Duplicate step name '{step.name}'")
+        graph[step.name] = step
+    order = _order(graph)
+
+    jobs = max(1, jobs or os.cpu_count() or 1)
+    log_path = Path(log_dir) if log_dir is not None else None
+    if log_path is not None:
+        log_path.mkdir(parents=True, exist_ok=True)
+
+    dependents: dict[str, list[str]] = {name: [] for name in graph}
+    for step in graph.values():
+        for dep in step.deps:
+            dependents[dep].append(step.name)
+
+    # Longest chain of dependents below each step: steps that unblock the most work start first
+    height: dict[str, int] = {}
+    for name in reversed(order):
+        height[name] = 1 + max((height[child] for child in dependents[name]), default=0)
+
+    report = GraphReport({name: StepResult(name) for name in graph})
+    results = report.steps
+    position = {name: index for index, name in enumerate(order)}
+    waiting = {name: len(step.deps) for name, step in graph.items()}
+    ready = [(-height[name], position[name], name) for name in order if waiting[name] == 0]
+    heapq.heapify(ready)
+    logs: dict[str, IO[bytes]] = {}
+    buffers: dict[str, list[bytes]] = {}
+    start = time.monotonic()
+
+    def skip_dependents(name: str) -> None:
+        pending = [name]
+        while pending:
+            for child in dependents[pending.pop()]:
+                if results[child].status == PENDING:
+                    results[child].status = SKIPPED
+                    results[child].blocked_by = name
+                    logger.info(f"Skipping step '{child}': step '{name}' failed")
+                    pending.append(child)
+
+    def output(name: str, data: bytes) -> None:
+        if name in logs:
+            logs[name].write(data)
+        else:
+            buffers[name].append(data)
+        if on_output is not None:
+            on_output(name, data)
+
+    def finished(name: str, job: Job) -> None:
+        result = results[name]
+        result.end = job.end_time - start
+        result.returncode = job.returncode
+        result.timed_out = job.timed_out
+        if name in logs:
+            logs.pop(name).close()
+        else:
+            result.output = b"".join(buffers.pop(name)).decode(errors="replace")
+        if job.returncode == 0:
+            result.status = OK
+            for child in dependents[name]:
+                waiting[child] -= 1
+                if waiting[child] == 0 and results[child].status == PENDING:
+                    heapq.heappush(ready, (-height[child], position[child], child))
+        else:
+            result.status = FAILED
+            logger.info(f"Step '{name}' failed with exit code {job.returncode}")
+            skip_dependents(name)
+
+    # Logs are closed as their steps finish, and the stack closes the others on errors
+    with Supervisor() as supervisor, contextlib.ExitStack() as stack:
+        while ready or len(supervisor):
+            while ready and len(supervisor) < jobs:
+                _, _, name = heapq.heappop(ready)
+                step, result = graph[name], results[name]
+                if log_path is not None:
+                    result.log = log_path / f"{name}.log"
+                    logs[name] = stack.enter_context(open(result.log, "wb"))
+                else:
+                    buffers[name] = []
+                result.status = RUNNING
+                result.start = time.monotonic() - start
+                logger.debug(f"Starting step '{name}'")
+                try:
+                    supervisor.spawn(
+                        chroot,
+                        step.command,
+                        step.userspec,
+                        timeout=step.timeout,
+                        on_exit=lambda job, name=name: finished(name, job),
+                        on_output=lambda job, stream, data, name=name: output(name, data),
+                    )
+                except (OSError, ChrootError) as e:
+                    logger.info(f"Step '{name}' could not be started: {e}")
+                    result.end = result.start
+                    result.status = FAILED
+                    if name in logs:
+                        logs.pop(name).close()
+                    buffers.pop(name, None)
+                    result.output = str(e)
+                    skip_dependents(name)
+            # With nothing running, poll() would block forever
+            if len(supervisor):
+                supervisor.poll()
+
+    report.duration = time.monotonic() - start
+    report.critical_path, report.critical_path_duration = _critical_path(graph, order, results)
+    return report
@@ -0,0 +1,512 @@
+"""
+Building chroot directories from OCI image layouts and tarballs.
+
+Used by 'chorut import'. Every layer is unpacked once into a content-addressed
+cache, keyed by the SHA-256 of its compressed blob, with whiteout markers kept
+as they appear in the archive. Layers are unpacked in parallel, each in its own
+process, and a root is then assembled from the cached layers either by copying
+them in order (with reflinks where the filesystem supports them), or by
+mounting them as the lowerdirs of an overlay filesystem.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import platform
+import shutil
+import stat
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+from . import ChrootError, ChrootManager, _linux
+
+logger = logging.getLogger(__name__)
+
+WHITEOUT_PREFIX = ".wh."
+OPAQUE_WHITEOUT = ".wh..wh..opq"
+
+_INDEX_TYPES = {
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+}
+_REF_ANNOTATION = "org.opencontainers.image.ref.name"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# platform.machine() -> OCI architecture
+_ARCHITECTURES = {
+    "x86_64": "amd64",
+    "aarch64": "arm64",
+    "armv7l": "arm",
+    "i686": "386",
+    "ppc64le": "ppc64le",
+    "s390x": "s390x",
+    "riscv64": "riscv64",
+}
+
+
+def default_cache_dir() -> Path:
+    """Return the layer cache used when none is given ($XDG_CACHE_HOME/chorut/layers)."""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return Path(base) / "chorut" / "layers"
+
+
+@dataclass(frozen=True, slots=True)
+class Layer:
+    """A layer blob and, when known in advance, its 'sha256:...' digest."""
+
+    path: Path
+    digest: str | None = None
+
+
+@dataclass(slots=True)
+class ImportResult:
+    """What import_image() did."""
+
+    dest: Path
+    layers: list[Path]
+    strategy: str
+    unpacked: int = 0
+    bytes_copied: int = 0
+    duration: float = 0.0
+
+
+def _sha256_file(path: str | Path) -> str:
+    with open(path, "rb") as f:
+        return "sha256:" + hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def oci_layers(layout: str | Path, ref: str | None = None) -> list[Layer]:
+    """
+    Return the layers of an image in an OCI image layout, bottom layer first.
+
+    Args:
+        layout: Directory containing oci-layout, index.json and blobs/
+        ref: Reference name to select (org.opencontainers.image.ref.name), needed
+            when the index lists more than one image
+
+    Raises:
+        ChrootError: If the layout is invalid or the image cannot be selected
+    """
+    layout = Path(layout)
+
+    def blob(digest: str) -> Path:
+        algorithm, _, value = digest.partition(":")
+        if algorithm != "sha256" or not value.isalnum():
+            raise ChrootError(f"Unsupported digest in {layout}: {digest}")
+        return layout / "blobs" / algorithm / value
+
+    def read_json(path: Path) -> dict:
+        try:
+            return json.loads(path.read_text())
+        except (OSError, json.JSONDecodeError) as e:
+            raise ChrootError(f"Invalid OCI layout {layout}: {e}") from None
+
+    if not (layout / "oci-layout").is_file():
+        raise ChrootError(f"Not an OCI image layout (no oci-layout file): {layout}")
+
+    descriptors = read_json(layout / "index.json").get("manifests", [])
+    if ref is not None:
+        descriptors = [d for d in descriptors if d.get("annotations", {}).get(_REF_ANNOTATION) == ref]
+        if not descriptors:
+            raise ChrootError(f"No image named '{ref}' in {layout}")
+    if len(descriptors) != 1:
+        names = sorted(d.get("annotations", {}).get(_REF_ANNOTATION, d.get("digest", "?")) for d in descriptors)
+        raise ChrootError(f"Select one of the images in {layout} with a ref: {', '.join(names) or 'none found'}")
+
+    descriptor = descriptors[0]
+    manifest = read_json(blob(descriptor["digest"]))
+    # An image index lists one manifest per platform; pick the one for this machine
+    if descriptor.get("mediaType") in _INDEX_TYPES or manifest.get("mediaType") in _INDEX_TYPES:
+        architecture = _ARCHITECTURES.get(platform.machine(), platform.machine())
+        matches = [
+            d
+            for d in manifest.get("manifests", [])
+            if d.get("platform", {}).get("os") == "linux" and d.get("platform", {}).get("architecture") == architecture
+        ]
+        if not matches:
+            raise ChrootError(f"No linux/{architecture} image in {layout}")
+        manifest = read_json(blob(matches[0]["digest"]))
+
+    return [Layer(blob(d["digest"]), d["digest"]) for d in manifest.get("layers", [])]
+
+
+@contextlib.contextmanager
+def _open_layer(path: Path):
+    """Yield a binary stream of a layer, decompressing zstd through the zstd tool."""
+    with open(path, "rb") as f:
+        if f.read(4) != _ZSTD_MAGIC:
+            f.seek(0)
+            yield f
+            return
+        f.seek(0)
+        try:
+            process = subprocess.Popen(["zstd", "-dc"], stdin=f, stdout=subprocess.PIPE)
+        except FileNotFoundError:
+            raise ChrootError(f"Layer {path} is zstd compressed, but the zstd tool is not installed") from None
+        try:
+            yield process.stdout
+        finally:
+            process.stdout.close()
+            if process.wait() != 0:
+                raise ChrootError(f"zstd failed to decompress {path}")
+
+
+def _unpack_layer(blob: str, digest: str | None, cache_dir: str) -> tuple[str, str, bool]:
+    """
+    Unpack one layer into the cache unless it is already there.
+
+    Runs in a worker process. Returns the layer directory, the digest and
+    whether it was unpacked by this call.
+    """
+    actual = _sha256_file(blob)
+    if digest is not None and digest != actual:
+        raise ChrootError(f"Layer {blob} does not match its digest {digest} (got {actual})")
+
+    final = Path(cache_dir) / "sha256" / actual.partition(":")[2]
+    if final.is_dir():
+        return str(final), actual, False
+
+    tmp = Path(cache_dir) / "tmp" / f"{final.name}.{os.getpid()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    try:
+        chroot = ChrootManager(tmp)
+        try:
+            with _open_layer(Path(blob)) as stream:
+                chroot.import_tar(stream)
+        finally:
+            chroot.teardown()
+        final.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.rename(tmp, final)
+        except OSError:
+            # Another import unpacked the same layer first
+            if not final.is_dir():
+                raise
+            shutil.rmtree(tmp)
+            return str(final), actual, False
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return str(final), actual, True
+
+
+class LayerCache:
+    """A directory of unpacked layers, named by the SHA-256 of their blobs."""
+
+    def __init__(self, directory: str | Path | None = None):
+        self.directory = Path(directory) if directory is not None else default_cache_dir()
+
+    def path(self, digest: str) -> Path:
+        """Return where the layer with a 'sha256:...' digest is (or would be) unpacked."""
+        return self.directory / "sha256" / digest.partition(":")[2]
+
+    def unpack(self, layers: list[Layer], jobs: int | None = None) -> tuple[list[Path], int]:
+        """
+        Make sure every layer is unpacked, unpacking missing ones in parallel.
+
+        Returns:
+            The layer directories in the given order and how many were unpacked now
+        """
+        missing = [layer for layer in layers if layer.digest is None or not self.path(layer.digest).is_dir()]
+        results: dict[Path, Path] = {layer.path: self.path(layer.digest) for layer in layers if layer not in missing}
+        unpacked = 0
+        if missing:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            with ProcessPoolExecutor(max_workers=min(jobs or os.cpu_count() or 1, len(missing))) as pool:
+                futures = [
+                    (layer, pool.submit(_unpack_layer, str(layer.path), layer.digest, str(self.directory)))
+                    for layer in missing
+                ]
+                for layer, future in futures:
+                    path, digest, fresh = future.result()
+                    results[layer.path] = Path(path)
+                    unpacked += fresh
+                    logger.debug(f"Layer {digest} {'unpacked' if fresh else 'cached'}: {layer.path}")
+        return [results[layer.path] for layer in layers], unpacked
+
+    def overlay_view(self, layer_dir: Path) -> Path:
+        """
+        Return a copy of an unpacked layer usable as an overlayfs lowerdir.
+
+        The copy is a hardlink farm of the layer in which whiteout markers are
+        turned into 0/0 character devices and opaque markers into the
+        trusted.overlay.opaque attribute. Creating it requires root.
+        """
+        view = self.directory / "overlay" / layer_dir.name
+        if view.is_dir():
+            return view
+
+        tmp = self.directory / "tmp" / f"overlay-{layer_dir.name}.{os.getpid()}"
+        shutil.rmtree(tmp, ignore_errors=True)
+        try:
+            for dirpath, dirnames, filenames in os.walk(layer_dir):
+                target = tmp / os.path.relpath(dirpath, layer_dir)
+                target.mkdir(parents=True, exist_ok=True)
+                shutil.copystat(dirpath, target, follow_symlinks=False)
+                st = os.lstat(dirpath)
+                os.chown(target, st.st_uid, st.st_gid)
+                for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]:
+                    if name == OPAQUE_WHITEOUT:
+                        os.setxattr(target, "trusted.overlay.opaque", b"y")
+                    elif name.startswith(WHITEOUT_PREFIX):
+                        os.mknod(target / name[len(WHITEOUT_PREFIX) :], stat.S_IFCHR, os.makedev(0, 0))
+                    else:
+                        os.link(os.path.join(dirpath, name), target / name, follow_symlinks=False)
+            view.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.rename(tmp, view)
+            except OSError:
+                # Another import created the same view first
+                if not view.is_dir():
+                    raise
+                shutil.rmtree(tmp)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        return view
+
+
+def _remove(dir_fd: int, name: str) -> None:
+    """Remove an entry of a directory, recursively if it is a directory."""
+    try:
+        st = os.lstat(name, dir_fd=dir_fd)
+    except FileNotFoundError:
+        return
+    if stat.S_ISDIR(st.st_mode):
+        shutil.rmtree(name, dir_fd=dir_fd)
+    else:
+        os.unlink(name, dir_fd=dir_fd)
+
+
+def _copy_metadata(st: os.stat_result, path: int | str, dir_fd: int | None = None) -> None:
+    no_follow = {} if isinstance(path, int) else {"dir_fd": dir_fd, "follow_symlinks": False}
+    if os.geteuid() == 0:
+        os.chown(path, st.st_uid, st.st_gid, **no_follow)
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(path, stat.S_IMODE(st.st_mode), **({} if isinstance(path, int) else {"dir_fd": dir_fd}))
+    os.utime(path, ns=(st.st_mtime_ns, st.st_mtime_ns), **no_follow)
+
+
+class _LayerApplier:
+    """Copies unpacked layers onto a root directory in order, applying whiteouts."""
+
+    def __init__(self, root_fd: int):
+        self.root_fd = root_fd
+        self.bytes_copied = 0
+        self.reflinked = 0
+        # inode in the layer -> path below the root of its first copy, to keep hardlinks
+        self._links: dict[int, str] = {}
+
+    def apply(self, layer_dir: Path) -> None:
+        self._links.clear()
+        self._apply_dir(str(layer_dir), "", self.root_fd)
+
+    def _apply_dir(self, src: str, rel: str, dst_fd: int) -> None:
+        with os.scandir(src) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+
+        # Whiteouts hide what lower layers put here, so they go before this layer's own entries
+        if any(entry.name == OPAQUE_WHITEOUT for entry in entries):
+            for name in os.listdir(dst_fd):
+                _remove(dst_fd, name)
+        for entry in entries:
+            if entry.name.startswith(WHITEOUT_PREFIX) and entry.name != OPAQUE_WHITEOUT:
+                _remove(dst_fd, entry.name[len(WHITEOUT_PREFIX) :])
+
+        for entry in entries:
+            if entry.name.startswith(WHITEOUT_PREFIX):
+                continue
+            st = entry.stat(follow_symlinks=False)
+            name = entry.name
+            path = f"{rel}/{name}" if rel else name
+
+            if stat.S_ISDIR(st.st_mode):
+                with contextlib.suppress(FileNotFoundError):
+                    if not stat.S_ISDIR(os.lstat(name, dir_fd=dst_fd).st_mode):
+                        os.unlink(name, dir_fd=dst_fd)
+                with contextlib.suppress(FileExistsError):
+                    os.mkdir(name, 0o700, dir_fd=dst_fd)
+                child_fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=dst_fd)
+                try:
+                    self._apply_dir(entry.path, path, child_fd)
+                    _copy_metadata(st, child_fd)
+                finally:
+                    os.close(child_fd)
+                continue
+
+            _remove(dst_fd, name)
+            if st.st_nlink > 1 and st.st_ino in self._links:
+                os.link(self._links[st.st_ino], name, src_dir_fd=self.root_fd, dst_dir_fd=dst_fd, follow_symlinks=False)
+                continue
+
+            if stat.S_ISREG(st.st_mode):
+                self._copy_file(entry.path, name, dst_fd, st)
+            elif stat.S_ISLNK(st.st_mode):
+                os.symlink(os.readlink(entry.path), name, dir_fd=dst_fd)
+                _copy_metadata(st, name, dst_fd)
+            else:
+                os.mknod(name, st.st_mode, st.st_rdev, dir_fd=dst_fd)
+                _copy_metadata(st, name, dst_fd)
+            if st.st_nlink > 1:
+                self._links[st.st_ino] = path
+
+    def _copy_file(self, src: str, name: str, dst_fd: int, st: os.stat_result) -> None:
+        src_fd = os.open(src, os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC)
+        try:
+            fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, 0o600, dir_fd=dst_fd)
+            try:
+                if _linux.reflink(src_fd, fd):
+                    self.reflinked += 1
+                else:
+                    self.bytes_copied += _linux.copy_fd(src_fd, fd)
+                _copy_metadata(st, fd)
+            finally:
+                os.close(fd)
+        finally:
+            os.close(src_fd)
+
+
+def _layers_from_sources(sources: list[str | Path], ref: str | None) -> list[Layer]:
+    layers: list[Layer] = []
+    for source in sources:
+        source = Path(source)
+        if source.is_dir():
+            layers.extend(oci_layers(source, ref))
+        elif source.is_file():
+            layers.append(Layer(source))
+        else:
+            raise ChrootError(f"Image source not found: {source}")
+    return layers
+
+
+def import_image(
+    sources: list[str | Path],
+    dest: str | Path,
+    cache_dir: str | Path | None = None,
+    strategy: str = "copy",
+    ref: str | None = None,
+    jobs: int | None = None,
+) -> ImportResult:
+    """
+    Build a chroot directory from OCI image layouts and/or layer tarballs.
+
+    Sources are applied in order, bottom layer first: an OCI layout directory
+    contributes the layers of its image, and a tarball (optionally compressed
+    with gzip, bzip2, xz or zstd) is one layer.
+
+    Args:
+        sources: OCI image layout directories and tarballs
+        dest: Directory to create the root in (must be empty or not exist)
+        cache_dir: Layer cache directory (default: $XDG_CACHE_HOME/chorut/layers)
+        strategy: 'copy' to copy the layers into dest, with reflinks where the filesystem
+            supports them, or 'overlay' to mount them read-only under a writable overlay
+            at dest (requires root; upper and work directories are created next to dest)
+        ref: Image to select in OCI layouts that contain several
+        jobs: Number of layers to unpack in parallel (default: the number of CPUs)
+
+    Returns:
+        An ImportResult
+
+    Raises:
+        ChrootError: If a source is invalid, a layer cannot be unpacked or dest cannot be built
+    """
+    if strategy not in ("copy", "overlay"):
+        raise ChrootError(f"Unknown import strategy: {strategy}")
+    if strategy == "overlay" and os.geteuid() != 0:
+        raise ChrootError("The overlay strategy requires root privileges")
+
+    start = time.monotonic()
+    dest = Path(dest)
+    cache = LayerCache(cache_dir)
+    layers = _layers_from_sources(sources, ref)
+    if not layers:
+        raise ChrootError("No layers to import")
+
+    try:
+        dest.mkdir(parents=True, exist_ok=True)
+        if any(dest.iterdir()):
+            raise ChrootError(f"Destination is not empty: {dest}")
+
+        layer_dirs, unpacked = cache.unpack(layers, jobs)
+        result = ImportResult(dest, layer_dirs, strategy, unpacked)
+
+        if strategy == "overlay":
+            lower = [str(cache.overlay_view(layer_dir)) for layer_dir in reversed(layer_dirs)]
+            upper = dest.with_name(f".{dest.name}.upper")
+            work = dest.with_name(f".{dest.name}.work")
+            upper.mkdir(exist_ok=True)
+            work.mkdir(exist_ok=True)
+            options = f"lowerdir={':'.join(lower)},upperdir={upper},workdir={work}"
+            _linux.mount("overlay", str(dest), "overlay", 0, options)
+        else:
+            root_fd = os.open(dest, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+            try:
+                applier = _LayerApplier(root_fd)
+                for layer_dir in layer_dirs:
+                    applier.apply(layer_dir)
+            finally:
+                os.close(root_fd)
+            result.bytes_copied = applier.bytes_copied
+            logger.debug(f"{applier.reflinked} files reflinked, {applier.bytes_copied} bytes copied")
+    except OSError as e:
+        raise ChrootError(f"Failed to import image into {dest}: {e}") from None
+
+    result.duration = time.monotonic() - start
+    logger.debug(
+        f"Imported {len(layers)} layers ({unpacked} unpacked) into {dest} with {strategy} "
+        f"in {result.duration:.3f}s, {result.bytes_copied} bytes copied"
+    )
+    return result
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Command-line interface for 'chorut import'."""
+    parser = argparse.ArgumentParser(
+        prog="chorut import",
+        description="Build a chroot directory from OCI image layouts and layer tarballs",
+    )
+    parser.add_argument("dest", help="Directory to create the root in")
+    parser.add_argument("sources", nargs="+", help="OCI image layout directories and tarballs, bottom layer first")
+    parser.add_argument("-r", "--ref", help="Image to select in an OCI layout with several images")
+    parser.add_argument("-C", "--cache", help="Layer cache directory (default: $XDG_CACHE_HOME/chorut/layers)")
+    parser.add_argument(
+        "-s",
+        "--strategy",
+        choices=["copy", "overlay"],
+        default="copy",
+        help="Copy layers into DEST (reflinked when possible) or mount them as an overlay (root only)",
+    )
+    parser.add_argument("-j", "--jobs", type=int, metavar="N", help="Number of layers to unpack in parallel")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose logging")
+
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    try:
+        result = import_image(args.sources, args.dest, args.cache, args.strategy, args.ref, args.jobs)
+    except ChrootError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    print(
+        f"Imported {len(result.layers)} layers into {result.dest} ({result.unpacked} unpacked, "
+        f"{result.bytes_copied} bytes copied) in {result.duration:.2f}s",
+        file=sys.stderr,
+    )
+    if result.strategy == "overlay":
+        print(f"{result.dest} is an overlay mount; unmount it with 'umount {result.dest}'", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
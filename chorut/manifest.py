@@ -0,0 +1,237 @@
+"""
+Manifests of a chroot directory, for finding which files a command changed.
+
+A Manifest records the inode, mtime, size, mode and optionally the SHA-256
+of every path below a root, plus the child names of every directory. Scans
+are incremental: a directory whose mtime and inode match the base manifest
+has the same entries as before, so it is not read again and only its
+entries are stat()ed. Directories are processed level by level on a thread
+pool, and mount points below the root are skipped, like 'find -xdev'.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+# Layout of an entry tuple
+INO, MTIME, SIZE, MODE, DIGEST = range(5)
+
+# Directories modified less than this long before a scan may still change within the same mtime tick
+_RACY_NS = 2_000_000_000
+
+# Fewest directories handed to a scanning thread at once
+_MIN_BATCH = 16
+
+_FORMAT = 1
+
+
+@dataclass(frozen=True, slots=True)
+class ManifestDiff:
+    """Paths (relative to the root, starting with '/') that differ between two manifests."""
+
+    created: set[str] = field(default_factory=set)
+    modified: set[str] = field(default_factory=set)
+    deleted: set[str] = field(default_factory=set)
+
+    def __bool__(self) -> bool:
+        return bool(self.created or self.modified or self.deleted)
+
+
+class Manifest:
+    """The recorded state of every path below a root directory."""
+
+    __slots__ = ("dirs", "entries", "hashed", "root", "scan_time")
+
+    def __init__(
+        self,
+        root: str | Path,
+        entries: dict[str, tuple] | None = None,
+        dirs: dict[str, tuple] | None = None,
+        hashed: bool = False,
+        scan_time: int = 0,
+    ):
+        self.root = str(root)
+        # path -> (ino, mtime_ns, size, mode, digest or None)
+        self.entries = entries or {}
+        # directory path -> (mtime_ns, ino, child names); mtime_ns is -1 when it cannot be trusted
+        self.dirs = dirs or {}
+        self.hashed = hashed
+        self.scan_time = scan_time
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, path: str) -> bool:
+        return path in self.entries
+
+    @classmethod
+    def load(cls, path: str | Path) -> "Manifest":
+        """Read a manifest written by save()."""
+        data = json.loads(Path(path).read_text())
+        if data.get("format") != _FORMAT:
+            raise ValueError(f"Unsupported manifest format in {path}")
+        return cls(
+            data["root"],
+            {name: tuple(entry) for name, entry in data["entries"].items()},
+            {name: (entry[0], entry[1], tuple(entry[2])) for name, entry in data["dirs"].items()},
+            data["hashed"],
+            data["scan_time"],
+        )
+
+    def save(self, path: str | Path) -> None:
+        """Write the manifest to a file, atomically replacing it."""
+        path = Path(path)
+        data = {
+            "format": _FORMAT,
+            "root": self.root,
+            "hashed": self.hashed,
+            "scan_time": self.scan_time,
+            "entries": self.entries,
+            "dirs": self.dirs,
+        }
+        tmp = path.with_name(f".{path.name}.tmp")
+        tmp.write_text(json.dumps(data, separators=(",", ":")))
+        os.replace(tmp, path)
+
+    def diff(self, newer: "Manifest") -> ManifestDiff:
+        """
+        Compare with a newer manifest of the same root.
+
+        Files count as modified when their inode, mtime, size or mode changed,
+        or, if both manifests are hashed, only when their content or mode
+        changed. Directories count as modified only when their inode or mode
+        changed, since their mtime follows every entry added or removed.
+        """
+        old, new = self.entries, newer.entries
+        both_hashed = self.hashed and newer.hashed
+        created = new.keys() - old.keys()
+        deleted = old.keys() - new.keys()
+        modified = set()
+        for path in old.keys() & new.keys():
+            before, after = old[path], new[path]
+            if before == after:
+                continue
+            if before[MODE] != after[MODE]:
+                modified.add(path)
+            elif stat.S_ISDIR(after[MODE]):
+                if before[INO] != after[INO]:
+                    modified.add(path)
+            elif both_hashed and stat.S_ISREG(after[MODE]):
+                if before[DIGEST] != after[DIGEST]:
+                    modified.add(path)
+            elif before[:MODE] != after[:MODE]:
+                modified.add(path)
+        return ManifestDiff(set(created), modified, set(deleted))
+
+
+def _digest(path: str) -> str:
+    fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC)
+    with open(fd, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def _entry(st: os.stat_result, previous: tuple | None, full_path: str, racy_before: int) -> tuple:
+    """Build the entry of a path in a hashed manifest."""
+    digest = None
+    if stat.S_ISREG(st.st_mode):
+        unchanged = previous is not None and previous[:DIGEST] == (st.st_ino, st.st_mtime_ns, st.st_size, st.st_mode)
+        # A file written in the same mtime tick as the previous scan may have changed unnoticed
+        if unchanged and previous[DIGEST] is not None and previous[MTIME] < racy_before:
+            digest = previous[DIGEST]
+        else:
+            digest = _digest(full_path)
+    return (st.st_ino, st.st_mtime_ns, st.st_size, st.st_mode, digest)
+
+
+def scan(root: str | Path, base: Manifest | None = None, hash: bool = False, workers: int | None = None) -> Manifest:
+    """
+    Scan a directory tree and return its manifest.
+
+    Args:
+        root: Directory to scan
+        base: A previous manifest of the same root; unchanged directories are not read again
+            and unchanged files are not hashed again
+        hash: Whether to record the SHA-256 of regular files
+        workers: Number of scanning threads (default: the number of CPUs plus 4, at most 32)
+
+    Returns:
+        The new Manifest
+    """
+    root = os.path.abspath(root)
+    if base is not None and base.root != root:
+        base = None
+    base_entries = base.entries if base is not None else {}
+    base_dirs = base.dirs if base is not None else {}
+    racy_before = base.scan_time - _RACY_NS if base is not None else 0
+
+    scan_time = time.time_ns()
+    root_st = os.lstat(root)
+    root_dev = root_st.st_dev
+    entries: dict[str, tuple] = {}
+    dirs: dict[str, tuple] = {}
+
+    def scan_dir(path: str, st: os.stat_result, subdirs: list[tuple[str, os.stat_result]]) -> None:
+        full = root + path if path != "/" else root
+        prefix = path.rstrip("/") + "/"
+        known = base_dirs.get(path)
+
+        if known is not None and known[0] == st.st_mtime_ns and known[1] == st.st_ino:
+            names = known[2]
+            stats = []
+            try:
+                dir_fd = os.open(full, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC)
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                return
+            try:
+                for name in names:
+                    # Removed after the directory mtime was read; it is rescanned next time
+                    with contextlib.suppress(FileNotFoundError):
+                        stats.append((name, os.lstat(name, dir_fd=dir_fd)))
+            finally:
+                os.close(dir_fd)
+        else:
+            try:
+                with os.scandir(full) as it:
+                    stats = [(entry.name, entry.stat(follow_symlinks=False)) for entry in it]
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                return
+            names = tuple(sorted(name for name, _ in stats))
+
+        for name, child_st in stats:
+            child = prefix + name
+            if hash:
+                try:
+                    entries[child] = _entry(child_st, base_entries.get(child), f"{full}/{name}", racy_before)
+                except (FileNotFoundError, PermissionError):
+                    continue
+            else:
+                entries[child] = (child_st.st_ino, child_st.st_mtime_ns, child_st.st_size, child_st.st_mode, None)
+            if stat.S_ISDIR(child_st.st_mode) and child_st.st_dev == root_dev:
+                subdirs.append((child, child_st))
+
+        mtime = st.st_mtime_ns if st.st_mtime_ns < scan_time - _RACY_NS else -1
+        dirs[path] = (mtime, st.st_ino, names)
+
+    def scan_batch(batch: list[tuple[str, os.stat_result]]) -> list[tuple[str, os.stat_result]]:
+        subdirs: list[tuple[str, os.stat_result]] = []
+        for path, st in batch:
+            scan_dir(path, st, subdirs)
+        return subdirs
+
+    level = [("/", root_st)]
+    workers = workers or min(32, (os.cpu_count() or 1) + 4)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Several directories per task, so that small directories do not drown in scheduling overhead
+        chunks = workers * 4
+        while level:
+            size = max(_MIN_BATCH, -(-len(level) // chunks))
+            batches = [level[i : i + size] for i in range(0, len(level), size)]
+            level = [subdir for subdirs in pool.map(scan_batch, batches) for subdir in subdirs]
+
+    return Manifest(root, entries, dirs, hash, scan_time)
@@ -0,0 +1,259 @@
+"""
+Page-cache prefetching of the files a chroot uses, learned from previous runs.
+
+The first command after a reboot or cache eviction loads bash, the dynamic
+loader and the libraries inside the root from disk, one page fault at a
+time. A Profile records which files below the root the processes of a
+chroot mapped, executed or held open, by sampling /proc while commands run.
+prefetch() replays it with posix_fadvise(POSIX_FADV_WILLNEED) from a thread
+pool, so all those reads are queued at once and overlap with mounting
+instead of stalling the first command.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from . import _linux
+
+logger = logging.getLogger(__name__)
+
+# Most files kept in a profile; the ones not seen for the longest time are dropped first
+MAX_FILES = 4096
+
+# Mount points of the standard mounts, whose files are virtual or short-lived
+_SKIP = ("/dev/", "/proc/", "/run/", "/sys/", "/tmp/")
+
+# Seconds between two samples of a running process tree
+_INTERVAL = 0.01
+
+_FORMAT = 1
+
+
+@dataclass(slots=True)
+class PrefetchResult:
+    """What prefetch() did."""
+
+    files: int = 0
+    bytes: int = 0
+    missing: list[str] = field(default_factory=list)
+    duration: float = 0.0
+
+
+class Profile:
+    """The files below a chroot that previous runs used, stored in a JSON file."""
+
+    __slots__ = ("_lock", "dirty", "files", "path")
+
+    def __init__(self, path: str | Path, files: list[str] | None = None):
+        self.path = Path(path)
+        # Paths inside the chroot, least recently seen first
+        self.files: dict[str, None] = dict.fromkeys(files or ())
+        self.dirty = False
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    @classmethod
+    def load(cls, path: str | Path) -> "Profile":
+        """Read a profile written by save(); a missing or unreadable file gives an empty profile."""
+        try:
+            data = json.loads(Path(path).read_text())
+        except FileNotFoundError:
+            return cls(path)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable prefetch profile {path}: {e}")
+            return cls(path)
+        if data.get("format") != _FORMAT:
+            logger.warning(f"Ignoring prefetch profile {path} with an unsupported format")
+            return cls(path)
+        return cls(path, data["files"])
+
+    def save(self) -> None:
+        """Write the profile if it changed, atomically replacing the file."""
+        with self._lock:
+            if not self.dirty:
+                return
+            data = {"format": _FORMAT, "files": list(self.files)}
+            self.dirty = False
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f".{self.path.name}.tmp")
+        tmp.write_text(json.dumps(data, separators=(",", ":")))
+        os.replace(tmp, self.path)
+
+    def add(self, paths) -> None:
+        """Mark paths as used by the latest run."""
+        with self._lock:
+            for path in paths:
+                # Moving a known path to the end changes the order that
+                # the MAX_FILES trim and the prefetch use, so it counts too.
+                if next(reversed(self.files), None) != path:
+                    self.files.pop(path, None)
+                    self.files[path] = None
+                    self.dirty = True
+            excess = len(self.files) - MAX_FILES
+            if excess > 0:
+                for path in list(self.files)[:excess]:
+                    del self.files[path]
+                self.dirty = True
+
+    def discard(self, paths) -> None:
+        """Forget paths, e.g. files that no longer exist."""
+        with self._lock:
+            for path in paths:
+                if self.files.pop(path, True) is None:
+                    self.dirty = True
+
+    def record(self, root: str | Path, pid: int, interval: float = _INTERVAL) -> "Recorder":
+        """Return a context manager that samples the files used by a process tree into this profile."""
+        return Recorder(self, str(root), pid, interval)
+
+
+def _process_tree(pid: int) -> list[int]:
+    """Return a process and its descendants, parents first."""
+    pids = [pid]
+    for parent in pids:
+        try:
+            tasks = os.listdir(f"/proc/{parent}/task")
+        except FileNotFoundError:
+            continue
+        for tid in tasks:
+            try:
+                with open(f"/proc/{parent}/task/{tid}/children") as f:
+                    pids.extend(int(child) for child in f.read().split())
+            except FileNotFoundError:
+                if not os.path.exists(f"/proc/{parent}/task/{tid}"):
+                    continue
+                # Kernel without CONFIG_PROC_CHILDREN
+                return _process_tree_by_ppid(pid)
+    return pids
+
+
+def _process_tree_by_ppid(pid: int) -> list[int]:
+    children: dict[int, list[int]] = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat", "rb") as f:
+                # The command name may contain spaces and parentheses, the fields after it cannot
+                ppid = int(f.read().rpartition(b")")[2].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+    pids = [pid]
+    for parent in pids:
+        pids.extend(children.get(parent, ()))
+    return pids
+
+
+class Recorder:
+    """Samples the files below a root that a process tree uses, until the context exits."""
+
+    def __init__(self, profile: Profile, root: str, pid: int, interval: float):
+        self.profile = profile
+        self.pid = pid
+        self.interval = interval
+        self.seen: dict[str, None] = {}
+        self._prefix = root.rstrip("/") + "/"
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"chorut-profile-{pid}", daemon=True)
+
+    def __enter__(self) -> "Recorder":
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+        self.profile.add(self.seen)
+        logger.debug(f"Recorded {len(self.seen)} files used by process {self.pid}")
+
+    def _note(self, path: str) -> None:
+        if path.startswith(self._prefix) and not path.endswith(" (deleted)"):
+            path = path[len(self._prefix) - 1 :]
+            if not path.startswith(_SKIP):
+                self.seen.setdefault(path)
+
+    def sample(self) -> None:
+        """Note the files currently mapped, executed or open by the process tree."""
+        for pid in _process_tree(self.pid):
+            proc = f"/proc/{pid}"
+            try:
+                with open(f"{proc}/maps") as f:
+                    for line in f:
+                        fields = line.split(maxsplit=5)
+                        if len(fields) == 6:
+                            self._note(fields[5].rstrip("\n"))
+                self._note(os.readlink(f"{proc}/exe"))
+                for fd in os.listdir(f"{proc}/fd"):
+                    with contextlib.suppress(OSError):
+                        self._note(os.readlink(f"{proc}/fd/{fd}"))
+            except (FileNotFoundError, ProcessLookupError, PermissionError):
+                # Exited between listing and reading, or not ours to inspect
+                continue
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+
+def prefetch(root: str | Path, paths, workers: int = 16) -> PrefetchResult:
+    """
+    Ask the kernel to read files below a root into the page cache.
+
+    Each file is opened inside the root (symlinks cannot lead outside of it)
+    and passed to posix_fadvise(POSIX_FADV_WILLNEED), which queues the reads
+    and returns without waiting for them.
+
+    Args:
+        root: The chroot directory
+        paths: Paths inside the root, e.g. the files of a Profile
+        workers: Number of threads opening files in parallel
+
+    Returns:
+        A PrefetchResult; missing lists the paths that no longer exist
+    """
+    start = time.monotonic()
+    result = PrefetchResult()
+    lock = threading.Lock()
+    root_fd = os.open(root, os.O_PATH | os.O_DIRECTORY | os.O_CLOEXEC)
+
+    def advise(path: str) -> None:
+        try:
+            fd = _linux.open_in_root(root_fd, path, os.O_RDONLY | os.O_NONBLOCK | os.O_NOCTTY)
+        except (FileNotFoundError, NotADirectoryError):
+            with lock:
+                result.missing.append(path)
+            return
+        except OSError:
+            return
+        try:
+            st = os.fstat(fd)
+            if stat.S_ISREG(st.st_mode):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                with lock:
+                    result.files += 1
+                    result.bytes += st.st_size
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chorut-prefetch") as pool:
+            for _ in pool.map(advise, list(paths)):
+                pass
+    finally:
+        os.close(root_fd)
+    result.duration = time.monotonic() - start
+    return result
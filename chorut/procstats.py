@@ -0,0 +1,399 @@
+"""
+Sampling of the CPU time, memory and I/O of the processes a command starts.
+
+When a command in a chroot is slow, its exit code does not say which of the
+processes it started is responsible. A Sampler reads /proc at a fixed
+interval for the command and all its descendants. In unshare mode that is
+every process in the command's pid namespace. In root mode it also adopts
+processes whose root directory is the chroot, such as daemons that left the
+tree. A sample reads /proc/PID/stat and /proc/PID/io of each process; the
+command line is read once per process, and samples equal to the previous one
+are not stored. Trees too large to sample within 2% of a CPU are sampled less
+often, so the sampler can stay on for every command.
+
+Processes that start and exit between two samples are not seen, and the
+counters of a process are those of its last sample.
+"""
+
+import contextlib
+import logging
+import os
+import threading
+import time
+from array import array
+from dataclasses import dataclass, field
+
+from .prefetch import _process_tree_by_ppid
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two samples
+INTERVAL = 0.1
+
+# Largest fraction of a CPU the sampler uses: large trees are sampled less often than the interval
+_MAX_LOAD = 0.02
+
+# In root mode, /proc is scanned for processes that left the tree once every this many samples
+_SCAN_EVERY = 10
+
+# Processes whose /proc files are kept open between samples, three files each
+_MAX_OPEN = 128
+
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# Values stored per sample in ProcessStats.samples
+_FIELDS = 5
+
+
+@dataclass(frozen=True, slots=True)
+class Sample:
+    """The counters of a process at one sample. time is in seconds from the start of the command."""
+
+    time: float
+    cpu_time: float
+    rss: int
+    read_bytes: int
+    write_bytes: int
+
+
+@dataclass(slots=True)
+class ProcessStats:
+    """
+    A process seen while sampling, with its counters over time. Times are in seconds.
+
+    The I/O counters are those of the process itself: unlike in /proc/PID/io, the
+    children it has waited for are not included.
+    """
+
+    pid: int
+    # At the last sample
+    ppid: int
+    cmdline: list[str]
+    first_seen: float
+    last_seen: float = 0.0
+    max_rss: int = 0
+    # time, cpu_time, rss, read_bytes and write_bytes of each sample that changed a counter
+    samples: array = field(default_factory=lambda: array("d"))
+
+    def _add(self, now: float, cpu_time: float, rss: int, read_bytes: int, write_bytes: int) -> None:
+        self.last_seen = now
+        self.max_rss = max(self.max_rss, rss)
+        if self.samples and self.samples[-4:] == array("d", (cpu_time, rss, read_bytes, write_bytes)):
+            return
+        self.samples.extend((now, cpu_time, rss, read_bytes, write_bytes))
+
+    def _last(self, index: int) -> float:
+        return self.samples[index - _FIELDS] if self.samples else 0.0
+
+    @property
+    def cpu_time(self) -> float:
+        """User and system CPU time at the last sample."""
+        return self._last(1)
+
+    @property
+    def read_bytes(self) -> int:
+        """Bytes read from storage at the last sample."""
+        return int(self._last(3))
+
+    @property
+    def write_bytes(self) -> int:
+        """Bytes written to storage at the last sample."""
+        return int(self._last(4))
+
+    @property
+    def timeline(self) -> list[Sample]:
+        """The samples that changed a counter, in order."""
+        values = self.samples
+        return [
+            Sample(values[i], values[i + 1], int(values[i + 2]), int(values[i + 3]), int(values[i + 4]))
+            for i in range(0, len(values), _FIELDS)
+        ]
+
+
+@dataclass(slots=True)
+class ProcessReport:
+    """The processes of a command, in the order they were first seen."""
+
+    interval: float
+    processes: list[ProcessStats] = field(default_factory=list)
+    duration: float = 0.0
+    samples: int = 0
+    # Seconds spent sampling
+    overhead: float = 0.0
+
+    @property
+    def cpu_time(self) -> float:
+        return sum(process.cpu_time for process in self.processes)
+
+    @property
+    def read_bytes(self) -> int:
+        return sum(process.read_bytes for process in self.processes)
+
+    @property
+    def write_bytes(self) -> int:
+        return sum(process.write_bytes for process in self.processes)
+
+    def format(self, limit: int = 20, width: int = 60) -> str:
+        """Render the processes that used the most CPU time as a table."""
+        lines = [f"{'PID':>7}  {'CPU':>7}  {'MAXRSS':>8}  {'READ':>8}  {'WRITE':>8}  {'TIME':>7}  COMMAND"]
+        for process in sorted(self.processes, key=lambda p: p.cpu_time, reverse=True)[:limit]:
+            command = " ".join(process.cmdline)
+            if len(command) > width:
+                command = command[: width - 3] + "..."
+            lines.append(
+                f"{process.pid:>7}  {process.cpu_time:7.2f}  {_size(process.max_rss):>8}  "
+                f"{_size(process.read_bytes):>8}  {_size(process.write_bytes):>8}  "
+                f"{process.last_seen - process.first_seen:7.2f}  {command}"
+            )
+        if len(self.processes) > limit:
+            lines.append(f"... {len(self.processes) - limit} more processes")
+        lines.append(
+            f"{len(self.processes)} processes, {self.cpu_time:.2f}s CPU in {self.duration:.2f}s, "
+            f"{self.samples} samples every {self.interval:g}s taking {self.overhead * 1000:.1f} ms"
+        )
+        return "\n".join(lines)
+
+
+def _size(value: int) -> str:
+    for unit in ("B", "K", "M", "G"):
+        if value < 1024 or unit == "G":
+            return f"{value:.0f}{unit}" if unit == "B" else f"{value:.1f}{unit}"
+        value /= 1024
+    return ""
+
+
+def _read(path: str) -> bytes:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, 65536)
+    finally:
+        os.close(fd)
+
+
+def _cmdline(pid: int) -> list[str] | None:
+    """Return the command line of a process, or None for zombies and processes in the middle of execve()."""
+    try:
+        raw = _read(f"/proc/{pid}/cmdline")
+    except OSError:
+        return None
+    return [arg.decode(errors="replace") for arg in raw.rstrip(b"\0").split(b"\0")] if raw else None
+
+
+def _open_files(pid: int) -> list[int] | None:
+    """Open the stat, io and children files of a process, or return None if it exited."""
+    try:
+        fds = [os.open(f"/proc/{pid}/stat", os.O_RDONLY)]
+    except OSError:
+        return None
+    for path in (f"/proc/{pid}/io", f"/proc/{pid}/task/{pid}/children"):
+        try:
+            fds.append(os.open(path, os.O_RDONLY))
+        except OSError:
+            fds.append(-1)
+    return fds
+
+
+def _close_files(fds: list[int]) -> None:
+    for fd in fds:
+        if fd >= 0:
+            os.close(fd)
+
+
+class Sampler:
+    """
+    Samples a process tree into a ProcessReport until the context exits.
+
+    The /proc files of up to _MAX_OPEN processes are kept open between samples,
+    so reading them again takes one pread() each. An open file also refers to
+    its process rather than to its pid, and fails once the process is reaped.
+
+    Args:
+        pid: The process started for the command
+        interval: Seconds between two samples
+        root: In root mode, the chroot directory, to adopt processes that left the tree
+    """
+
+    def __init__(self, pid: int, interval: float = INTERVAL, root: str | None = None):
+        self.pid = pid
+        self.report = ProcessReport(interval)
+        self._root = root
+        # By pid and start time, which tell apart processes that reused a pid
+        self._processes: dict[tuple[int, int], ProcessStats] = {}
+        self._comms: dict[tuple[int, int], bytes | None] = {}
+        # Bytes read and written as the kernel reports them, and the part of them done by reaped children
+        self._io: dict[tuple[int, int], list[int]] = {}
+        # Processes of the last sample
+        self._live: dict[int, tuple[int, int]] = {}
+        # Open stat, io and children files by pid, -1 for those that cannot be read
+        self._files: dict[int, list[int]] = {}
+        # Processes found by their root directory
+        self._adopted: set[int] = set()
+        # Kernels without CONFIG_PROC_CHILDREN only give the parent of each process
+        self._by_ppid = not os.path.exists(f"/proc/self/task/{threading.get_native_id()}/children")
+        self._start_ticks: int | None = None
+        self._start = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"chorut-procstats-{pid}", daemon=True)
+
+    def __enter__(self) -> "Sampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+        while self._files:
+            _close_files(self._files.popitem()[1])
+        self.report.duration = time.monotonic() - self._start
+        logger.debug(
+            f"Sampled {len(self.report.processes)} processes of {self.pid} {self.report.samples} times "
+            f"in {self.report.overhead * 1000:.1f} ms"
+        )
+
+    def _adopt(self) -> None:
+        """Add processes that run in the root and started after the command."""
+        for name in os.listdir("/proc"):
+            if not name.isdigit() or int(name) in self._adopted:
+                continue
+            try:
+                if os.readlink(f"/proc/{name}/root") != self._root:
+                    continue
+                started = int(_read(f"/proc/{name}/stat").rpartition(b")")[2].split()[19])
+            except (OSError, IndexError, ValueError):
+                continue
+            if started >= self._start_ticks:
+                self._adopted.add(int(name))
+
+    @staticmethod
+    def _children(pid: int, fds: list[int], threads: bytes) -> list[bytes]:
+        """Return the children of a process, forked by any of its threads."""
+        try:
+            if threads == b"1" and fds[2] >= 0:
+                return os.pread(fds[2], 65536, 0).split()
+            children = []
+            for tid in os.listdir(f"/proc/{pid}/task"):
+                with contextlib.suppress(OSError):
+                    children.extend(_read(f"/proc/{pid}/task/{tid}/children").split())
+            return children
+        except OSError:
+            return []
+
+    @staticmethod
+    def _read_io(fds: list[int]) -> tuple[int, int] | None:
+        """Return the bytes a process read from and wrote to storage, or None if they cannot be read."""
+        if fds[1] < 0:
+            return None
+        try:
+            data = os.pread(fds[1], 4096, 0)
+        except PermissionError:
+            # Another user's process: stop trying
+            os.close(fds[1])
+            fds[1] = -1
+            return None
+        except OSError:
+            return None
+        read_bytes = write_bytes = 0
+        for line in data.splitlines():
+            key, _, value = line.partition(b": ")
+            if key == b"read_bytes":
+                read_bytes = int(value)
+            elif key == b"write_bytes":
+                write_bytes = int(value)
+        return read_bytes, write_bytes
+
+    def sample(self) -> None:
+        """Read the counters of every process of the command."""
+        began = time.monotonic()
+        now = began - self._start
+        if self._root is not None and self._start_ticks is not None and self.report.samples % _SCAN_EVERY == 0:
+            self._adopt()
+        queue = list(dict.fromkeys([self.pid, *sorted(self._adopted)]))
+        if self._by_ppid:
+            queue = list(dict.fromkeys(pid for top in queue for pid in _process_tree_by_ppid(top)))
+        queued = set(queue)
+
+        live: dict[int, tuple[int, int]] = {}
+        readings = []
+        unkept = []
+        for pid in queue:
+            fds = self._files.get(pid)
+            if fds is None:
+                fds = _open_files(pid)
+                if fds is None:
+                    self._adopted.discard(pid)
+                    continue
+                if len(self._files) < _MAX_OPEN:
+                    self._files[pid] = fds
+                else:
+                    unkept.append(fds)
+            try:
+                stat = os.pread(fds[0], 4096, 0)
+            except OSError:
+                # Exited since its parent listed it
+                self._adopted.discard(pid)
+                continue
+            comm, _, rest = stat.rpartition(b")")
+            fields = rest.split()
+            if not self._by_ppid:
+                for child in self._children(pid, fds, fields[17]):
+                    child_pid = int(child)
+                    if child_pid not in queued:
+                        queued.add(child_pid)
+                        queue.append(child_pid)
+
+            started = int(fields[19])
+            if pid == self.pid and self._start_ticks is None:
+                self._start_ticks = started
+            key = (pid, started)
+            process = self._processes.get(key)
+            if process is None or self._comms[key] != comm:
+                # New, or ran execve() like chroot(8) does
+                cmdline = _cmdline(pid)
+                # Without a command line, show the command name and try again next time
+                self._comms[key] = comm if cmdline is not None else None
+                cmdline = cmdline or [f"[{comm.partition(b'(')[2].decode(errors='replace')}]"]
+                if process is None:
+                    process = ProcessStats(pid, int(fields[1]), cmdline, now)
+                    self._processes[key] = process
+                    self._io[key] = [0, 0, 0, 0]
+                    self.report.processes.append(process)
+                else:
+                    process.cmdline = cmdline
+            # Orphans are reparented
+            process.ppid = int(fields[1])
+            live[pid] = key
+            cpu_time = (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+            readings.append((process, key, cpu_time, int(fields[21]) * _PAGE_SIZE, self._read_io(fds)))
+
+        for fds in unkept:
+            _close_files(fds)
+        for pid in [pid for pid in self._files if pid not in live]:
+            _close_files(self._files.pop(pid))
+
+        # The kernel adds the I/O of a reaped child to its parent's, which would count it twice
+        for pid, key in self._live.items():
+            if live.get(pid) != key:
+                child = self._processes[key]
+                parent = live.get(child.ppid)
+                if parent is not None:
+                    self._io[parent][2] += self._io[key][0]
+                    self._io[parent][3] += self._io[key][1]
+        self._live = live
+
+        for process, key, cpu_time, rss, io in readings:
+            counters = self._io[key]
+            if io is not None:
+                counters[0], counters[1] = io
+            read_bytes = max(0, counters[0] - counters[2])
+            write_bytes = max(0, counters[1] - counters[3])
+            process._add(now, cpu_time, rss, read_bytes, write_bytes)
+        self.report.samples += 1
+        self.report.overhead += time.monotonic() - began
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            began = time.monotonic()
+            self.sample()
+            cost = time.monotonic() - began
+            self._stop.wait(max(self.report.interval, cost / _MAX_LOAD - cost))
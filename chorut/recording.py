@@ -0,0 +1,198 @@
+"""
+An unprivileged stand-in for MountManager that records operations instead of performing them.
+
+A RecordingMountManager keeps an in-memory mount table and file list in
+place of the kernel's, so the setup() and teardown() of a root mode
+ChrootManager run without root, without mount(8) and without changing the
+system. Every mount, umount, symlink, file creation and removal, and
+helper spawn is recorded with its timing, and can be slowed down or made
+to fail on purpose. The table enforces what the kernel would: a mount point
+must exist, and a mount with other mounts below it cannot be unmounted
+(except lazily). Ordering, error recovery and chorut's own per-operation
+overhead can then be tested and benchmarked anywhere.
+
+Directories that setup() creates are still created: the chroot directory
+is real, only the mounts on top of it are not.
+"""
+
+import errno
+import fnmatch
+import os
+import random
+import threading
+import time
+from collections import Counter
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass
+
+from . import MountError, MountManager
+
+# Operation kinds
+MOUNT, UMOUNT, SYMLINK, TOUCH, UNLINK, SPAWN = "mount", "umount", "symlink", "touch", "unlink", "spawn"
+KINDS = (MOUNT, UMOUNT, SYMLINK, TOUCH, UNLINK, SPAWN)
+
+# Exit code of mount(8) and umount(8) for a failed mount or unmount
+_MOUNT_FAILURE = 32
+
+
+@dataclass(frozen=True, slots=True)
+class Operation:
+    """A recorded operation. Times are in seconds from the creation of the recorder."""
+
+    kind: str
+    target: str
+    args: tuple[str, ...]
+    start: float
+    duration: float
+    # Why the operation failed, or None
+    error: str | None = None
+
+
+class RecordingMountManager(MountManager):
+    """
+    A MountManager whose operations only change an in-memory mount table and are recorded.
+
+    Args:
+        latency: Seconds each operation takes, or a dict of seconds by operation kind
+            (mount, umount, symlink, touch, unlink, spawn)
+        fail: Operations to fail: a callable taking the kind and target, or glob patterns
+            matched against "KIND TARGET", e.g. "mount */dev/pts" or "umount *"
+        failure_rate: Probability of failing any operation at random
+        seed: Seed of the random failures, for reproducible runs
+    """
+
+    requires_root = False
+
+    def __init__(
+        self,
+        latency: float | dict[str, float] = 0.0,
+        fail: Callable[[str, str], bool] | Iterable[str] | None = None,
+        failure_rate: float = 0.0,
+        seed: int | None = None,
+    ):
+        super().__init__()
+        if isinstance(latency, dict):
+            unknown = set(latency) - set(KINDS)
+            if unknown:
+                raise MountError(f"Unknown operation kinds: {', '.join(sorted(unknown))}")
+        self.latency = latency
+        if fail is None or callable(fail):
+            self.fail = fail
+        else:
+            patterns = list(fail)
+            self.fail = lambda kind, target: any(fnmatch.fnmatchcase(f"{kind} {target}", p) for p in patterns)
+        self.failure_rate = failure_rate
+        self.operations: list[Operation] = []
+        # Mount point -> source, in mount order
+        self.mounts: dict[str, str] = {}
+        # Path -> symlink target, or None for plain files
+        self.files: dict[str, str | None] = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._created = time.monotonic()
+
+    def _begin(self, kind: str, target: str) -> tuple[float, bool]:
+        """Wait out the latency of an operation, and decide whether to fail it."""
+        start = time.monotonic()
+        delay = self.latency.get(kind, 0.0) if isinstance(self.latency, dict) else self.latency
+        if delay:
+            time.sleep(delay)
+        with self._lock:
+            random_failure = self.failure_rate > 0 and self._random.random() < self.failure_rate
+        return start, random_failure or (self.fail is not None and self.fail(kind, target))
+
+    def _record(self, kind: str, target: str, args: Iterable[str], start: float, error: str | None) -> None:
+        # Called with the lock held
+        end = time.monotonic()
+        self.operations.append(Operation(kind, target, tuple(args), start - self._created, end - start, error))
+
+    def _exists(self, path: str) -> bool:
+        return path in self.files or path in self.mounts or os.path.lexists(path)
+
+    def _spawn(self, cmd: list[str]) -> tuple[int, str]:
+        kind = cmd[0] if cmd[0] in (MOUNT, UMOUNT) else SPAWN
+        target = cmd[-1]
+        start, injected = self._begin(kind, target)
+        with self._lock:
+            if injected:
+                error = "injected failure"
+            elif kind == MOUNT:
+                error = None if self._exists(target) else "mount point does not exist"
+                if error is None:
+                    self.mounts.pop(target, None)
+                    self.mounts[target] = cmd[-2]
+            elif kind == UMOUNT:
+                below = [path for path in self.mounts if path.startswith(target.rstrip("/") + "/")]
+                if target not in self.mounts:
+                    error = "not mounted"
+                elif below and "--lazy" not in cmd:
+                    error = "target is busy"
+                else:
+                    error = None
+                    for path in [target, *below]:
+                        del self.mounts[path]
+            else:
+                # mountpoint -q PATH is the only helper setup() spawns; "no" is an answer, not a failure
+                error = None
+                if target not in self.mounts:
+                    self._record(kind, target, cmd, start, None)
+                    return _MOUNT_FAILURE, ""
+            self._record(kind, target, cmd, start, error)
+        if error is None:
+            return 0, ""
+        return _MOUNT_FAILURE, f"{cmd[0]}: {target}: {error}"
+
+    def _file_operation(self, kind: str, target: str, args: Iterable[str], apply: Callable[[], int]) -> None:
+        start, injected = self._begin(kind, target)
+        with self._lock:
+            code = errno.EIO if injected else apply()
+            self._record(kind, target, args, start, os.strerror(code) if code else None)
+        if code:
+            raise OSError(code, os.strerror(code), target)
+
+    def _symlink(self, source: str, target: str) -> None:
+        def apply() -> int:
+            if self._exists(target):
+                return errno.EEXIST
+            self.files[target] = source
+            return 0
+
+        self._file_operation(SYMLINK, target, (source, target), apply)
+
+    def _touch(self, path: str) -> None:
+        def apply() -> int:
+            self.files.setdefault(path, None)
+            return 0
+
+        self._file_operation(TOUCH, path, (path,), apply)
+
+    def _unlink(self, path: str) -> None:
+        def apply() -> int:
+            if path not in self.files:
+                return errno.ENOENT
+            if path in self.mounts:
+                return errno.EBUSY
+            del self.files[path]
+            return 0
+
+        self._file_operation(UNLINK, path, (path,), apply)
+
+    def _bind_idmapped(self, source: str, target: str, uid_map: str, gid_map: str, attributes: int) -> None:
+        code, error = self._spawn(["mount", "--bind", "-o", f"X-idmap,attr={attributes:#x}", source, target])
+        if code:
+            raise OSError(errno.EINVAL, error)
+
+    def counts(self) -> Counter:
+        """Return the number of operations of each kind."""
+        with self._lock:
+            return Counter(operation.kind for operation in self.operations)
+
+    def failures(self) -> list[Operation]:
+        """Return the operations that failed."""
+        with self._lock:
+            return [operation for operation in self.operations if operation.error is not None]
+
+    def clear(self) -> None:
+        """Forget the recorded operations, keeping the mount table."""
+        with self._lock:
+            self.operations.clear()
@@ -0,0 +1,589 @@
+"""
+Local daemon that keeps chroots set up and runs requests over a Unix socket.
+
+Started with 'chorut serve'. Short-lived clients connect to the socket and
+send requests; the chroots stay mounted between requests.
+
+Every frame on the socket is a 5 byte header (kind as an unsigned byte and
+payload length as an unsigned 32-bit big endian integer) followed by the
+payload. Requests and responses are JSON frames. File descriptors travel
+with a JSON frame as SCM_RIGHTS ancillary data.
+
+Requests (one at a time per connection, any number per connection):
+
+- {"op": "roots"}: list the chroots served and their current load.
+- {"op": "execute", "root": NAME, "command": CMD, "userspec": SPEC, "stdin": BOOL, "stdio": MODE}:
+  run a command. Responds with {"type": "started", "pid": PID}, then output
+  and finally {"type": "exit", "returncode": N}. Three stdio modes:
+    - "stream" (default): output comes back as STDOUT/STDERR frames. If
+      "stdin" is true, the client sends STDIN frames and an empty one for EOF.
+    - "fds": the client attaches three file descriptors to the request and
+      they are used as the command's stdin, stdout and stderr directly.
+    - "pipe": the "started" response carries the write end of the stdin pipe
+      and the read ends of the stdout and stderr pipes of the command.
+  In the last two modes output never passes through the daemon.
+- {"op": "put", "root": NAME, "path": PATH, "mode": MODE}: write a file inside
+  the chroot. The content is either a file descriptor attached to the
+  request, or DATA frames terminated by an empty one. Responds with
+  {"type": "ok", "size": N}.
+- {"op": "get", "root": NAME, "path": PATH, "fd": BOOL}: read a file inside
+  the chroot. Responds with {"type": "file", "size": N}, carrying a read-only
+  file descriptor if "fd" is true, or followed by DATA frames and an empty
+  one otherwise.
+
+Failures are reported as {"type": "error", "message": TEXT}.
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import threading
+from pathlib import Path
+from typing import Any
+
+from . import ChrootError, ChrootManager, MountError, _linux, _parse_mount_option
+
+logger = logging.getLogger(__name__)
+
+# Frame kinds
+FRAME_JSON = 0
+FRAME_STDOUT = 1
+FRAME_STDERR = 2
+FRAME_STDIN = 3
+FRAME_DATA = 4
+
+_HEADER = struct.Struct("!BI")
+_CHUNK = 1 << 16
+_MAX_FRAME = (1 << 32) - 1
+_MAX_FDS = 3
+
+
+class ProtocolError(ChrootError):
+    """Exception raised for malformed or unexpected frames."""
+
+    pass
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    """Receive exactly size bytes."""
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ProtocolError("Connection closed in the middle of a frame")
+        data += chunk
+    return bytes(data)
+
+
+def send_frame(sock: socket.socket, kind: int, payload: bytes = b"", fds: list[int] | None = None) -> None:
+    """Send one frame, optionally with file descriptors attached."""
+    header = _HEADER.pack(kind, len(payload))
+    if fds:
+        socket.send_fds(sock, [header], fds)
+        sock.sendall(payload)
+    else:
+        sock.sendall(header + payload)
+
+
+def send_message(sock: socket.socket, message: dict[str, Any], fds: list[int] | None = None) -> None:
+    """Send a JSON frame."""
+    send_frame(sock, FRAME_JSON, json.dumps(message).encode(), fds)
+
+
+def recv_frame(sock: socket.socket) -> tuple[int, bytes, list[int]] | None:
+    """
+    Receive one frame and any file descriptors attached to it.
+
+    Returns None if the peer closed the connection between frames.
+    """
+    header, fds, _, _ = socket.recv_fds(sock, _HEADER.size, _MAX_FDS)
+    if not header:
+        return None
+    if len(header) < _HEADER.size:
+        header += _recv_exact(sock, _HEADER.size - len(header))
+    kind, size = _HEADER.unpack(header)
+    return kind, _recv_exact(sock, size) if size else b"", fds
+
+
+def recv_message(sock: socket.socket) -> tuple[dict[str, Any], list[int]]:
+    """Receive a JSON frame, failing on anything else."""
+    frame = recv_frame(sock)
+    if frame is None:
+        raise ProtocolError("Connection closed")
+    kind, payload, fds = frame
+    if kind != FRAME_JSON:
+        for fd in fds:
+            os.close(fd)
+        raise ProtocolError(f"Expected a JSON frame, got frame kind {kind}")
+    try:
+        message = json.loads(payload)
+    except json.JSONDecodeError as e:
+        raise ProtocolError(f"Invalid JSON frame: {e}") from None
+    if not isinstance(message, dict):
+        raise ProtocolError("JSON frame must contain an object")
+    return message, fds
+
+
+class ChrootServer:
+    """Serves execute/put/get requests for a set of chroots that stay set up."""
+
+    def __init__(self, socket_path: str | Path, roots: dict[str, ChrootManager], max_concurrency: int = 4):
+        """
+        Initialize the server.
+
+        Args:
+            socket_path: Path of the Unix socket to listen on
+            roots: Chroots to serve, by the name clients use to refer to them
+            max_concurrency: Maximum number of commands running at once in each chroot;
+                further execute requests wait for a free slot
+        """
+        self.socket_path = Path(socket_path)
+        self.roots = roots
+        self.max_concurrency = max_concurrency
+        self._slots = {name: threading.BoundedSemaphore(max_concurrency) for name in roots}
+        self._active = dict.fromkeys(roots, 0)
+        self._lock = threading.Lock()
+        self._socket: socket.socket | None = None
+        self._stopping = False
+
+    def serve_forever(self) -> None:
+        """Set up every chroot, then accept connections until shutdown() is called."""
+        with contextlib.ExitStack() as stack:
+            for name, chroot in self.roots.items():
+                logger.debug(f"Setting up root '{name}' at {chroot.chroot_dir}")
+                chroot.setup()
+                stack.callback(chroot.teardown)
+
+            with contextlib.suppress(FileNotFoundError):
+                if stat.S_ISSOCK(os.lstat(self.socket_path).st_mode):
+                    os.unlink(self.socket_path)
+
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            stack.callback(self._socket.close)
+            self._bind()
+            stack.callback(os.unlink, self.socket_path)
+            self._socket.listen()
+            logger.debug(f"Listening on {self.socket_path}")
+
+            while not self._stopping:
+                try:
+                    conn, _ = self._socket.accept()
+                except OSError:
+                    if self._stopping:
+                        break
+                    raise
+                threading.Thread(target=self._handle_connection, args=(conn,), daemon=True).start()
+
+    def _bind(self) -> None:
+        """Bind the socket in a private directory and move it into place, so it is never reachable as non-0600."""
+        import tempfile
+
+        private = tempfile.mkdtemp(prefix=f".{self.socket_path.name}.", dir=self.socket_path.parent)
+        try:
+            path = os.path.join(private, "socket")
+            self._socket.bind(path)
+            os.chmod(path, 0o600)
+            os.rename(path, self.socket_path)
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(os.path.join(private, "socket"))
+            os.rmdir(private)
+
+    def shutdown(self) -> None:
+        """Stop accepting connections. Safe to call from a signal handler."""
+        self._stopping = True
+        if self._socket is not None:
+            with contextlib.suppress(OSError):
+                self._socket.shutdown(socket.SHUT_RDWR)
+
+    def _handle_connection(self, conn: socket.socket) -> None:
+        """Serve requests on one connection until the client disconnects."""
+        with conn:
+            while True:
+                try:
+                    frame = recv_frame(conn)
+                except (OSError, ProtocolError):
+                    return
+                if frame is None:
+                    return
+
+                kind, payload, fds = frame
+                try:
+                    if kind != FRAME_JSON:
+                        raise ProtocolError(f"Expected a request, got frame kind {kind}")
+                    request = json.loads(payload)
+                    if not isinstance(request, dict):
+                        raise ProtocolError("A request must be a JSON object")
+                    self._dispatch(conn, request, fds)
+                except (ChrootError, OSError, ValueError, KeyError, TypeError) as e:
+                    logger.debug(f"Request failed: {e}")
+                    try:
+                        send_message(conn, {"type": "error", "message": str(e)})
+                    except OSError:
+                        return
+                finally:
+                    for fd in fds:
+                        with contextlib.suppress(OSError):
+                            os.close(fd)
+
+    def _root(self, request: dict[str, Any]) -> tuple[str, ChrootManager]:
+        name = request.get("root")
+        if name not in self.roots:
+            raise ChrootError(f"Unknown root: {name}")
+        return name, self.roots[name]
+
+    def _dispatch(self, conn: socket.socket, request: dict[str, Any], fds: list[int]) -> None:
+        op = request.get("op")
+        if op == "roots":
+            with self._lock:
+                roots = {
+                    name: {
+                        "chroot_dir": str(chroot.chroot_dir),
+                        "unshare_mode": chroot.unshare_mode,
+                        "active": self._active[name],
+                        "limit": self.max_concurrency,
+                    }
+                    for name, chroot in self.roots.items()
+                }
+            send_message(conn, {"type": "roots", "roots": roots})
+        elif op == "execute":
+            self._execute(conn, request, fds)
+        elif op == "put":
+            self._put(conn, request, fds)
+        elif op == "get":
+            self._get(conn, request)
+        else:
+            raise ProtocolError(f"Unknown op: {op}")
+
+    def _execute(self, conn: socket.socket, request: dict[str, Any], fds: list[int]) -> None:
+        name, chroot = self._root(request)
+        mode = request.get("stdio", "stream")
+        if mode not in ("stream", "fds", "pipe"):
+            raise ProtocolError(f"Unknown stdio mode: {mode}")
+        if mode == "fds" and len(fds) != 3:
+            raise ProtocolError("stdio mode 'fds' needs exactly three file descriptors")
+
+        with self._slots[name]:
+            with self._lock:
+                self._active[name] += 1
+            try:
+                if mode == "stream":
+                    returncode = self._execute_stream(conn, chroot, request)
+                else:
+                    returncode = self._execute_fds(conn, chroot, request, fds if mode == "fds" else None)
+            finally:
+                with self._lock:
+                    self._active[name] -= 1
+
+        send_message(conn, {"type": "exit", "returncode": returncode})
+
+    def _execute_fds(
+        self, conn: socket.socket, chroot: ChrootManager, request: dict[str, Any], fds: list[int] | None
+    ) -> int:
+        """Run a command on client-supplied descriptors, or on pipes handed back to the client."""
+        if fds is not None:
+            proc = chroot.popen(
+                request.get("command"), request.get("userspec"), stdin=fds[0], stdout=fds[1], stderr=fds[2]
+            )
+            try:
+                send_message(conn, {"type": "started", "pid": proc.pid})
+            except BaseException:
+                # Nobody would wait for the command otherwise
+                proc.kill()
+                proc.wait()
+                raise
+        else:
+            stdin_r, stdin_w = os.pipe()
+            stdout_r, stdout_w = os.pipe()
+            stderr_r, stderr_w = os.pipe()
+            try:
+                proc = chroot.popen(
+                    request.get("command"), request.get("userspec"), stdin=stdin_r, stdout=stdout_w, stderr=stderr_w
+                )
+            finally:
+                for fd in (stdin_r, stdout_w, stderr_w):
+                    os.close(fd)
+            try:
+                send_message(conn, {"type": "started", "pid": proc.pid}, fds=[stdin_w, stdout_r, stderr_r])
+            except BaseException:
+                proc.kill()
+                proc.wait()
+                raise
+            finally:
+                for fd in (stdin_w, stdout_r, stderr_r):
+                    os.close(fd)
+        return proc.wait()
+
+    def _execute_stream(self, conn: socket.socket, chroot: ChrootManager, request: dict[str, Any]) -> int:
+        """Run a command and relay its stdin and output through frames on the connection."""
+        want_stdin = bool(request.get("stdin"))
+        proc = chroot.popen(
+            request.get("command"),
+            request.get("userspec"),
+            stdin=subprocess.PIPE if want_stdin else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        send_message(conn, {"type": "started", "pid": proc.pid})
+
+        stdin_thread = None
+        if want_stdin:
+            stdin_thread = threading.Thread(target=self._pump_stdin, args=(conn, proc), daemon=True)
+            stdin_thread.start()
+
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(proc.stdout, selectors.EVENT_READ, FRAME_STDOUT)
+                selector.register(proc.stderr, selectors.EVENT_READ, FRAME_STDERR)
+                while selector.get_map():
+                    for key, _ in selector.select():
+                        data = os.read(key.fd, _CHUNK)
+                        if not data:
+                            selector.unregister(key.fileobj)
+                            continue
+                        send_frame(conn, key.data, data)
+        except OSError:
+            # The client went away; do not leave the command running for nobody
+            proc.kill()
+            raise
+        finally:
+            proc.stdout.close()
+            proc.stderr.close()
+            returncode = proc.wait()
+
+        if stdin_thread is not None:
+            stdin_thread.join()
+        return returncode
+
+    @staticmethod
+    def _pump_stdin(conn: socket.socket, proc: subprocess.Popen) -> None:
+        """Copy STDIN frames from the client to the command until an empty frame."""
+        try:
+            while True:
+                frame = recv_frame(conn)
+                if frame is None or frame[0] != FRAME_STDIN or not frame[1]:
+                    break
+                if proc.stdin.closed:
+                    # The command stopped reading; the rest of the frames are drained all the same
+                    continue
+                try:
+                    proc.stdin.write(frame[1])
+                    proc.stdin.flush()
+                except BrokenPipeError:
+                    with contextlib.suppress(OSError):
+                        proc.stdin.close()
+        except (OSError, ProtocolError):
+            pass
+        finally:
+            with contextlib.suppress(OSError):
+                proc.stdin.close()
+
+    def _put(self, conn: socket.socket, request: dict[str, Any], fds: list[int]) -> None:
+        _, chroot = self._root(request)
+        size = 0
+        with chroot.open(request["path"], "wb", buffering=0) as f:
+            if fds:
+                if not _linux.reflink(fds[0], f.fileno()):
+                    _linux.copy_fd(fds[0], f.fileno())
+                size = os.fstat(f.fileno()).st_size
+            else:
+                while True:
+                    frame = recv_frame(conn)
+                    if frame is None or frame[0] != FRAME_DATA:
+                        raise ProtocolError("Expected DATA frames for put")
+                    if not frame[1]:
+                        break
+                    f.write(frame[1])
+                    size += len(frame[1])
+            if "mode" in request:
+                os.fchmod(f.fileno(), int(request["mode"]) & 0o7777)
+        send_message(conn, {"type": "ok", "size": size})
+
+    def _get(self, conn: socket.socket, request: dict[str, Any]) -> None:
+        _, chroot = self._root(request)
+        with chroot.open(request["path"], "rb", buffering=0) as f:
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode):
+                raise ChrootError(f"Not a regular file in chroot: {request['path']}")
+
+            if request.get("fd"):
+                send_message(conn, {"type": "file", "size": st.st_size}, fds=[f.fileno()])
+                return
+
+            send_message(conn, {"type": "file", "size": st.st_size})
+            offset = 0
+            while offset < st.st_size:
+                count = min(st.st_size - offset, _MAX_FRAME)
+                conn.sendall(_HEADER.pack(FRAME_DATA, count))
+                while count:
+                    sent = os.sendfile(conn.fileno(), f.fileno(), offset, count)
+                    if not sent:
+                        raise ChrootError(f"File shrank while sending: {request['path']}")
+                    offset += sent
+                    count -= sent
+            send_frame(conn, FRAME_DATA)
+
+
+class ChrootClient:
+    """Minimal client for a chorut server."""
+
+    def __init__(self, socket_path: str | Path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(str(socket_path))
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _request(self, request: dict[str, Any], fds: list[int] | None = None) -> tuple[dict[str, Any], list[int]]:
+        send_message(self.sock, request, fds)
+        message, received = recv_message(self.sock)
+        if message.get("type") == "error":
+            raise ChrootError(message.get("message", "Unknown server error"))
+        return message, received
+
+    def roots(self) -> dict[str, Any]:
+        """Return the chroots served and their current load."""
+        return self._request({"op": "roots"})[0]["roots"]
+
+    def execute(
+        self, root: str, command: list[str] | str | None, userspec: str | None = None, input: bytes | None = None
+    ) -> subprocess.CompletedProcess:
+        """Run a command and collect its output through the socket."""
+        request = {"op": "execute", "root": root, "command": command, "userspec": userspec, "stdin": input is not None}
+        self._request(request)
+        stdin_thread = None
+        if input is not None:
+            # Sent while the output is read: the command may not read all of its input before writing
+            stdin_thread = threading.Thread(target=self._send_stdin, args=(input,), daemon=True)
+            stdin_thread.start()
+        try:
+            return self._collect_output(command)
+        finally:
+            if stdin_thread is not None:
+                stdin_thread.join()
+
+    def _send_stdin(self, input: bytes) -> None:
+        """Send input as STDIN frames, ending with an empty one."""
+        try:
+            for offset in range(0, len(input), _CHUNK):
+                send_frame(self.sock, FRAME_STDIN, input[offset : offset + _CHUNK])
+            send_frame(self.sock, FRAME_STDIN)
+        except OSError:
+            # The server stops reading stdin once the command exits
+            pass
+
+    def _collect_output(self, command: list[str] | str | None) -> subprocess.CompletedProcess:
+        """Receive output frames until the exit message."""
+        output = {FRAME_STDOUT: bytearray(), FRAME_STDERR: bytearray()}
+        while True:
+            frame = recv_frame(self.sock)
+            if frame is None:
+                raise ProtocolError("Connection closed before the command exited")
+            kind, payload, _ = frame
+            if kind in output:
+                output[kind] += payload
+                continue
+            message = json.loads(payload)
+            if message.get("type") == "error":
+                raise ChrootError(message.get("message", "Unknown server error"))
+            if message.get("type") == "exit":
+                return subprocess.CompletedProcess(
+                    command, message["returncode"], bytes(output[FRAME_STDOUT]), bytes(output[FRAME_STDERR])
+                )
+
+    def execute_fds(
+        self, root: str, command: list[str] | str | None, userspec: str | None = None, stdio: tuple = (0, 1, 2)
+    ) -> int:
+        """Run a command directly on the given stdin/stdout/stderr descriptors and return its exit code."""
+        request = {"op": "execute", "root": root, "command": command, "userspec": userspec, "stdio": "fds"}
+        self._request(request, fds=list(stdio))
+        message, _ = recv_message(self.sock)
+        if message.get("type") == "error":
+            raise ChrootError(message.get("message", "Unknown server error"))
+        return message["returncode"]
+
+    def put(self, root: str, host_path: str | Path, chroot_path: str) -> int:
+        """Copy a host file into the chroot; only its descriptor is sent to the server."""
+        with open(host_path, "rb") as f:
+            mode = os.fstat(f.fileno()).st_mode & 0o7777
+            request = {"op": "put", "root": root, "path": chroot_path, "mode": mode}
+            message, _ = self._request(request, fds=[f.fileno()])
+        return message["size"]
+
+    def get(self, root: str, chroot_path: str, host_path: str | Path) -> int:
+        """Copy a file out of the chroot, reading it through a descriptor handed out by the server."""
+        message, fds = self._request({"op": "get", "root": root, "path": chroot_path, "fd": True})
+        if not fds:
+            raise ProtocolError("Server did not send a file descriptor")
+        try:
+            with open(host_path, "wb") as f:
+                if not _linux.reflink(fds[0], f.fileno()):
+                    _linux.copy_fd(fds[0], f.fileno())
+        finally:
+            for fd in fds:
+                os.close(fd)
+        return message["size"]
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Command-line interface for 'chorut serve'."""
+    parser = argparse.ArgumentParser(
+        prog="chorut serve",
+        description="Keep chroots set up and serve execute/put/get requests over a Unix socket",
+    )
+    parser.add_argument("roots", nargs="+", metavar="NAME=DIR", help="chroot to serve and the name clients use for it")
+    parser.add_argument("-s", "--socket", required=True, help="Path of the Unix socket to listen on")
+    parser.add_argument("-N", "--unshare", action="store_true", help="Run in unshare mode as a regular user")
+    parser.add_argument(
+        "-c", "--concurrency", type=int, default=4, metavar="N", help="Maximum concurrent commands per chroot"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose logging")
+    parser.add_argument(
+        "-m",
+        "--mount",
+        action="append",
+        metavar="SOURCE:TARGET[:OPTIONS]",
+        help="Add custom mount to every chroot (can be used multiple times)",
+    )
+
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    try:
+        custom_mounts = [_parse_mount_option(spec) for spec in args.mount or []]
+        roots = {}
+        for entry in args.roots:
+            name, sep, chroot_dir = entry.partition("=")
+            if not sep or not name or not chroot_dir:
+                parser.error(f"invalid root '{entry}', expected NAME=DIR")
+            roots[name] = ChrootManager(chroot_dir, unshare_mode=args.unshare, custom_mounts=custom_mounts)
+
+        server = ChrootServer(args.socket, roots, max_concurrency=args.concurrency)
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown())
+        signal.signal(signal.SIGINT, lambda signum, frame: server.shutdown())
+        server.serve_forever()
+    except (ChrootError, MountError, OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,307 @@
+"""
+Single-threaded supervision of many concurrent chroot commands.
+
+Every child is tracked through a pidfd, which becomes readable when the
+child exits, so one epoll set covers both process exits and output pipes.
+Children are reaped with waitid(P_PIDFD), which can never reap an unrelated
+process, and signalled with pidfd_send_signal(), which can never signal a
+recycled pid.
+"""
+
+import contextlib
+import heapq
+import logging
+import os
+import resource
+import selectors
+import signal
+import subprocess
+import time
+from collections.abc import Callable, Iterator
+from typing import Any
+
+from . import ChrootError, ChrootManager
+
+logger = logging.getLogger(__name__)
+
+_CHUNK = 1 << 16
+
+
+class Job:
+    """A command started by a Supervisor."""
+
+    __slots__ = (
+        "_deadline",
+        "_open_streams",
+        "_output",
+        "command",
+        "end_time",
+        "on_exit",
+        "on_output",
+        "pidfd",
+        "process",
+        "returncode",
+        "start_time",
+        "text",
+        "timed_out",
+    )
+
+    def __init__(
+        self,
+        command: Any,
+        process: subprocess.Popen,
+        text: bool,
+        on_exit: Callable | None,
+        on_output: Callable | None = None,
+    ):
+        self.command = command
+        self.process = process
+        self.pidfd = os.pidfd_open(process.pid)
+        self.text = text
+        self.on_exit = on_exit
+        self.on_output = on_output
+        self.returncode: int | None = None
+        self.start_time = time.monotonic()
+        self.end_time: float | None = None
+        self.timed_out = False
+        self._deadline: float | None = None
+        self._output: dict[str, list[bytes]] = {}
+        self._open_streams = 0
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    @property
+    def done(self) -> bool:
+        """Whether the command exited and all of its output was read."""
+        return self.returncode is not None and self._open_streams == 0
+
+    @property
+    def duration(self) -> float | None:
+        """Seconds from start to exit, once the command exited."""
+        return None if self.end_time is None else self.end_time - self.start_time
+
+    def send_signal(self, signum: int) -> None:
+        """Signal the command through its pidfd, unless it was already reaped."""
+        if self.returncode is None:
+            signal.pidfd_send_signal(self.pidfd, signum)
+
+    def kill(self) -> None:
+        self.send_signal(signal.SIGKILL)
+
+    def _collected(self, name: str) -> bytes | str | None:
+        if name not in self._output:
+            return None
+        data = b"".join(self._output[name])
+        return data.decode() if self.text else data
+
+    def result(self) -> subprocess.CompletedProcess:
+        """Return the outcome as a CompletedProcess. Only valid once the job is done."""
+        if not self.done:
+            raise ChrootError(f"Job {self.pid} has not finished")
+        return subprocess.CompletedProcess(
+            self.command, self.returncode, self._collected("stdout"), self._collected("stderr")
+        )
+
+
+class Supervisor:
+    """
+    Runs many chroot commands concurrently from a single thread.
+
+    Commands are started with spawn() and driven by wait(), as_completed()
+    or poll(), which block in a single epoll call covering every pidfd and
+    output pipe. Nothing happens while no one is waiting, so the caller
+    decides which thread does the work.
+
+    Each captured job uses three file descriptors, so the soft RLIMIT_NOFILE
+    is raised to the hard limit when the supervisor is created.
+    """
+
+    def __init__(self):
+        self._selector = selectors.EpollSelector()
+        self._jobs: set[Job] = set()
+        self._finished: list[Job] = []
+        self._deadlines: list[tuple[float, int, Job]] = []
+        self._sequence = 0
+
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            except (ValueError, OSError) as e:
+                logger.debug(f"Could not raise RLIMIT_NOFILE: {e}")
+
+    def __len__(self) -> int:
+        """Number of jobs that have not finished yet."""
+        return len(self._jobs)
+
+    def spawn(
+        self,
+        chroot: ChrootManager,
+        command: list[str] | str | None,
+        userspec: str | None = None,
+        capture_output: bool = True,
+        text: bool = True,
+        timeout: float | None = None,
+        on_exit: Callable[[Job], None] | None = None,
+        on_output: Callable[[Job, str, bytes], None] | None = None,
+        **kwargs: Any,
+    ) -> Job:
+        """
+        Start a command in a chroot and start supervising it.
+
+        Args:
+            chroot: A set up ChrootManager
+            command: Command to execute, as accepted by ChrootManager.execute()
+            userspec: User specification in format 'user' or 'user:group'
+            capture_output: If True, collect stdout and stderr
+            text: If True, decode captured output as text
+            timeout: Seconds after which the command is killed (job.timed_out is set)
+            on_exit: Called with the job once it is done
+            on_output: Called with the job, 'stdout' or 'stderr' and the bytes read, as captured
+                output arrives; the output is then passed on instead of being collected
+            **kwargs: Passed to ChrootManager.popen() (stdin defaults to /dev/null)
+
+        Returns:
+            The Job handle
+        """
+        kwargs.setdefault("stdin", subprocess.DEVNULL)
+        if capture_output:
+            kwargs["stdout"] = kwargs["stderr"] = subprocess.PIPE
+        process = chroot.popen(command, userspec, **kwargs)
+
+        try:
+            job = Job(command, process, text, on_exit, on_output)
+        except OSError:
+            process.kill()
+            process.wait()
+            raise
+
+        self._selector.register(job.pidfd, selectors.EVENT_READ, (job, None))
+        for name, stream in (("stdout", process.stdout), ("stderr", process.stderr)):
+            if stream is not None:
+                os.set_blocking(stream.fileno(), False)
+                job._output[name] = []
+                job._open_streams += 1
+                self._selector.register(stream.fileno(), selectors.EVENT_READ, (job, name))
+
+        if timeout is not None:
+            job._deadline = job.start_time + timeout
+            self._sequence += 1
+            heapq.heappush(self._deadlines, (job._deadline, self._sequence, job))
+
+        self._jobs.add(job)
+        return job
+
+    def _reap(self, job: Job) -> None:
+        self._selector.unregister(job.pidfd)
+        try:
+            info = os.waitid(os.P_PIDFD, job.pidfd, os.WEXITED)
+            status = info.si_status if info.si_code == os.CLD_EXITED else -info.si_status
+        except ChildProcessError:
+            # Someone else reaped it (e.g. a stray Popen.wait()); use what Popen knows
+            status = job.process.returncode if job.process.returncode is not None else -1
+        os.close(job.pidfd)
+        job.returncode = job.process.returncode = status
+        job.end_time = time.monotonic()
+
+    def _read(self, job: Job, fd: int, name: str) -> None:
+        try:
+            data = os.read(fd, _CHUNK)
+        except BlockingIOError:
+            return
+        if data:
+            if job.on_output is not None:
+                job.on_output(job, name, data)
+            else:
+                job._output[name].append(data)
+            return
+        self._selector.unregister(fd)
+        job._open_streams -= 1
+
+    def _finish(self, job: Job) -> None:
+        self._jobs.discard(job)
+        for stream in (job.process.stdout, job.process.stderr):
+            if stream is not None:
+                stream.close()
+        self._finished.append(job)
+        if job.on_exit is not None:
+            job.on_exit(job)
+
+    def _expire(self, now: float) -> None:
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, _, job = heapq.heappop(self._deadlines)
+            if job.returncode is None:
+                job.timed_out = True
+                job.kill()
+
+    def poll(self, timeout: float | None = None) -> list[Job]:
+        """
+        Wait for events once and handle them.
+
+        Returns:
+            The jobs that finished during this call
+        """
+        if self._deadlines:
+            until_deadline = max(0.0, self._deadlines[0][0] - time.monotonic())
+            timeout = until_deadline if timeout is None else min(timeout, until_deadline)
+
+        for key, _ in self._selector.select(timeout):
+            job, name = key.data
+            if name is None:
+                self._reap(job)
+            else:
+                self._read(job, key.fd, name)
+            if job.done and job in self._jobs:
+                self._finish(job)
+
+        self._expire(time.monotonic())
+        finished, self._finished = self._finished, []
+        return finished
+
+    def as_completed(self, timeout: float | None = None) -> Iterator[Job]:
+        """Yield jobs as they finish until none are left, or until timeout seconds have passed."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._jobs:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return
+            yield from self.poll(remaining)
+
+    def wait(self, timeout: float | None = None) -> list[Job]:
+        """Drive all jobs until they finish (or timeout expires) and return the finished ones."""
+        return list(self.as_completed(timeout))
+
+    def close(self, timeout: float = 5.0) -> None:
+        """
+        Kill and reap all remaining jobs and release the epoll set.
+
+        Output is read until the pipes close, for at most timeout seconds.
+        Processes that a command left behind can hold its pipes open, so
+        the pipes of jobs still open after that are closed once the command
+        itself has been reaped.
+        """
+        for job in list(self._jobs):
+            job.kill()
+        deadline = time.monotonic() + timeout
+        while self._jobs and (remaining := deadline - time.monotonic()) > 0:
+            self.poll(remaining)
+
+        for job in list(self._jobs):
+            while job.returncode is None:
+                self.poll()
+            for stream in (job.process.stdout, job.process.stderr):
+                if stream is not None and not stream.closed:
+                    with contextlib.suppress(KeyError):
+                        self._selector.unregister(stream.fileno())
+            job._open_streams = 0
+            if job in self._jobs:
+                self._finish(job)
+        self._selector.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
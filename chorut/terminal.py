@@ -0,0 +1,236 @@
+"""
+Interactive chroot shells on pseudo-terminals, multiplexed through one event loop.
+
+Each PtySession runs a command inside a chroot on its own pty pair, with the
+pty as its controlling terminal, so job control, line editing and window
+size changes work as they do in a real terminal. A PtyMultiplexer relays the
+I/O of any number of sessions from a single thread.
+"""
+
+import contextlib
+import errno
+import fcntl
+import os
+import selectors
+import signal
+import struct
+import subprocess
+import termios
+import time
+from collections.abc import Callable
+
+from . import ChrootManager
+
+_CHUNK = 1 << 16
+
+
+class PtySession:
+    """A command running inside a chroot on its own pseudo-terminal."""
+
+    __slots__ = ("_pending", "master_fd", "on_exit", "on_output", "pidfd", "process", "returncode")
+
+    def __init__(
+        self,
+        chroot: ChrootManager,
+        command: list[str] | str | None = None,
+        userspec: str | None = None,
+        rows: int = 24,
+        cols: int = 80,
+        env: dict[str, str] | None = None,
+    ):
+        """
+        Start a command on a new pty.
+
+        Args:
+            chroot: A set up ChrootManager
+            command: Command to execute (defaults to /bin/bash), as accepted by ChrootManager.execute()
+            userspec: User specification in format 'user' or 'user:group'
+            rows: Initial terminal height
+            cols: Initial terminal width
+            env: Extra environment variables (TERM defaults to xterm-256color)
+        """
+        chroot_cmd, base_env = chroot._build_command(command, userspec)
+        base_env.setdefault("TERM", "xterm-256color")
+        base_env.update(env or {})
+
+        self.master_fd, slave_fd = os.openpty()
+        try:
+            self._set_size(slave_fd, rows, cols)
+            # setsid --ctty starts a new session and makes the pty (its stdin) the controlling terminal
+            self.process = subprocess.Popen(
+                ["setsid", "--ctty", *chroot_cmd], stdin=slave_fd, stdout=slave_fd, stderr=slave_fd, env=base_env
+            )
+        except BaseException:
+            os.close(self.master_fd)
+            raise
+        finally:
+            os.close(slave_fd)
+
+        os.set_blocking(self.master_fd, False)
+        self.pidfd = os.pidfd_open(self.process.pid)
+        self.returncode: int | None = None
+        self.on_output: Callable[[PtySession, bytes], None] | None = None
+        self.on_exit: Callable[[PtySession], None] | None = None
+        self._pending = bytearray()
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    @staticmethod
+    def _set_size(fd: int, rows: int, cols: int) -> None:
+        fcntl.ioctl(fd, termios.TIOCSWINSZ, struct.pack("HHHH", rows, cols, 0, 0))
+
+    def resize(self, rows: int, cols: int) -> None:
+        """Change the window size; the kernel sends SIGWINCH to the foreground process group."""
+        self._set_size(self.master_fd, rows, cols)
+
+    def fileno(self) -> int:
+        return self.master_fd
+
+    def send_signal(self, signum: int) -> None:
+        """Signal the session leader through its pidfd, unless it was already reaped."""
+        if self.returncode is None:
+            signal.pidfd_send_signal(self.pidfd, signum)
+
+
+class PtyMultiplexer:
+    """
+    Serves many PtySessions from one thread.
+
+    Output of every session is delivered to its on_output callback as it
+    arrives, input passed to write() is buffered and written when the pty
+    can take it, and on_exit is called once the command has exited and its
+    output has been drained. Drive it by calling poll() or run().
+    """
+
+    def __init__(self):
+        self._selector = selectors.EpollSelector()
+        self.sessions: set[PtySession] = set()
+
+    def spawn(
+        self,
+        chroot: ChrootManager,
+        command: list[str] | str | None = None,
+        userspec: str | None = None,
+        rows: int = 24,
+        cols: int = 80,
+        env: dict[str, str] | None = None,
+        on_output: Callable[[PtySession, bytes], None] | None = None,
+        on_exit: Callable[[PtySession], None] | None = None,
+    ) -> PtySession:
+        """Start a new session and add it to the loop. See PtySession for the arguments."""
+        session = PtySession(chroot, command, userspec, rows, cols, env)
+        session.on_output = on_output
+        session.on_exit = on_exit
+        self._selector.register(session.master_fd, selectors.EVENT_READ, (session, "pty"))
+        self._selector.register(session.pidfd, selectors.EVENT_READ, (session, "exit"))
+        self.sessions.add(session)
+        return session
+
+    def write(self, session: PtySession, data: bytes) -> None:
+        """Queue input for a session; it is written as soon as the pty accepts it."""
+        if session.master_fd < 0:
+            return
+        was_empty = not session._pending
+        session._pending += data
+        if was_empty:
+            self._flush(session)
+
+    def _flush(self, session: PtySession) -> None:
+        try:
+            while session._pending:
+                written = os.write(session.master_fd, session._pending)
+                del session._pending[:written]
+        except BlockingIOError:
+            pass
+        except OSError:
+            session._pending.clear()
+
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if session._pending else 0)
+        self._selector.modify(session.master_fd, events, (session, "pty"))
+
+    def _read(self, session: PtySession) -> None:
+        try:
+            data = os.read(session.master_fd, _CHUNK)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # EIO means every process holding the slave side is gone
+            if e.errno != errno.EIO:
+                raise
+            data = b""
+
+        if data:
+            if session.on_output is not None:
+                session.on_output(session, data)
+            return
+        self._close_pty(session)
+
+    def _close_pty(self, session: PtySession) -> None:
+        self._selector.unregister(session.master_fd)
+        os.close(session.master_fd)
+        session.master_fd = -1
+        session._pending.clear()
+
+    def _reap(self, session: PtySession) -> None:
+        self._selector.unregister(session.pidfd)
+        info = os.waitid(os.P_PIDFD, session.pidfd, os.WEXITED)
+        os.close(session.pidfd)
+        session.returncode = info.si_status if info.si_code == os.CLD_EXITED else -info.si_status
+        session.process.returncode = session.returncode
+
+    def poll(self, timeout: float | None = None) -> None:
+        """Wait for events once and handle them."""
+        for key, events in self._selector.select(timeout):
+            session, kind = key.data
+            if kind == "exit":
+                self._reap(session)
+            else:
+                if events & selectors.EVENT_WRITE:
+                    self._flush(session)
+                if events & selectors.EVENT_READ and session.master_fd >= 0:
+                    self._read(session)
+            self._finish(session)
+
+    def _finish(self, session: PtySession) -> None:
+        """Drop a session once its command has exited and its pty is closed."""
+        if session.returncode is not None and session.master_fd < 0 and session in self.sessions:
+            self.sessions.discard(session)
+            if session.on_exit is not None:
+                session.on_exit(session)
+
+    def run(self) -> None:
+        """Handle events until every session has ended."""
+        while self.sessions:
+            self.poll()
+
+    def close(self, timeout: float = 5.0) -> None:
+        """
+        Hang up every remaining session and wait for them to end.
+
+        Sessions still running after timeout seconds are killed, and their
+        ptys closed without reading any more output, as processes that ignore
+        SIGHUP could keep them open.
+        """
+        for session in list(self.sessions):
+            with contextlib.suppress(OSError):
+                session.send_signal(signal.SIGHUP)
+        deadline = time.monotonic() + timeout
+        while self.sessions and (remaining := deadline - time.monotonic()) > 0:
+            self.poll(remaining)
+
+        for session in list(self.sessions):
+            with contextlib.suppress(OSError):
+                session.send_signal(signal.SIGKILL)
+            if session.master_fd >= 0:
+                self._close_pty(session)
+            self._finish(session)
+        self.run()
+        self._selector.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
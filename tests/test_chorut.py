@@ -3,11 +3,20 @@
 Simple test script for chorut library.
 """
 
+import os
+import shlex
 import shutil
+import signal
+import stat
+import subprocess
+import sys
 import tempfile
+import time
 from pathlib import Path
 
-from chorut import ChrootError, ChrootManager
+import pytest
+
+from chorut import ChrootError, ChrootManager, MountError, MountSpec, _parse_command, compile_mounts
 
 
 def create_minimal_chroot():
@@ -32,6 +41,20 @@ def create_minimal_chroot():
     return chroot_dir
 
 
+class HostChroot(ChrootManager):
+    """Runs commands on the host instead of inside the chroot, for tests without root."""
+
+    def setup(self):
+        self._is_setup = True
+
+    def teardown(self):
+        self._is_setup = False
+
+    def _build_command(self, command, userspec, mounts=None):
+        argv = ["/bin/sh", "-c", command] if isinstance(command, str) else self._command_argv(command)
+        return argv, self._command_env()
+
+
 def test_library():
     """Test the chorut library functionality."""
     print("Creating test chroot directory...")
@@ -92,5 +115,993 @@ def test_library():
         shutil.rmtree(chroot_dir)
 
 
+def test_paths_resolve_inside_chroot(tmp_path):
+    """Symlinks inside the chroot must not lead back to the host."""
+    (tmp_path / "etc").mkdir()
+    (tmp_path / "etc/hostname").write_text("chroot\n")
+    (tmp_path / "escape").symlink_to("/etc")
+    (tmp_path / "up").symlink_to("../../..")
+
+    chroot = ChrootManager(tmp_path)
+    try:
+        assert chroot.open("/escape/hostname").read() == "chroot\n"
+        assert chroot.exists("/up/up/etc/hostname")
+        assert not chroot.exists("/escape/passwd")
+        assert sorted(chroot.listdir("/up")) == ["escape", "etc", "up"]
+        # Relative paths are relative to the chroot root
+        assert stat.S_ISLNK(chroot.stat("escape", follow_symlinks=False).st_mode)
+
+        host_file = tmp_path.parent / f"{tmp_path.name}.host"
+        host_file.write_text("data")
+        assert chroot.put(host_file, "/escape/copied") == 4
+        assert (tmp_path / "etc/copied").read_text() == "data"
+        host_file.unlink()
+    finally:
+        chroot.teardown()
+
+
+def test_file_transfer_and_tar_stay_inside_chroot(tmp_path):
+    """put/get copy files, and tar streams round-trip without following symlinks out of the chroot."""
+    import io
+    import tarfile
+
+    root = tmp_path / "root"
+    (root / "etc").mkdir(parents=True)
+    (root / "etc/hostname").write_text("chroot\n")
+    os.link(root / "etc/hostname", root / "etc/hostname.bak")
+    (root / "etc/passwd").symlink_to("/etc/passwd")
+    (root / "escape").symlink_to("/etc")
+    chroot = ChrootManager(root)
+
+    (tmp_path / "data").write_bytes(b"data")
+    (tmp_path / "data").chmod(0o640)
+    assert chroot.put(tmp_path / "data", "/escape/data") == 4
+    assert (root / "etc/data").read_bytes() == b"data"
+    assert chroot.get("/escape/data", tmp_path / "back") == 4
+    assert (tmp_path / "back").read_bytes() == b"data"
+    assert stat.S_IMODE((tmp_path / "back").stat().st_mode) == 0o640
+    with pytest.raises(ChrootError):
+        chroot.get("/etc/passwd", tmp_path / "passwd")
+
+    archive = io.BytesIO()
+    assert chroot.export_tar("/escape", archive) == 5
+    archive.seek(0)
+    with tarfile.open(fileobj=archive) as tar:
+        members = {member.name: member for member in tar}
+        assert members["escape/passwd"].issym()
+        assert members["escape/passwd"].linkname == "/etc/passwd"
+        assert members["escape/hostname.bak"].islnk()
+        assert tar.extractfile("escape/data").read() == b"data"
+    # The symlink was stored, not the host's /etc/passwd it points to
+    assert b"root:" not in archive.getvalue()
+
+    archive.seek(0)
+    assert chroot.import_tar(archive, "/copy") == 5
+    assert (root / "copy/escape/hostname").read_text() == "chroot\n"
+    assert os.readlink(root / "copy/escape/passwd") == "/etc/passwd"
+    with pytest.raises(ChrootError):
+        chroot.export_tar("/escape/passwd", io.BytesIO())
+    chroot.teardown()
+
+
+def test_action_key_tracks_inputs(tmp_path):
+    """Action keys change with input contents and the command, not with unrelated files."""
+    from chorut.cache import ActionCache
+
+    root = tmp_path / "root"
+    (root / "src").mkdir(parents=True)
+    (root / "src/main.c").write_text("int main(void) { return 0; }\n")
+    cache = ActionCache(tmp_path / "cache", env_keys=["PATH"])
+    chroot = ChrootManager(root)
+    try:
+        key = cache.action_key(chroot, ["make"], {"PATH": "/bin"}, None, ["/src"])
+        assert cache.action_key(chroot, ["make"], {"PATH": "/bin", "TERM": "xterm"}, None, ["src"]) == key
+        (root / "unrelated").write_text("x")
+        assert cache.action_key(chroot, ["make"], {"PATH": "/bin"}, None, ["/src"]) == key
+        assert cache.action_key(chroot, ["make", "-j2"], {"PATH": "/bin"}, None, ["/src"]) != key
+        (root / "src/main.c").write_text("int main(void) { return 1; }\n")
+        assert cache.action_key(chroot, ["make"], {"PATH": "/bin"}, None, ["/src"]) != key
+    finally:
+        chroot.teardown()
+
+
+def test_diff_since_reports_changes(tmp_path):
+    """Created, modified and deleted files are found, including in directories skipped by mtime."""
+    (tmp_path / "etc").mkdir()
+    (tmp_path / "etc/hostname").write_text("chroot\n")
+    (tmp_path / "etc/motd").write_text("hello\n")
+    (tmp_path / "usr/lib").mkdir(parents=True)
+
+    chroot = ChrootManager(tmp_path)
+    before = chroot.snapshot(hash=True)
+    (tmp_path / "etc/hostname").write_text("renamed\n")
+    (tmp_path / "etc/motd").unlink()
+    (tmp_path / "usr/lib/libnew.so").write_text("")
+
+    changes = chroot.diff_since(before)
+    assert changes.created == {"/usr/lib/libnew.so"}
+    assert changes.modified == {"/etc/hostname"}
+    assert changes.deleted == {"/etc/motd"}
+
+    manifest_file = tmp_path.parent / f"{tmp_path.name}.manifest"
+    before.save(manifest_file)
+    assert chroot.diff_since(type(before).load(manifest_file)) == changes
+    manifest_file.unlink()
+
+
+def test_import_image_applies_whiteouts(tmp_path):
+    """Layer tarballs are applied in order; whiteouts hide lower files and opaque directories."""
+    import io
+    import tarfile
+
+    from chorut.image import import_image
+
+    def write_layer(name, files):
+        path = tmp_path / name
+        with tarfile.open(path, "w:gz") as tar:
+            for member, data in files.items():
+                info = tarfile.TarInfo(member)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        return path
+
+    lower = write_layer("lower.tar.gz", {"etc/a": b"1", "etc/b": b"1", "opt/x": b"1"})
+    upper = write_layer("upper.tar.gz", {"etc/a": b"2", "etc/.wh.b": b"", "opt/.wh..wh..opq": b"", "opt/y": b"2"})
+
+    result = import_image([lower, upper], tmp_path / "root", cache_dir=tmp_path / "cache")
+    assert result.unpacked == 2
+    assert sorted(str(p.relative_to(tmp_path / "root")) for p in (tmp_path / "root").rglob("*")) == [
+        "etc",
+        "etc/a",
+        "opt",
+        "opt/y",
+    ]
+    assert (tmp_path / "root/etc/a").read_text() == "2"
+
+    assert import_image([lower, upper], tmp_path / "again", cache_dir=tmp_path / "cache").unpacked == 0
+
+
+def test_clone_hardlink_keeps_base_intact(tmp_path):
+    """A hardlink clone shares file data, but private paths and broken links are real copies."""
+    base = tmp_path / "base"
+    (base / "usr/bin").mkdir(parents=True)
+    (base / "etc").mkdir()
+    (base / "usr/bin/tool").write_text("tool")
+    (base / "etc/config").write_text("base")
+
+    result = ChrootManager.clone(base, tmp_path / "job", strategy="hardlink")
+    assert (result.files, result.bytes_copied, result.bytes_shared) == (2, 4, 4)
+
+    job = ChrootManager(tmp_path / "job")
+    try:
+        assert (tmp_path / "job/usr/bin/tool").stat().st_ino == (base / "usr/bin/tool").stat().st_ino
+        with job.open("/etc/config", "w") as f:
+            f.write("job")
+        assert job.break_links("/usr/bin/tool") == 1
+        with job.open("/usr/bin/tool", "a") as f:
+            f.write(" patched")
+    finally:
+        job.teardown()
+
+    assert (base / "etc/config").read_text() == "base"
+    assert (base / "usr/bin/tool").read_text() == "tool"
+    assert (tmp_path / "job/usr/bin/tool").read_text() == "tool patched"
+
+
+def test_setup_checks_root_before_taking_resources(tmp_path, monkeypatch):
+    """A root mode setup() by a regular user fails without leaving cache locks or a prefetch thread behind."""
+    import chorut
+
+    chroot = ChrootManager(
+        tmp_path / "root",
+        cache_mounts={"pip": "/pip"},
+        cache_store=tmp_path / "store",
+        prefetch_profile=tmp_path / "profile.json",
+    )
+    (tmp_path / "root").mkdir()
+    monkeypatch.setattr(chorut.os, "getuid", lambda: 1000)
+    with pytest.raises(ChrootError, match="requires root"):
+        chroot.setup()
+    assert chroot._cache_locks == []
+    assert chroot._prefetch_thread is None
+
+
+def test_action_cache_runs_restores_and_prunes(tmp_path, monkeypatch):
+    """A miss runs and stores the command, a hit restores its outputs and output, and prune() evicts entries."""
+    import io
+
+    from chorut.cache import ActionCache
+
+    root = tmp_path / "root"
+    (root / "src").mkdir(parents=True)
+    (root / "src/in").write_text("v1")
+    cache = ActionCache(tmp_path / "cache")
+    command = f"mkdir -p {root}/out && cat {root}/src/in > {root}/out/result && echo built"
+
+    with HostChroot(root, action_cache=cache) as chroot:
+        first = chroot.execute(command, capture_output=True, inputs=["/src"], outputs=["/out"])
+        assert (first.returncode, first.stdout, cache.misses) == (0, "built\n", 1)
+        shutil.rmtree(root / "out")
+
+        second = chroot.execute(command, capture_output=True, inputs=["/src"], outputs=["/out"])
+        assert (second.stdout, cache.hits) == ("built\n", 1)
+        assert (root / "out/result").read_text() == "v1"
+
+        # Output that is not captured goes to sys.stdout, even a replacement without a binary buffer
+        monkeypatch.setattr(sys, "stdout", io.StringIO())
+        chroot.execute(command, inputs=["/src"], outputs=["/out"])
+        assert sys.stdout.getvalue() == "built\n"
+        monkeypatch.undo()
+
+        (root / "src/in").write_text("v2")
+        chroot.execute(command, capture_output=True, inputs=["/src"], outputs=["/out"])
+        assert cache.misses == 2
+        assert (root / "out/result").read_text() == "v2"
+
+        # Failures are not stored
+        chroot.execute("exit 3", inputs=[])
+        chroot.execute("exit 3", inputs=[])
+        assert cache.misses == 4
+
+        # Outputs are part of the key: a record stored for /out holds nothing for /src
+        chroot.execute(command, capture_output=True, inputs=["/src"], outputs=["/out", "/src"])
+        assert cache.misses == 5
+
+        argv = chroot._command_argv(command)
+        key = cache.action_key(chroot, argv, chroot._command_env(), None, ["/src"], outputs=["/out"])
+    record = cache.lookup(key)
+    assert record["returncode"] == 0
+    assert set(record["outputs"]) == {"/out", "/out/result"}
+
+    # An action whose blobs were evicted is a miss
+    digest = record["outputs"]["/out/result"]["digest"]
+    (tmp_path / "cache/blobs" / digest[:2] / digest).unlink()
+    assert cache.lookup(key) is None
+    assert cache.prune(0) > 0
+    assert cache.size() == 0
+
+
+def test_action_key_covers_mounts_and_rejects_namespace_inputs(tmp_path):
+    """Mount sources are part of the key, and unshare mode refuses inputs that only exist in the namespace."""
+    from chorut.cache import ActionCache
+
+    cache = ActionCache(tmp_path / "cache")
+    keys = set()
+    for source in ("/srv/a", "/srv/b"):
+        chroot = ChrootManager(tmp_path, custom_mounts=[{"source": source, "target": "/data", "bind": True}])
+        keys.add(cache.action_key(chroot, ["make"], {}, None, []))
+    assert len(keys) == 2
+
+    chroot = ChrootManager(tmp_path, unshare_mode=True, custom_mounts=[{"source": "/srv", "target": "/data"}])
+    for path in ("/tmp/x", "/data", "/data/sub"):
+        with pytest.raises(ChrootError, match="only mounted inside the namespace"):
+            cache.action_key(chroot, ["make"], {}, None, [path])
+    cache.action_key(chroot, ["make"], {}, None, ["/database"])
+
+
+def test_cache_mounts_prune_when_unused(tmp_path):
+    """Cache mounts bind a store directory; a size-limited cache is pruned by its last user."""
+    chroot = ChrootManager(
+        tmp_path / "root",
+        cache_mounts={"pip": {"target": "/root/.cache/pip", "max_size": 0}},
+        cache_store=tmp_path / "store",
+    )
+    [[mount]] = chroot.mount_plan
+    assert (mount.source, mount.target, mount.bind) == (str(tmp_path / "store/pip"), "root/.cache/pip", True)
+
+    store, cache = chroot.cache_store, chroot.cache_mounts[0]
+    first, second = store.acquire(cache), store.acquire(cache)
+    (tmp_path / "store/pip/wheels").mkdir()
+    (tmp_path / "store/pip/wheels/a.whl").write_bytes(b"x" * 8192)
+    store.release(cache, first)
+    assert (tmp_path / "store/pip/wheels/a.whl").exists()
+    store.release(cache, second)
+    assert store.size("pip") == 0
+    assert not (tmp_path / "store/pip/wheels").exists()
+
+    with pytest.raises(MountError):
+        ChrootManager(tmp_path / "root", cache_mounts={"../x": "/x"})
+
+
+def test_prefetch_profile_records_open_files(tmp_path):
+    """Files held open below the root are recorded, saved, and replayed by prefetch()."""
+    from chorut.prefetch import Profile, prefetch
+
+    root = tmp_path / "root"
+    (root / "data").mkdir(parents=True)
+    (root / "data/model.bin").write_bytes(b"x" * 4096)
+    (root / "tmp").mkdir()
+    (root / "tmp/scratch").write_bytes(b"")
+
+    profile = Profile(tmp_path / "profile.json")
+    script = "import sys, time; files = [open(p) for p in sys.argv[1:]]; time.sleep(0.5)"
+    argv = [sys.executable, "-c", script, root / "data/model.bin", root / "tmp/scratch"]
+    with subprocess.Popen(argv) as process, profile.record(root, process.pid):
+        process.wait()
+    profile.save()
+
+    profile = Profile.load(tmp_path / "profile.json")
+    assert list(profile.files) == ["/data/model.bin"]
+    profile.add(["/data/model.bin"])
+    assert not profile.dirty
+    profile.add(["/etc/passwd", "/data/model.bin"])
+    assert profile.dirty
+    assert list(profile.files) == ["/etc/passwd", "/data/model.bin"]
+    profile.discard(["/etc/passwd"])
+    result = prefetch(root, profile.files)
+    assert (result.files, result.bytes, result.missing) == (1, 4096, [])
+
+    (root / "data/model.bin").unlink()
+    chroot = ChrootManager(root, prefetch_profile=tmp_path / "profile.json")
+    assert chroot.prefetch().missing == ["/data/model.bin"]
+    assert len(chroot.profile) == 0
+
+
+def test_process_sampler_attributes_cpu_and_io_to_children(tmp_path):
+    """Each process of a tree gets its own CPU time and I/O, without the children it waited for."""
+    from chorut.procstats import Sampler
+
+    script = (
+        "import os, sys, time\n"
+        "end = time.process_time() + 0.3\n"
+        "while time.process_time() < end: pass\n"
+        "with open(sys.argv[1], 'wb') as f: f.write(os.urandom(4 << 20)); os.fsync(f.fileno())\n"
+        "time.sleep(0.3)\n"
+    )
+    command = f"{shlex.quote(sys.executable)} -c {shlex.quote(script)} {tmp_path / 'out'}; sleep 0.3"
+    with subprocess.Popen(["/bin/sh", "-c", command]) as process, Sampler(process.pid, interval=0.02) as sampler:
+        process.wait()
+
+    report = sampler.report
+    shell, child = report.processes[:2]
+    assert shell.cmdline == ["/bin/sh", "-c", command]
+    assert child.ppid == shell.pid
+    assert child.cmdline[:2] == [sys.executable, "-c"]
+    assert child.cpu_time >= 0.2 > shell.cpu_time
+    assert [sample.cpu_time for sample in child.timeline] == sorted(sample.cpu_time for sample in child.timeline)
+    if child.write_bytes:
+        # With I/O accounting the write is counted once, for the child
+        assert child.write_bytes >= 4 << 20
+        assert shell.write_bytes < 1 << 20
+    assert report.samples >= 10
+    assert report.overhead < report.duration
+
+
+def test_run_graph_skips_dependents_of_failures(tmp_path):
+    """Steps run after their dependencies, failures skip what depends on them, and the critical path is reported."""
+    from chorut.graph import GraphError, run_graph
+
+    steps = [
+        {"name": "fetch", "command": "echo fetched > fetched"},
+        {"name": "build", "command": "sleep 0.2 && cat fetched", "deps": ["fetch"]},
+        {"name": "lint", "command": "exit 3", "deps": ["fetch"]},
+        {"name": "docs", "command": "true", "deps": ["lint"]},
+        {"name": "package", "command": "true", "deps": ["build", "docs"]},
+        {"name": "test", "command": "true", "deps": ["build"]},
+    ]
+    chroot = HostChroot(tmp_path)
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(tmp_path)
+        report = run_graph(chroot, steps, jobs=2, log_dir=tmp_path / "logs")
+
+    assert {name: result.status for name, result in report.steps.items()} == {
+        "fetch": "ok",
+        "build": "ok",
+        "lint": "failed",
+        "docs": "skipped",
+        "package": "skipped",
+        "test": "ok",
+    }
+    assert report.steps["lint"].returncode == 3
+    assert report.steps["package"].blocked_by == "lint"
+    assert (tmp_path / "logs/build.log").read_text() == "fetched\n"
+    assert report.critical_path[:2] == ["fetch", "build"]
+
+    cycle = [{"name": "a", "command": "true", "deps": ["b"]}, {"name": "b", "command": "true", "deps": ["a"]}]
+    with pytest.raises(GraphError):
+        run_graph(chroot, cycle)
+
+
+def test_run_graph_records_steps_that_cannot_start(tmp_path):
+    """A step whose command cannot be started fails and skips its dependents, without waiting on nothing."""
+    from chorut.graph import run_graph
+
+    class BrokenChroot(HostChroot):
+        def popen(self, command, userspec=None, mounts=None, **kwargs):
+            if command == "missing":
+                raise FileNotFoundError(2, "No such file or directory", "missing")
+            if command == "unset":
+                raise ChrootError("Chroot environment not set up. Call setup() first.")
+            return super().popen(command, userspec, mounts, **kwargs)
+
+    chroot = BrokenChroot(tmp_path)
+    report = run_graph(chroot, [{"name": "only", "command": "missing"}], log_dir=tmp_path / "logs")
+    assert report.failed == ["only"]
+    assert "No such file" in report.steps["only"].output
+
+    steps = [
+        {"name": "a", "command": "unset"},
+        {"name": "b", "command": "true", "deps": ["a"]},
+        {"name": "c", "command": "true"},
+    ]
+    report = run_graph(chroot, steps, jobs=1)
+    assert {name: result.status for name, result in report.steps.items()} == {
+        "a": "failed",
+        "b": "skipped",
+        "c": "ok",
+    }
+
+
+def test_fleet_rate_limits_and_reports_failures(tmp_path):
+    """A fleet sets roots up at no more than its rate, and keeps failed roots apart."""
+    from chorut.fleet import ChrootFleet
+
+    with ChrootFleet(max_concurrent=2, rate=50) as fleet:
+        for i in range(8):
+            (tmp_path / f"root{i}").mkdir()
+            fleet.add(tmp_path / f"root{i}", unshare_mode=True)
+        missing = fleet.add(tmp_path / "missing", unshare_mode=True)
+
+        start = time.monotonic()
+        failures = fleet.setup()
+        # Two tokens up front, then one every 20ms
+        assert time.monotonic() - start >= 0.13
+        assert list(failures) == [missing]
+        assert isinstance(failures[missing], ChrootError)
+        assert [fleet.state(i) for i in (0, 7, missing)] == ["ready", "ready", "failed"]
+
+        stats = fleet.stats()
+        assert (stats.roots, stats.ready, stats.failed, stats.setups, stats.errors) == (9, 8, 1, 9, 1)
+        assert stats.throughput > 0
+        # Only roots that are set up hold a manager
+        assert sorted(fleet._managers) == list(range(8))
+        assert fleet[0]._is_setup
+        # Managers handed out for roots without one are not kept
+        assert fleet[missing] is not fleet[missing]
+        (tmp_path / "root8").mkdir()
+        idle = fleet.add(tmp_path / "root8", unshare_mode=True)
+        assert not fleet[idle]._is_setup
+        assert idle not in fleet._managers
+
+        # Roots that are set up, or on their way, are not set up again
+        with pytest.raises(ChrootError, match="while it is ready"):
+            fleet.submit_setup(0)
+        assert list(fleet.setup([0, idle])) == [0]
+        assert fleet.state(idle) == "ready"
+
+        own = ChrootManager(tmp_path / "root0", unshare_mode=True)
+        assert fleet[fleet.add(own)] is own
+
+    assert fleet.stats().teardowns == 9
+    assert list(fleet._managers.values()) == [own]
+
+
+def test_stdin_chunks_stream_without_deadlock():
+    """Iterators are pumped into stdin while output is read; fds and real files are passed through."""
+    import io
+    import threading
+
+    from chorut import _pump_stdin, _stdin_source
+
+    assert _stdin_source(None) == (None, None)
+    assert _stdin_source(5) == (5, None)
+    with open(__file__, "rb") as f:
+        assert _stdin_source(f) == (f, None)
+    assert list(_stdin_source(io.BytesIO(b"abc"))[1]) == [b"abc"]
+    with pytest.raises(TypeError):
+        _stdin_source(1.5)
+
+    # More than a pipe buffer each way: writing everything before reading would deadlock
+    stdin, chunks = _stdin_source(b"x" * 65536 for _ in range(64))
+    errors: list = []
+    with subprocess.Popen(["cat"], stdin=stdin, stdout=subprocess.PIPE) as process:
+        writer, process.stdin = process.stdin, None
+        pump = threading.Thread(target=_pump_stdin, args=(process, writer, chunks, errors))
+        pump.start()
+        stdout, _ = process.communicate()
+        pump.join()
+    assert len(stdout) == 64 * 65536
+    assert not errors
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="chroot(2) needs root")
+def test_run_callable_returns_results_and_errors(tmp_path):
+    """Results and exceptions come back from the chroot, even when fn leaves a process holding the pipe."""
+    (tmp_path / "marker").touch()
+    chroot = HostChroot(tmp_path)
+    with chroot:
+        assert chroot.run_callable(os.listdir, "/") == ["marker"]
+        assert chroot.run_callable(os.getuid, userspec="1000:1000") == 1000
+        with pytest.raises(FileNotFoundError):
+            chroot.run_callable(os.stat, "/missing")
+        with pytest.raises(ChrootError, match="Failed to pickle"):
+            chroot.run_callable(lambda: lambda: None)
+        with pytest.raises(ChrootError, match="exit status 5"):
+            chroot.run_callable(os._exit, 5)
+
+        def leave_background_process(result):
+            if os.fork() == 0:
+                time.sleep(3)
+                os._exit(0)
+            if result is None:
+                os._exit(5)
+            return result
+
+        start = time.monotonic()
+        assert chroot.run_callable(leave_background_process, 42) == 42
+        with pytest.raises(ChrootError, match="exit status 5"):
+            chroot.run_callable(leave_background_process, None)
+        assert time.monotonic() - start < 2
+
+
+def test_supervisor_collects_times_out_and_kills(tmp_path):
+    """Jobs are reaped with their output, killed at their timeout, and killed when the supervisor closes."""
+    from chorut.supervisor import Supervisor
+
+    chroot = HostChroot(tmp_path)
+    chroot.setup()
+    exited = []
+    chunks = []
+    with Supervisor() as supervisor:
+        echo = supervisor.spawn(chroot, "echo out; echo err >&2; exit 3", on_exit=exited.append)
+        streamed = supervisor.spawn(
+            chroot, ["echo", "chunk"], text=False, on_output=lambda job, name, data: chunks.append((name, data))
+        )
+        slow = supervisor.spawn(chroot, ["sleep", "10"], timeout=0.2)
+        with pytest.raises(ChrootError, match="has not finished"):
+            slow.result()
+        assert len(supervisor) == 3
+
+        finished = supervisor.wait(timeout=5)
+        assert set(finished) == {echo, streamed, slow}
+        assert exited == [echo]
+        result = echo.result()
+        assert (result.returncode, result.stdout, result.stderr) == (3, "out\n", "err\n")
+        assert chunks == [("stdout", b"chunk\n")]
+        assert streamed.result().stdout == b""
+        assert slow.timed_out
+        assert slow.returncode == -signal.SIGKILL
+        assert slow.duration < 5
+        # Signalling a reaped job does nothing, as its pid may be in use again
+        slow.kill()
+
+        left = supervisor.spawn(chroot, ["sleep", "10"], capture_output=False)
+        assert supervisor.poll(timeout=0) == []
+    assert left.returncode == -signal.SIGKILL
+    assert len(supervisor) == 0
+
+    # A process left behind by a killed command holds its pipes, so close() stops reading at its timeout
+    with Supervisor() as supervisor:
+        orphaned = supervisor.spawn(chroot, "sleep 3 & echo started; wait")
+        while not orphaned._output["stdout"]:
+            supervisor.poll(timeout=5)
+        start = time.monotonic()
+        supervisor.close(timeout=0.2)
+    assert time.monotonic() - start < 2
+    assert orphaned.returncode == -signal.SIGKILL
+    assert orphaned.result().stdout == "started\n"
+
+
+def test_pty_sessions_relay_io_and_close(tmp_path):
+    """Sessions see their pty as a terminal of the requested size; close() kills sessions that ignore SIGHUP."""
+    from chorut.terminal import PtyMultiplexer
+
+    chroot = HostChroot(tmp_path)
+    chroot.setup()
+    output = bytearray()
+    ended = []
+    with PtyMultiplexer() as mux:
+        session = mux.spawn(
+            chroot,
+            ["sh", "-c", "stty size; read line; echo got $line"],
+            rows=30,
+            cols=100,
+            on_output=lambda session, data: output.extend(data),
+            on_exit=ended.append,
+        )
+        mux.write(session, b"hello\n")
+        mux.run()
+    assert ended == [session]
+    assert session.returncode == 0
+    assert b"30 100" in output
+    assert b"got hello" in output
+
+    mux = PtyMultiplexer()
+    output.clear()
+    stubborn = mux.spawn(
+        chroot,
+        ["sh", "-c", "trap '' HUP; echo ready; exec sleep 30"],
+        on_output=lambda session, data: output.extend(data),
+    )
+    polite = mux.spawn(chroot, ["sleep", "30"])
+    while b"ready" not in output:
+        mux.poll(timeout=5)
+    start = time.monotonic()
+    mux.close(timeout=0.5)
+    assert time.monotonic() - start < 5
+    assert polite.returncode == -signal.SIGHUP
+    assert stubborn.returncode == -signal.SIGKILL
+    assert not mux.sessions
+
+
+def test_batch_streams_output_and_reports_results(tmp_path, capfd):
+    """Batch results are written as JSON lines; uncaptured output streams to stderr."""
+    import io
+    import json
+    import threading
+
+    from chorut.batch import run_batch
+
+    lines = [
+        "echo one",
+        "# comment",
+        '{"id": "cap", "command": ["sh", "-c", "echo two; echo err >&2"], "capture": true}',
+        "",
+        '{"command": 1}',
+        "exit 4",
+    ]
+    output = io.StringIO()
+    with HostChroot(tmp_path) as chroot:
+        assert run_batch(chroot, lines, output=output) == 1
+    # Parse errors are reported at once, results as commands finish
+    records = sorted((json.loads(line) for line in output.getvalue().splitlines()), key=lambda record: record["line"])
+    assert [(record["line"], record["returncode"]) for record in records] == [(1, 0), (3, 0), (5, None), (6, 4)]
+    assert records[1]["id"] == "cap"
+    assert (records[1]["stdout"], records[1]["stderr"]) == ("two\n", "err\n")
+    assert "must be a string" in records[2]["error"]
+    assert "stdout" not in records[0]
+    assert capfd.readouterr() == ("", "one\n")
+
+    # The output of a running command is on stderr before the command finishes
+    done = tmp_path / "done"
+    command = f"echo started >&2; while [ ! -e {done} ]; do sleep 0.01; done"
+    with HostChroot(tmp_path) as chroot:
+        thread = threading.Thread(target=run_batch, args=(chroot, [command]), kwargs={"output": output})
+        thread.start()
+        try:
+            deadline = time.monotonic() + 5
+            while "started" not in capfd.readouterr().err:
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+        finally:
+            done.touch()
+            thread.join()
+
+
+def test_batch_commands_do_not_read_batch_input(tmp_path, capfd):
+    """With '--batch -' the batch input is stdin, so commands get /dev/null or their own 'stdin' string."""
+    import io
+    import json
+    import threading
+
+    from chorut.batch import run_batch
+
+    read_fd, write_fd = os.pipe()
+    saved_stdin = os.dup(0)
+    os.dup2(read_fd, 0)
+    output = io.StringIO()
+    try:
+        with HostChroot(tmp_path) as chroot, os.fdopen(read_fd) as lines, os.fdopen(write_fd, "w") as writer:
+            thread = threading.Thread(target=run_batch, args=(chroot, lines), kwargs={"output": output})
+            thread.start()
+            try:
+                writer.write("cat\n")
+                writer.flush()
+                # A cat reading the batch input would wait for more lines
+                deadline = time.monotonic() + 5
+                while not output.getvalue():
+                    assert time.monotonic() < deadline
+                    time.sleep(0.01)
+                writer.write('{"command": "cat", "stdin": "fed\\n", "capture": true}\n')
+                writer.write('{"command": "cat", "stdin": "streamed\\n"}\n')
+            finally:
+                writer.close()
+                thread.join()
+    finally:
+        os.dup2(saved_stdin, 0)
+        os.close(saved_stdin)
+
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [(record["line"], record["returncode"]) for record in records] == [(1, 0), (2, 0), (3, 0)]
+    assert records[1]["stdout"] == "fed\n"
+    assert capfd.readouterr().err == "streamed\n"
+
+
+def test_server_protocol_over_socketpair(tmp_path):
+    """Requests are served over a socket: streamed execute with large input, put and get by descriptor."""
+    import socket
+    import threading
+
+    from chorut.server import FRAME_DATA, FRAME_JSON, ChrootClient, ChrootServer, recv_message, send_frame, send_message
+
+    root = tmp_path / "root"
+    root.mkdir()
+    server = ChrootServer(tmp_path / "socket", {"host": HostChroot(root)})
+    server_sock, client_sock = socket.socketpair()
+    thread = threading.Thread(target=server._handle_connection, args=(server_sock,), daemon=True)
+    thread.start()
+    client = ChrootClient.__new__(ChrootClient)
+    client.sock = client_sock
+
+    with client:
+        assert client.roots()["host"]["active"] == 0
+
+        # Far more than the socket and pipe buffers in both directions at once
+        data = os.urandom(1 << 22)
+        result = client.execute("host", "cat; echo done >&2", input=data)
+        assert result.returncode == 0
+        assert result.stdout == data
+        assert result.stderr == b"done\n"
+        # Input the command never reads is drained, so the connection stays usable
+        result = client.execute("host", "exit 3", input=data)
+        assert result.returncode == 3
+
+        source = tmp_path / "source"
+        source.write_bytes(b"payload")
+        assert client.put("host", source, "/copy") == 7
+        assert (root / "copy").read_bytes() == b"payload"
+        assert client.get("host", "/copy", tmp_path / "back") == 7
+        assert (tmp_path / "back").read_bytes() == b"payload"
+
+        with pytest.raises(ChrootError, match="Unknown root"):
+            client.execute("missing", "true")
+        send_frame(client.sock, FRAME_DATA, b"x")
+        assert b"Expected a request" in client.sock.recv(4096)
+        send_frame(client.sock, FRAME_JSON, b"[]")
+        assert recv_message(client.sock)[0]["message"] == "A request must be a JSON object"
+        send_message(client.sock, {"op": "execute", "root": "host", "command": "true", "stdio": "fds"}, fds=[0])
+        assert "three file descriptors" in recv_message(client.sock)[0]["message"]
+        assert client.roots()["host"]["limit"] == 4
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+
+
+def test_exec_hands_teardown_to_reaper(tmp_path):
+    """exec() replaces the calling process, and a reaper keeps the cache locks until the command exits."""
+    import fcntl
+
+    script = f"""
+from chorut import ChrootManager
+
+class HostChroot(ChrootManager):
+    def _build_command(self, command, userspec):
+        return command, self._command_env()
+
+store = {str(tmp_path / "store")!r}
+chroot = HostChroot({str(tmp_path)!r}, unshare_mode=True, cache_mounts={{"pip": "/pip"}}, cache_store=store)
+chroot.setup()
+chroot.exec(["sh", "-c", "echo $$ && exec sleep 0.5"])
+"""
+    with subprocess.Popen(
+        [sys.executable, "-c", script], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    ) as process:
+        assert int(process.stdout.readline()) == process.pid
+        lock = os.open(tmp_path / "store/pip.lock", os.O_RDWR)
+        with pytest.raises(BlockingIOError):
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # The reaper does not hold the command's stdout or stderr
+        assert process.stdout.read() == ""
+        assert process.stderr.read() == ""
+        assert process.wait() == 0
+
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+    os.close(lock)
+
+
+def test_setup_profiles_and_deferred_mounts(tmp_path):
+    """Profiles select the standard mounts; deferred mounts are only made for commands that declare them."""
+    mounts = [
+        {"source": "/srv/data", "target": "/data", "bind": True, "defer": True},
+        {"source": "tmpfs", "target": "/data/scratch", "fstype": "tmpfs"},
+        {"source": "/var/cache", "target": "/cache", "bind": True},
+    ]
+    chroot = ChrootManager(
+        tmp_path, unshare_mode=True, custom_mounts=mounts, setup_profile="minimal", standard_mounts={"tmp": True}
+    )
+    assert chroot.standard_mounts == ("proc", "dev", "tmp")
+    script = chroot._create_unshare_script()
+    assert "mount -t tmpfs tmp tmp" in script
+    assert "/sys" not in script
+    assert "resolv.conf" not in script
+    assert "/var/cache cache" in script
+    assert "data" not in script
+
+    script = chroot._create_unshare_script(deferred=chroot._deferred_targets(["/data/scratch"]))
+    assert script.index("/srv/data data") < script.index("data/scratch")
+    with pytest.raises(MountError):
+        chroot._deferred_targets(["/srv"])
+
+    # Cached results depend on the deferred mounts the command declares
+    from chorut.cache import ActionCache
+
+    cache = ActionCache(tmp_path / "cache")
+    keys = {cache.action_key(chroot, ["make"], {}, None, [], mounts) for mounts in (None, ["/data"], ["/data/scratch"])}
+    assert len(keys) == 2
+
+    with pytest.raises(ChrootError):
+        ChrootManager(tmp_path, setup_profile="tiny")
+    with pytest.raises(ChrootError):
+        ChrootManager(tmp_path, standard_mounts={"home": True})
+
+
+def test_recording_backend_checks_order_and_recovers(tmp_path):
+    """Root mode setup runs unprivileged on a recording backend, and a failed setup undoes its mounts."""
+    from chorut.recording import RecordingMountManager
+
+    mounts = [
+        {"source": "/srv", "target": "/srv", "bind": True},
+        {"source": "tmpfs", "target": "/srv/tmp", "fstype": "tmpfs"},
+    ]
+    recorder = RecordingMountManager()
+    with ChrootManager(tmp_path, custom_mounts=mounts, mount_manager=recorder):
+        assert len(recorder.mounts) == 9
+        assert str(tmp_path / "srv/tmp") in recorder.mounts
+    mounted = [operation.target for operation in recorder.operations if operation.kind == "mount"]
+    unmounted = [operation.target for operation in recorder.operations if operation.kind == "umount"]
+    assert unmounted == mounted[::-1]
+    assert not recorder.mounts
+    assert not recorder.failures()
+
+    recorder = RecordingMountManager(fail=["mount */srv/tmp"])
+    with pytest.raises(ChrootError):
+        ChrootManager(tmp_path, custom_mounts=mounts, mount_manager=recorder).setup()
+    assert not recorder.mounts
+    assert recorder.counts()["umount"] == 8
+
+    # Like the kernel, the table refuses to unmount a mount that has mounts below it
+    recorder = RecordingMountManager()
+    recorder.mount("/srv", str(tmp_path / "srv"), bind=True)
+    recorder.mount("tmpfs", str(tmp_path / "srv/tmp"), fstype="tmpfs")
+    recorder.active_mounts.reverse()
+    recorder.unmount_all()
+    assert [operation.error for operation in recorder.failures()] == ["target is busy"]
+    assert list(recorder.mounts) == [str(tmp_path / "srv")]
+
+
+def test_root_image_detection_and_cleanup(tmp_path, monkeypatch):
+    """Images are recognised by their magic, and teardown removes the overlay and forgets the loop device."""
+    from chorut import _linux
+    from chorut.recording import RecordingMountManager
+
+    squashfs = tmp_path / "root.squashfs"
+    squashfs.write_bytes(b"hsqs" + bytes(2044))
+    erofs = tmp_path / "root.erofs"
+    erofs.write_bytes(bytes(1024) + b"\xe2\xe1\xf5\xe0" + bytes(1020))
+    other = tmp_path / "root.img"
+    other.write_bytes(bytes(2048))
+    assert ChrootManager._image_fstype(squashfs) == "squashfs"
+    assert ChrootManager._image_fstype(erofs) == "erofs"
+    assert ChrootManager._image_fstype(other) is None
+
+    def loop_attach(path, read_only=True, direct_io=True):
+        return "/dev/loop7", os.open(os.devnull, os.O_RDONLY)
+
+    monkeypatch.setattr(_linux, "loop_attach", loop_attach)
+    root = tmp_path / "root"
+    recorder = RecordingMountManager()
+    chroot = ChrootManager(root, image=squashfs, image_overlay=True, mount_manager=recorder)
+    with chroot:
+        assert recorder.mounts[str(root)].startswith("overlay")
+        assert chroot._loop_device == "/dev/loop7"
+        assert len(chroot._image_dirs) == 2
+    assert not recorder.mounts
+    assert not recorder.failures()
+    assert chroot._loop_device is None
+    assert not chroot._image_dirs
+    # Only the state directory is left, as upper and work were made on a tmpfs the recorder did not mount
+    (state,) = tmp_path.glob(".root.*")
+    assert state.name.startswith(".root.state-")
+    assert sorted(os.listdir(state)) == ["upper", "work"]
+
+
+def test_image_released_when_setup_fails(tmp_path, monkeypatch):
+    """A setup() that fails after the image is mounted unmounts it again."""
+    from chorut import _linux
+    from chorut.recording import RecordingMountManager
+
+    image = tmp_path / "root.squashfs"
+    image.write_bytes(b"hsqs" + bytes(2044))
+    monkeypatch.setattr(_linux, "loop_attach", lambda *args, **kwargs: ("/dev/loop7", os.open(os.devnull, os.O_RDONLY)))
+
+    def fail():
+        raise ChrootError("no root here")
+
+    recorder = RecordingMountManager()
+    chroot = ChrootManager(tmp_path / "root", image=image, image_overlay=True, mount_manager=recorder)
+    monkeypatch.setattr(chroot, "_check_chroot_dir", fail)
+    with pytest.raises(ChrootError, match="no root here"):
+        chroot.setup()
+    assert not recorder.mounts
+    assert not recorder.failures()
+    assert chroot._loop_device is None
+    assert not chroot._image_dirs
+
+    # A cache store that cannot be created fails after the image is mounted too
+    (tmp_path / "store").write_text("")
+    chroot = ChrootManager(
+        tmp_path / "root",
+        image=image,
+        cache_mounts={"pip": "/root/.cache/pip"},
+        cache_store=tmp_path / "store",
+        mount_manager=recorder,
+    )
+    with pytest.raises(ChrootError, match="Failed to prepare cache mounts"):
+        chroot.setup()
+    assert not recorder.mounts
+    assert not recorder.failures()
+    assert chroot._loop_device is None
+    assert not chroot._cache_locks
+
+
+def test_compile_mounts_orders_and_deduplicates():
+    """Nested targets are mounted after their parents; siblings share a wave."""
+    plan = compile_mounts(
+        [
+            {"source": "/srv", "target": "work/src/data", "bind": True},
+            {"source": "tmpfs", "target": "/work", "fstype": "tmpfs"},
+            {"source": "tmpfs", "target": "cache/", "fstype": "tmpfs"},
+            MountSpec(source="tmpfs", target="work", fstype="tmpfs"),
+        ]
+    )
+    assert [[m.target for m in wave] for wave in plan] == [["work", "cache"], ["work/src/data"]]
+
+    with pytest.raises(MountError):
+        compile_mounts([{"source": "a", "target": "x"}, {"source": "b", "target": "/x"}])
+    with pytest.raises(MountError):
+        compile_mounts([{"source": "a", "target": "/"}])
+
+
+def test_idmap_ranges_and_unshare_translation():
+    """Idmaps parse into uid and gid ranges, and chroot ids translate through a namespace id map."""
+    from chorut import _map_ranges, _parse_idmap, _parse_mount_option
+
+    assert _parse_idmap("1000:0 u:2000:100:10") == ([(1000, 0, 1), (2000, 100, 10)], [(1000, 0, 1)])
+    # unshare --map-root-user --map-auto: root is the caller, other ids come from /etc/subuid
+    ns_map = [(0, 1000, 1), (1, 100000, 65536)]
+    assert _map_ranges([(1000, 0, 3)], ns_map) == [(1000, 1000, 1), (1001, 100000, 2)]
+    with pytest.raises(MountError):
+        _map_ranges([(0, 65537, 1)], ns_map)
+
+    spec = MountSpec.parse(_parse_mount_option("/src:work:bind,ro,idmap=u:1000:0 g:1000:0"))
+    assert (spec.options, spec.idmap, spec.idmap_attributes()) == ("bind,ro", "u:1000:0 g:1000:0", 1)
+    for bad in ({"idmap": "1000"}, {"idmap": "x:1:2"}, {"idmap": "1:2", "options": "size=1G"}):
+        with pytest.raises(MountError):
+            MountSpec(source="/src", target="work", bind=True, **bad)
+    with pytest.raises(MountError):
+        MountSpec(source="/src", target="work", idmap="1000:0")
+    hidden = {"source": "/src", "target": "tmp/src", "bind": True, "idmap": "0:0"}
+    with pytest.raises(MountError):
+        ChrootManager("/tmp", unshare_mode=True, custom_mounts=[hidden])
+
+
+@pytest.mark.parametrize(
+    ("command", "needs_shell"),
+    [
+        ("echo 'hello world'", False),
+        ("echo 'a|b' \"$x\"", True),
+        ("echo 'a|b' '$x'", False),
+        ("ls | wc -l", True),
+        ("FOO=bar env", True),
+        ("env FOO=bar", False),
+        ("find . -exec rm {} \\;", False),
+        ("echo {a,b}", True),
+    ],
+)
+def test_parse_command_is_quote_aware(command, needs_shell):
+    """Shell features inside single quotes do not trigger bash -c wrapping."""
+    argv = _parse_command(command)
+    if needs_shell:
+        assert argv == ("bash", "-c", command)
+    else:
+        assert list(argv) == shlex.split(command)
+
+
 if __name__ == "__main__":
     test_library()